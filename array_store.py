@@ -0,0 +1,229 @@
+##############################################
+# Sharded on-disk store for NumPy arrays.    #
+# Arrays are appended to a few large shard   #
+# files instead of one .npy file each.       #
+##############################################
+
+import os
+import time
+import sqlite3
+import threading
+import numpy as np
+
+
+class ShardedArrayStore:
+    """
+    Stores many small arrays in append-only shard files with a SQLite index.
+
+    Each array is written as raw bytes to the current shard; the index keeps
+    its shard, offset, dtype, shape and last access time. Shards roll over
+    once they pass shard_bytes. Deleted arrays leave holes that compact()
+    reclaims.
+    """
+
+    def __init__(self, directory, shard_bytes=256 * 1024 * 1024, commit_every=1000):
+        """
+        Args:
+            directory (str): Folder holding the shards and index.sqlite
+            shard_bytes (int): Size at which a new shard is started
+            commit_every (int): Index writes between commits
+        """
+        self.directory = directory
+        self.shard_bytes = shard_bytes
+        self.commit_every = commit_every
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.RLock()
+        self._pending = 0
+        self._db = sqlite3.connect(os.path.join(directory, 'index.sqlite'), check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS arrays ('
+            ' key TEXT PRIMARY KEY, shard INTEGER, offset INTEGER, nbytes INTEGER,'
+            ' dtype TEXT, shape TEXT, last_access REAL)')
+        self._db.execute('CREATE INDEX IF NOT EXISTS arrays_last_access ON arrays (last_access)')
+        self._db.commit()
+        row = self._db.execute('SELECT MAX(shard), COALESCE(SUM(nbytes), 0) FROM arrays').fetchone()
+        self._shard = row[0] if row[0] is not None else 0
+        self._live_bytes = row[1]
+
+    def _shard_path(self, shard):
+        return os.path.join(self.directory, f'shard-{shard:05d}.bin')
+
+    def _touch(self):
+        self._pending += 1
+        if self._pending >= self.commit_every:
+            self.flush()
+
+    def flush(self):
+        """ Commit pending index changes. """
+        with self._lock:
+            self._db.commit()
+            self._pending = 0
+
+    def close(self):
+        self.flush()
+        self._db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def put(self, key, array):
+        """
+        Append an array, replacing any array stored under the same key.
+
+        Args:
+            key (str): Lookup key
+            array (np.ndarray): The array to store
+        """
+        array = np.ascontiguousarray(array)
+        data = array.tobytes()
+        with self._lock:
+            replaced = self._db.execute('SELECT nbytes FROM arrays WHERE key = ?', (key,)).fetchone()
+            if replaced is not None:
+                self._live_bytes -= replaced[0]
+            path = self._shard_path(self._shard)
+            if os.path.exists(path) and os.path.getsize(path) + len(data) > self.shard_bytes:
+                self._shard += 1
+                path = self._shard_path(self._shard)
+            with open(path, 'ab') as shard_file:
+                offset = shard_file.tell()
+                shard_file.write(data)
+            self._db.execute(
+                'INSERT OR REPLACE INTO arrays VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (key, self._shard, offset, len(data), array.dtype.str,
+                 ','.join(str(x) for x in array.shape), time.time()))
+            self._live_bytes += len(data)
+            self._touch()
+
+    def _read(self, shard, offset, nbytes, dtype, shape):
+        shape = tuple(int(x) for x in shape.split(',') if x)
+        with open(self._shard_path(shard), 'rb') as shard_file:
+            shard_file.seek(offset)
+            data = shard_file.read(nbytes)
+        return np.frombuffer(data, dtype=np.dtype(dtype)).reshape(shape)
+
+    def get(self, key, touch=True):
+        """
+        Args:
+            key (str): Lookup key
+            touch (bool): Record the access for LRU eviction
+
+        Returns:
+            np.ndarray: The stored array (read-only), or None if missing
+        """
+        with self._lock:
+            row = self._db.execute(
+                'SELECT shard, offset, nbytes, dtype, shape FROM arrays WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            if touch:
+                self._db.execute('UPDATE arrays SET last_access = ? WHERE key = ?', (time.time(), key))
+                self._touch()
+        return self._read(*row)
+
+    def __contains__(self, key):
+        with self._lock:
+            return self._db.execute('SELECT 1 FROM arrays WHERE key = ?', (key,)).fetchone() is not None
+
+    def __len__(self):
+        with self._lock:
+            return self._db.execute('SELECT COUNT(*) FROM arrays').fetchone()[0]
+
+    def keys(self):
+        """ All keys, in shard order. """
+        with self._lock:
+            return [row[0] for row in self._db.execute('SELECT key FROM arrays ORDER BY shard, offset')]
+
+    def iter_arrays(self):
+        """
+        Yield (key, array) pairs in shard order, reading each shard once.
+        """
+        with self._lock:
+            rows = self._db.execute(
+                'SELECT key, shard, offset, nbytes, dtype, shape FROM arrays ORDER BY shard, offset').fetchall()
+        current_shard = None
+        data = None
+        for key, shard, offset, nbytes, dtype, shape in rows:
+            if shard != current_shard:
+                data = np.memmap(self._shard_path(shard), dtype=np.uint8, mode='r')
+                current_shard = shard
+            shape = tuple(int(x) for x in shape.split(',') if x)
+            yield key, np.frombuffer(data[offset:offset + nbytes], dtype=np.dtype(dtype)).reshape(shape)
+
+    def total_bytes(self):
+        """ Bytes held by live arrays (holes left by deletes not counted). """
+        return self._live_bytes
+
+    def delete(self, key):
+        with self._lock:
+            row = self._db.execute('SELECT nbytes FROM arrays WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return
+            self._db.execute('DELETE FROM arrays WHERE key = ?', (key,))
+            self._live_bytes -= row[0]
+            self._touch()
+
+    def evict(self, max_bytes):
+        """
+        Drop least recently used arrays until live bytes fit in max_bytes,
+        then reclaim the space.
+
+        Args:
+            max_bytes (int): Budget for live arrays
+
+        Returns:
+            int: Number of arrays evicted
+        """
+        evicted = 0
+        with self._lock:
+            excess = self.total_bytes() - max_bytes
+            if excess <= 0:
+                return 0
+            rows = self._db.execute('SELECT key, nbytes FROM arrays ORDER BY last_access')
+            doomed = []
+            for key, nbytes in rows:
+                if excess <= 0:
+                    break
+                doomed.append((key,))
+                excess -= nbytes
+                self._live_bytes -= nbytes
+            self._db.executemany('DELETE FROM arrays WHERE key = ?', doomed)
+            self.flush()
+            evicted = len(doomed)
+        self.compact()
+        return evicted
+
+    def compact(self, min_live_fraction=0.5):
+        """
+        Delete shards with no live arrays, and rewrite shards that are
+        mostly holes into the current shard.
+
+        Args:
+            min_live_fraction (float): Shards with less live data than this
+                fraction of their size are rewritten
+        """
+        with self._lock:
+            live = dict(self._db.execute('SELECT shard, SUM(nbytes) FROM arrays GROUP BY shard').fetchall())
+            for name in sorted(os.listdir(self.directory)):
+                if not (name.startswith('shard-') and name.endswith('.bin')):
+                    continue
+                shard = int(name[len('shard-'):-len('.bin')])
+                if shard == self._shard:
+                    continue
+                path = self._shard_path(shard)
+                if shard not in live:
+                    os.remove(path)
+                    continue
+                if live[shard] >= min_live_fraction * os.path.getsize(path):
+                    continue
+                rows = self._db.execute(
+                    'SELECT key, offset, nbytes, dtype, shape, last_access FROM arrays WHERE shard = ?',
+                    (shard,)).fetchall()
+                for key, offset, nbytes, dtype, shape, last_access in rows:
+                    self.put(key, self._read(shard, offset, nbytes, dtype, shape))
+                    self._db.execute('UPDATE arrays SET last_access = ? WHERE key = ?', (last_access, key))
+                self.flush()
+                os.remove(path)
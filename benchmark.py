@@ -0,0 +1,284 @@
+##############################################
+# Micro-benchmarks for the functions.py      #
+# preprocessing steps on synthetic images,   #
+# checked against a stored baseline so a     #
+# slowdown fails loudly. Runs offline.       #
+##############################################
+
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+from contextlib import contextmanager, redirect_stdout
+import numpy as np
+import PIL
+from PIL import Image
+from functions import (resize_to_fit, pad_to_square, process_image_to_numpy_array,
+                       save_image, save_numpy_array)
+from vector_loader import STORAGE_DTYPES, to_storage
+
+# (width, height): small, HD, portrait, phone camera, panorama
+RESOLUTIONS = [(640, 480), (1920, 1080), (1080, 1920), (4032, 3024), (3000, 500)]
+FORMATS = ['JPEG', 'PNG']
+STEPS = ['decode', 'resize', 'pad', 'grayscale', 'normalize', 'save', 'process']
+
+
+def synthetic_image(width, height, image_format, seed=0):
+    """
+    Encoded bytes of a photo-like test image: smooth gradients with noise,
+    so JPEG and PNG have something realistic to compress.
+
+    Args:
+        width (int): Width in pixels
+        height (int): Height in pixels
+        image_format (str): 'JPEG' or 'PNG'
+        seed (int): Seed for the noise, the same seed gives the same bytes
+
+    Returns:
+        bytes: The encoded image
+    """
+    rng = np.random.default_rng(seed)
+    y = np.linspace(0, 1, height, dtype=np.float32)[:, None]
+    x = np.linspace(0, 1, width, dtype=np.float32)[None, :]
+    channels = [x * 255, y * 255, (x + y) * 127.5]
+    pixels = np.stack([np.broadcast_to(c, (height, width)) for c in channels], axis=-1)
+    pixels = pixels + rng.normal(0, 12, pixels.shape).astype(np.float32)
+    image = Image.fromarray(np.clip(pixels, 0, 255).astype(np.uint8), 'RGB')
+    buffer = io.BytesIO()
+    image.save(buffer, format=image_format, **({'quality': 90} if image_format == 'JPEG' else {}))
+    return buffer.getvalue()
+
+
+@contextmanager
+def _working_directory(path):
+    # process_image_to_numpy_array saves under ./results and ./vectors
+    previous = os.getcwd()
+    os.chdir(path)
+    try:
+        yield
+    finally:
+        os.chdir(previous)
+
+
+def _time(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return result, (time.perf_counter() - start) * 1000
+
+
+def run_case(data, size, dtype, workspace):
+    """
+    Time each preprocessing step once for one encoded image.
+
+    Returns:
+        dict: Step name -> milliseconds
+    """
+    timings = {}
+
+    def decode():
+        image = Image.open(io.BytesIO(data))
+        image.load()
+        return image
+
+    image, timings['decode'] = _time(decode)
+    resized, timings['resize'] = _time(resize_to_fit, image, size)
+    padded, timings['pad'] = _time(pad_to_square, resized, size)
+    _, timings['grayscale'] = _time(padded.convert, 'L')
+    vector, timings['normalize'] = _time(lambda: to_storage(np.array(padded), dtype).flatten())
+    with redirect_stdout(io.StringIO()):
+        _, timings['save'] = _time(lambda: (save_image(padded, os.path.join(workspace, 'results')),
+                                            save_numpy_array(vector, os.path.join(workspace, 'vectors'))))
+        with _working_directory(workspace):
+            _, timings['process'] = _time(
+                lambda: process_image_to_numpy_array(decode(), size, dtype=dtype))
+    return timings
+
+
+def case_name(image_format, width, height):
+    return f'{image_format}-{width}x{height}'
+
+
+def run(resolutions=RESOLUTIONS, formats=FORMATS, size=64, dtype='float64', repeat=7, warmup=1,
+        only=None):
+    """
+    Benchmark every resolution and format.
+
+    Args:
+        resolutions (list): (width, height) of the test images
+        formats (list): PIL format names
+        size (int): Side of the preprocessed square
+        dtype (str): Storage dtype for the normalize and process steps
+        repeat (int): Timed runs per case, the fastest is reported
+            (as timeit does: slower runs measure other load, not the code)
+        warmup (int): Untimed runs first, to fill caches
+        only (set, optional): Case names to run, all of them if None
+
+    Returns:
+        dict: {'meta': {...}, 'cases': {'JPEG-1920x1080': {step: ms}}}
+    """
+    cases = {}
+    with tempfile.TemporaryDirectory(prefix='benchmark-') as workspace:
+        for image_format in formats:
+            for width, height in resolutions:
+                name = case_name(image_format, width, height)
+                if only is not None and name not in only:
+                    continue
+                data = synthetic_image(width, height, image_format)
+                for _ in range(warmup):
+                    run_case(data, size, dtype, workspace)
+                runs = [run_case(data, size, dtype, workspace) for _ in range(repeat)]
+                cases[name] = {step: round(min(r[step] for r in runs), 3)
+                               for step in STEPS}
+                print(f'{name:<16}' + ' '.join(f'{step} {cases[name][step]:8.2f}' for step in STEPS))
+    meta = {
+        'size': size,
+        'dtype': dtype,
+        'repeat': repeat,
+        'python': platform.python_version(),
+        'pillow': PIL.__version__,
+        'numpy': np.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    return {'meta': meta, 'cases': cases}
+
+
+def compare(results, baseline, tolerance=0.5, min_ms=1.0):
+    """
+    Find steps that got slower than the baseline allows.
+
+    A step regresses when it takes more than baseline * (1 + tolerance)
+    and also more than baseline + min_ms, so steps that take a fraction
+    of a millisecond don't fail on timer noise.
+
+    Args:
+        results (dict): Output of run()
+        baseline (dict): An earlier output of run()
+        tolerance (float): Allowed slowdown, 0.5 is 50% slower
+        min_ms (float): Allowed slowdown in milliseconds regardless of tolerance
+
+    Returns:
+        list: (case, step, baseline ms, current ms) for each regression
+    """
+    regressions = []
+    for name, steps in results['cases'].items():
+        base_steps = baseline['cases'].get(name)
+        if base_steps is None:
+            continue
+        for step, current in steps.items():
+            base = base_steps.get(step)
+            if base is None:
+                continue
+            if current > base * (1 + tolerance) and current > base + min_ms:
+                regressions.append((name, step, base, current))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Time each image preprocessing step on synthetic images"
+    )
+    parser.add_argument(
+        '--baseline',
+        default='benchmark_baseline.json',
+        help='Default benchmark_baseline.json. Results to compare \
+            against. Skipped if the file does not exist'
+    )
+    parser.add_argument(
+        '--save-baseline',
+        action='store_true',
+        help='write these results to --baseline instead of \
+            comparing against it'
+    )
+    parser.add_argument(
+        '--output',
+        default=None,
+        help='also write these results as JSON to this file'
+    )
+    parser.add_argument(
+        '--tolerance',
+        default=0.5,
+        type=float,
+        help='Default 0.5. Allowed slowdown per step, 0.5 is \
+            50%% slower than the baseline'
+    )
+    parser.add_argument(
+        '--min-ms',
+        default=1.0,
+        type=float,
+        help='Default 1.0. Slowdowns under this many ms never \
+            count, so very fast steps do not fail on noise'
+    )
+    parser.add_argument(
+        '--size',
+        default=64,
+        type=int,
+        help='Default 64. Pixels on each side of the output'
+    )
+    parser.add_argument(
+        '--dtype',
+        default='float64',
+        choices=STORAGE_DTYPES,
+        help='Default float64. Storage dtype for normalize'
+    )
+    parser.add_argument(
+        '--repeat',
+        default=7,
+        type=int,
+        help='Default 7. Timed runs per case, the fastest is kept'
+    )
+    parser.add_argument(
+        '--quick',
+        action='store_true',
+        help='only the two smallest resolutions, for a fast check'
+    )
+    args = parser.parse_args()
+
+    resolutions = RESOLUTIONS[:2] if args.quick else RESOLUTIONS
+    results = run(resolutions, size=args.size, dtype=args.dtype, repeat=args.repeat)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(results, output_file, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, 'w') as baseline_file:
+            json.dump(results, baseline_file, indent=2)
+        print(f'Baseline saved to {args.baseline}')
+        return 0
+    if not os.path.exists(args.baseline):
+        print(f'No baseline at {args.baseline}, run with --save-baseline to make one')
+        return 0
+
+    with open(args.baseline) as baseline_file:
+        baseline = json.load(baseline_file)
+    if (baseline['meta'].get('size'), baseline['meta'].get('dtype')) != (args.size, args.dtype):
+        print(f"Baseline was taken with size {baseline['meta'].get('size')} and "
+              f"dtype {baseline['meta'].get('dtype')}, results may not compare")
+    regressions = compare(results, baseline, args.tolerance, args.min_ms)
+    if regressions:
+        # a burst of load from elsewhere looks like a regression, so time
+        # the slow cases again and only fail if they are still slow
+        again = {name for name, _, _, _ in regressions}
+        print(f'Timing {len(again)} slow cases again')
+        rerun = run(resolutions, size=args.size, dtype=args.dtype, repeat=args.repeat,
+                    only=again)
+        for name, steps in rerun['cases'].items():
+            for step, ms in steps.items():
+                results['cases'][name][step] = min(results['cases'][name][step], ms)
+        regressions = compare(results, baseline, args.tolerance, args.min_ms)
+    for name, step, base, current in regressions:
+        print(f'REGRESSION {name} {step}: {base:.2f} ms -> {current:.2f} ms '
+              f'({current / base:.1f}x)')
+    if regressions:
+        print(f'{len(regressions)} steps slower than the baseline allows')
+        return 1
+    print(f'All steps within {args.tolerance:.0%} of the baseline')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,185 @@
+##############################################
+# Columnar catalog of every member a run     #
+# stores: where it came from, where it went, #
+# its size, hash and dimensions. Exported to #
+# Parquet or CSV at the end of the run.      #
+##############################################
+
+import os
+import hashlib
+import threading
+from array import array
+
+COLUMNS = ['archive', 'member', 'name', 'key', 'size', 'sha256', 'width', 'height']
+
+
+class _StringColumn:
+    """
+    Strings packed end to end in one bytearray, with an offsets array:
+    about the UTF-8 length plus 8 bytes a row, instead of a str object
+    (49+ bytes) and a list slot per row.
+    """
+
+    def __init__(self):
+        self._data = bytearray()
+        self._offsets = array('Q', [0])
+
+    def append(self, value):
+        self._data += value.encode('utf-8', 'surrogateescape')
+        self._offsets.append(len(self._data))
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def __getitem__(self, row):
+        return self._data[self._offsets[row]:self._offsets[row + 1]].decode('utf-8', 'surrogateescape')
+
+    def __iter__(self):
+        return (self[row] for row in range(len(self)))
+
+    def nbytes(self):
+        return len(self._data) + self._offsets.itemsize * len(self._offsets)
+
+
+def file_digest(path, chunk_size=1024 * 1024):
+    """
+    Returns:
+        tuple: (size in bytes, raw SHA-256 digest) of a file
+    """
+    digest = hashlib.sha256()
+    size = 0
+    with open(path, 'rb') as member_file:
+        for block in iter(lambda: member_file.read(chunk_size), b''):
+            digest.update(block)
+            size += len(block)
+    return size, digest.digest()
+
+
+class MemberCatalog:
+    """
+    One row per stored member, kept as columns.
+
+    Archive keys repeat for every member, so they are stored once and each
+    row keeps a 4 byte code. Hashes are kept as 32 raw bytes. Rows can be
+    added from any number of upload threads while the run streams.
+    """
+
+    def __init__(self):
+        self._archives = []        # code -> archive key
+        self._archive_codes = {}   # archive key -> code
+        self.archive = array('I')
+        self.member = _StringColumn()
+        self.name = _StringColumn()
+        self.key = _StringColumn()
+        self.size = array('q')
+        self._sha256 = bytearray()
+        self.width = array('i')
+        self.height = array('i')
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.size)
+
+    def append(self, archive, member, name, key, size, sha256, width=-1, height=-1):
+        """
+        Add one row.
+
+        Args:
+            archive (str): Key of the archive the member came from
+            member (str): Path of the member inside the archive
+            name (str): The random name it was stored under
+            key (str): Object (or shard) key it was stored at, '' on a dry run
+            size (int): Bytes
+            sha256 (bytes): Raw 32 byte digest
+            width (int): Pixels, -1 if not known
+            height (int): Pixels, -1 if not known
+        """
+        with self._lock:
+            code = self._archive_codes.get(archive)
+            if code is None:
+                code = self._archive_codes[archive] = len(self._archives)
+                self._archives.append(archive)
+            self.archive.append(code)
+            self.member.append(member)
+            self.name.append(name)
+            self.key.append(key)
+            self.size.append(size)
+            self._sha256 += sha256
+            self.width.append(width)
+            self.height.append(height)
+
+    def add_file(self, archive, member, path, name, key, size=None, sha256=None):
+        """
+        Add a row for a file on disk, reading its size, hash and dimensions.
+
+        Args:
+            archive (str): Key of the archive the member came from
+            member (str): Path of the member inside the archive
+            path (str): The extracted file
+            name (str): The random name it was stored under
+            key (str): Where it was stored
+            size, sha256: From file_digest, if the file was already hashed
+        """
+        if sha256 is None:
+            size, sha256 = file_digest(path)
+        width, height = -1, -1
+        try:
+            from PIL import Image
+            # only the header is read to get the size
+            with Image.open(path) as image:
+                width, height = image.size
+        except Exception as e:
+            print(f'Could not read the dimensions of {path}: {e}')
+        self.append(archive, member, name, key, size, sha256, width, height)
+
+    def nbytes(self):
+        """ Approximate memory held by the rows. """
+        return (self.archive.itemsize * len(self.archive) + self.member.nbytes()
+                + self.name.nbytes() + self.key.nbytes() + self.size.itemsize * len(self.size)
+                + len(self._sha256) + 2 * self.width.itemsize * len(self.width))
+
+    def to_frame(self):
+        """
+        Returns:
+            pandas.DataFrame: One row per member, with the COLUMNS
+        """
+        import pandas as pd
+        with self._lock:
+            rows = len(self)
+            codes = list(self.archive)
+            frame = pd.DataFrame({
+                'archive': pd.Categorical.from_codes(codes, categories=list(self._archives))
+                if rows else pd.Categorical([]),
+                'member': [self.member[row] for row in range(rows)],
+                'name': [self.name[row] for row in range(rows)],
+                'key': [self.key[row] for row in range(rows)],
+                'size': pd.array(self.size.tolist(), dtype='int64'),
+                'sha256': [bytes(self._sha256[row * 32:(row + 1) * 32]).hex() for row in range(rows)],
+                'width': pd.array(self.width.tolist(), dtype='int32'),
+                'height': pd.array(self.height.tolist(), dtype='int32'),
+            })
+        return frame[COLUMNS]
+
+    def export(self, path):
+        """
+        Write the catalog to path, as Parquet if it ends in .parquet and
+        a Parquet engine (pyarrow or fastparquet) is installed, as CSV
+        otherwise.
+
+        Returns:
+            str: The path written, which ends in .csv if Parquet fell back
+        """
+        frame = self.to_frame()
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        if path.endswith('.parquet'):
+            try:
+                frame.to_parquet(path, index=False)
+                print(f'Catalog of {len(frame)} members written to {path}')
+                return path
+            except ImportError:
+                print('No Parquet engine (pyarrow or fastparquet) installed, writing CSV instead')
+                path = path[:-len('.parquet')] + '.csv'
+        frame.to_csv(path, index=False)
+        print(f'Catalog of {len(frame)} members written to {path}')
+        return path
@@ -0,0 +1,200 @@
+##############################################
+# Guards against oversized and bomb-like     #
+# archives. Extraction stops at the first    #
+# limit it goes over, before the volume      #
+# fills up.                                  #
+##############################################
+
+import zipfile
+import threading
+
+GiB = 1024 ** 3
+MiB = 1024 ** 2
+
+
+class ExtractionLimitExceeded(Exception):
+    """ An archive went over one of its ExtractionLimits. """
+
+
+class ExtractionLimits:
+    """
+    Bounds for one top-level archive and everything nested in it.
+
+    Declared sizes from the archive headers are checked before anything is
+    written, and the bytes actually written are counted as they go, so an
+    archive whose headers lie is still stopped part way.
+    """
+
+    def __init__(self, max_total_bytes=50 * GiB, max_ratio=100.0, max_members=1_000_000,
+                 max_depth=3, ratio_min_bytes=16 * MiB):
+        """
+        Args:
+            max_total_bytes (int): Most bytes an archive may unpack to,
+                nested archives included
+            max_ratio (float): Most uncompressed bytes per compressed byte
+            max_members (int): Most members in one archive
+            max_depth (int): Most levels of archives inside archives
+            ratio_min_bytes (int): Ratios are only checked once this much
+                has been unpacked, so small well-compressed files pass
+        """
+        self.max_total_bytes = max_total_bytes
+        self.max_ratio = max_ratio
+        self.max_members = max_members
+        self.max_depth = max_depth
+        self.ratio_min_bytes = ratio_min_bytes
+
+    def budget(self, name, compressed_size=None):
+        """ A fresh ExtractionBudget for a top-level archive. """
+        return ExtractionBudget(self, name, compressed_size)
+
+
+class ExtractionBudget:
+    """
+    Byte and member accounting for one archive. Nested archives get a
+    budget of their own for the ratio and member checks, and share the
+    total byte count with the archive they came from.
+    """
+
+    def __init__(self, limits, name, compressed_size=None, depth=0, parent=None):
+        """
+        Args:
+            limits (ExtractionLimits): The bounds
+            name (str): Archive key or path, for the error messages
+            compressed_size (int, optional): Archive size, needed for ratio checks
+            depth (int): 0 for a top-level archive
+            parent (ExtractionBudget, optional): Budget of the enclosing archive
+        """
+        self.limits = limits
+        self.name = name
+        self.compressed_size = compressed_size
+        self.depth = depth
+        self.root = parent.root if parent is not None else self
+        self.written = 0     # bytes written from this archive
+        self.total = 0       # on the root only: bytes written from the whole tree
+        self.members = 0
+        self._lock = parent._lock if parent is not None else threading.Lock()
+        if depth > limits.max_depth:
+            raise ExtractionLimitExceeded(
+                f'{name} is nested {depth} archives deep, the limit is {limits.max_depth}')
+
+    def nested(self, name, compressed_size=None):
+        """ Budget for an archive found inside this one. """
+        return ExtractionBudget(self.limits, name, compressed_size, self.depth + 1, self)
+
+    def _check_ratio(self, uncompressed, compressed, what):
+        if not compressed or uncompressed < self.limits.ratio_min_bytes:
+            return
+        if uncompressed / compressed > self.limits.max_ratio:
+            raise ExtractionLimitExceeded(
+                f'{what} expands {uncompressed / compressed:.0f}x, '
+                f'the limit is {self.limits.max_ratio:.0f}x')
+
+    def check_members(self, members):
+        """
+        Check the sizes an archive declares, before extracting it.
+
+        Args:
+            members (list): (name, uncompressed size, compressed size or None)
+                for each member to be extracted
+        """
+        if len(members) > self.limits.max_members:
+            raise ExtractionLimitExceeded(
+                f'{self.name} has {len(members)} members, the limit is {self.limits.max_members}')
+        declared = 0
+        for name, size, compressed in members:
+            self._check_ratio(size, compressed, f'{name} in {self.name}')
+            declared += size
+        with self._lock:
+            if self.root.total + declared > self.limits.max_total_bytes:
+                raise ExtractionLimitExceeded(
+                    f'{self.name} declares {declared} bytes, over the '
+                    f'{self.limits.max_total_bytes} byte limit')
+        self._check_ratio(declared, self.compressed_size, self.name)
+
+    def count_member(self, name):
+        """ Count a member found while streaming, where there is no list up front. """
+        with self._lock:
+            self.members += 1
+            if self.members > self.limits.max_members:
+                raise ExtractionLimitExceeded(
+                    f'{self.name} has more than {self.limits.max_members} members')
+
+    def add(self, nbytes):
+        """ Count bytes about to be written (or just written). """
+        with self._lock:
+            self.written += nbytes
+            self.root.total += nbytes
+            if self.root.total > self.limits.max_total_bytes:
+                raise ExtractionLimitExceeded(
+                    f'{self.root.name} unpacked more than {self.limits.max_total_bytes} bytes')
+            written = self.written
+        self._check_ratio(written, self.compressed_size, self.name)
+
+    def reader(self, fileobj):
+        """ Wrap a member stream so every byte read from it is counted. """
+        return _CountingReader(fileobj, self)
+
+
+class _CountingReader:
+    """ Read-only file wrapper reporting each read to a budget. """
+
+    def __init__(self, fileobj, budget):
+        self._fileobj = fileobj
+        self._budget = budget
+
+    def read(self, size=-1):
+        data = self._fileobj.read(size)
+        if data:
+            self._budget.add(len(data))
+        return data
+
+    def close(self):
+        self._fileobj.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def __getattr__(self, name):
+        return getattr(self._fileobj, name)
+
+
+def count_reads(archive, budget):
+    """
+    Count every byte read through archive.open() against budget.
+
+    For archive classes that, like zipfile, write each member by copying
+    from open() (rarfile.RarFile), but are only imported when needed and
+    so cannot be subclassed here.
+
+    Returns:
+        The archive, with open() wrapped
+    """
+    opener = archive.open
+
+    def counted_open(*args, **kwargs):
+        return budget.reader(opener(*args, **kwargs))
+
+    archive.open = counted_open
+    return archive
+
+
+class GuardedZipFile(zipfile.ZipFile):
+    """
+    ZipFile whose extract() and extractall() count the bytes they inflate.
+
+    ZipFile writes members by copying from self.open(), so counting there
+    covers every write while keeping zipfile's own path sanitising.
+    """
+
+    def __init__(self, file, mode='r', budget=None, **kwargs):
+        super().__init__(file, mode, **kwargs)
+        self.budget = budget
+
+    def open(self, name, mode='r', pwd=None, **kwargs):
+        member = super().open(name, mode, pwd, **kwargs)
+        if mode == 'r' and self.budget is not None:
+            return self.budget.reader(member)
+        return member
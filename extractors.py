@@ -3,8 +3,8 @@ import zipfile
 import tarfile
 import os
 import shutil
-import rarfile
-import py7zr
+from concurrent.futures import ThreadPoolExecutor
+from extraction_limits import ExtractionLimitExceeded, GuardedZipFile, count_reads
 
 # --- Abstract Base Class ---
 
@@ -15,6 +15,18 @@ class ArchiveExtractor(abc.ABC):
     Defines the interface for all archive extractors.
     """
 
+    def __init__(self, workers: int = 1, budget=None):
+        """
+        Args:
+            workers (int): Number of threads to use for formats that can be
+                           extracted in parallel. Defaults to 1 (serial).
+            budget (ExtractionBudget, optional): Size, ratio and member limits.
+                           Going over one raises ExtractionLimitExceeded and
+                           removes what was extracted. Defaults to None (no limits).
+        """
+        self.workers = max(1, workers or 1)
+        self.budget = budget
+
     @abc.abstractmethod
     def extract(self, archive_path: str, destination_path: str):
         """
@@ -34,6 +46,17 @@ class ArchiveExtractor(abc.ABC):
         """
         raise NotImplementedError("Subclasses must implement the 'extract' method.")
 
+    def _discard(self, destination_path: str, error):
+        """
+        Removes a partly extracted archive that went over its limits.
+
+        Args:
+            destination_path (str): The directory the archive was extracted to.
+            error (ExtractionLimitExceeded): The limit that was hit.
+        """
+        print(f"Error: {error}. Removing '{destination_path}'.")
+        shutil.rmtree(destination_path, ignore_errors=True)
+
     def _ensure_destination_path(self, destination_path: str):
         """
         Ensures the destination directory exists.
@@ -44,6 +67,19 @@ class ArchiveExtractor(abc.ABC):
         os.makedirs(destination_path, exist_ok=True)
         print(f"Ensured destination path: {destination_path}")
 
+    def _open_stream(self, archive_path: str):
+        """
+        Opens an independent read handle on the archive, so parallel
+        workers never share a file position.
+
+        Args:
+            archive_path (str): The path to the archive file.
+
+        Returns:
+            A new binary file object positioned at the start of the archive.
+        """
+        return open(archive_path, 'rb')
+
 # --- Concrete Implementations ---
 
 class ZipExtractor(ArchiveExtractor):
@@ -51,13 +87,15 @@ class ZipExtractor(ArchiveExtractor):
     Concrete implementation for extracting .zip files.
     """
 
-    def extract(self, archive_path: str, destination_path: str):
+    def extract(self, archive_path: str, destination_path: str, member_filter=None):
         """
         Extracts the contents of a .zip file.
 
         Args:
             archive_path (str): The path to the .zip file.
             destination_path (str): The directory where contents will be extracted.
+            member_filter (callable, optional): Called with each member name; only
+                members it returns True for are extracted. Defaults to None (all).
 
         Raises:
             FileNotFoundError: If the .zip file does not exist.
@@ -72,15 +110,87 @@ class ZipExtractor(ArchiveExtractor):
         self._ensure_destination_path(destination_path)
 
         try:
-            with zipfile.ZipFile(archive_path, 'r') as zip_ref:
-                print(f"Extracting '{archive_path}' to '{destination_path}'...")
-                zip_ref.extractall(destination_path)
+            with GuardedZipFile(archive_path, 'r', budget=self.budget) as zip_ref:
+                members = zip_ref.infolist()
+                if member_filter is not None:
+                    members = [m for m in members if member_filter(m.filename)]
+                if self.budget is not None:
+                    self.budget.check_members([(m.filename, m.file_size, m.compress_size) for m in members])
+                if self.workers > 1 and len(members) > 1:
+                    print(f"Extracting '{archive_path}' to '{destination_path}' "
+                          f"({len(members)} members on {self.workers} threads)...")
+                    self._extract_parallel(archive_path, members, destination_path)
+                else:
+                    print(f"Extracting '{archive_path}' to '{destination_path}'...")
+                    zip_ref.extractall(destination_path, members=members)
                 print("Zip extraction complete.")
+        except ExtractionLimitExceeded as e:
+            self._discard(destination_path, e)
+            raise
         except zipfile.BadZipFile as e:
             print(f"Error: The file '{archive_path}' is not a valid zip file or is corrupted. {e}")
+            raise
 
         except Exception as e:
             print(f"An unexpected error occurred during zip extraction: {e}")
+            raise
+
+    def _extract_parallel(self, archive_path, members, destination_path):
+        """
+        Inflates the members on several threads. zlib releases the GIL while
+        decompressing, so the threads genuinely run side by side.
+
+        Args:
+            archive_path (str): The path to the .zip file.
+            members (list): The zipfile.ZipInfo entries to extract.
+            destination_path (str): The directory where contents will be extracted.
+        """
+        bins = self._partition_members(members, self.workers)
+        with ThreadPoolExecutor(max_workers=len(bins)) as pool:
+            futures = [
+                pool.submit(self._extract_members, archive_path, chunk, destination_path)
+                for chunk in bins
+            ]
+            for future in futures:
+                future.result() # re-raise worker errors here
+
+    @staticmethod
+    def _partition_members(members, count):
+        """
+        Splits the members into at most 'count' groups of similar compressed
+        size, largest members first.
+
+        Args:
+            members (list): The zipfile.ZipInfo entries to split.
+            count (int): The number of groups wanted.
+
+        Returns:
+            list: Non-empty lists of zipfile.ZipInfo entries.
+        """
+        bins = [[] for _ in range(min(count, len(members)))]
+        loads = [0] * len(bins)
+        for member in sorted(members, key=lambda m: m.compress_size, reverse=True):
+            lightest = loads.index(min(loads))
+            bins[lightest].append(member)
+            loads[lightest] += member.compress_size
+        return [chunk for chunk in bins if chunk]
+
+    def _extract_members(self, archive_path, members, destination_path):
+        """
+        Extracts a group of members through a ZipFile handle of its own.
+
+        Args:
+            archive_path (str): The path to the .zip file.
+            members (list): The zipfile.ZipInfo entries to extract.
+            destination_path (str): The directory where contents will be extracted.
+        """
+        with self._open_stream(archive_path) as stream, GuardedZipFile(stream, 'r', budget=self.budget) as zip_ref:
+            for member in members:
+                try:
+                    zip_ref.extract(member, destination_path)
+                except FileExistsError:
+                    # another thread created the same parent directory first
+                    zip_ref.extract(member, destination_path)
 
 
 class TarExtractor(ArchiveExtractor):
@@ -88,6 +198,22 @@ class TarExtractor(ArchiveExtractor):
     Concrete implementation for extracting .tar, .tar.gz, .tar.bz2, etc. files.
     """
 
+    def _guarded(self, tar_ref):
+        """
+        Yields the members one at a time, counting each against the budget
+        before it is written. A tar member's size in its header is exactly
+        what gets written, so the check is made ahead of the bytes.
+
+        Args:
+            tar_ref (tarfile.TarFile): The archive being read.
+        """
+        for member in tar_ref:
+            if self.budget is not None:
+                self.budget.count_member(member.name)
+                if member.isfile():
+                    self.budget.add(member.size)
+            yield member
+
     def extract(self, archive_path: str, destination_path: str):
         """
         Extracts the contents of a .tar (or compressed tar) file.
@@ -112,13 +238,18 @@ class TarExtractor(ArchiveExtractor):
             # tarfile automatically detects compression type (gz, bz2, xz)
             with tarfile.open(archive_path, 'r:*') as tar_ref:
                 print(f"Extracting '{archive_path}' to '{destination_path}'...")
-                tar_ref.extractall(destination_path)
+                tar_ref.extractall(destination_path, members=self._guarded(tar_ref))
                 print("Tar extraction complete.")
+        except ExtractionLimitExceeded as e:
+            self._discard(destination_path, e)
+            raise
         except tarfile.ReadError as e:
             print(f"Error: The file '{archive_path}' is not a valid tar file or is corrupted. {e}")
+            raise
 
         except Exception as e:
             print(f"An unexpected error occurred during tar extraction: {e}")
+            raise
 
 
 class SevenZExtractor(ArchiveExtractor):
@@ -142,6 +273,7 @@ class SevenZExtractor(ArchiveExtractor):
             py7zr.IncorrectPassword: If the provided password is incorrect.
             Exception: For other unexpected errors during extraction.
         """
+        import py7zr  # only loaded once a .7z archive turns up
         if not os.path.exists(archive_path):
             raise FileNotFoundError(f"7z archive not found: {archive_path}")
         if os.path.isdir(archive_path):
@@ -151,20 +283,37 @@ class SevenZExtractor(ArchiveExtractor):
 
         try:
             with py7zr.SevenZipFile(archive_path, mode='r', password=password) as szf:
+                if self.budget is not None:
+                    # py7zr writes each member up to its size in the header and
+                    # no further, so checking the declared sizes bounds what is
+                    # written. Its progress callback runs on a thread of its own
+                    # and cannot stop the extraction, so nothing is counted live
+                    declared = [(f.filename, f.uncompressed or 0, None) for f in szf.files]
+                    self.budget.check_members(declared)
+                    self.budget.add(sum(size for _, size, _ in declared))
+                # given a path, py7zr already decodes independent blocks on
+                # threads of its own, so there is nothing to gain splitting here
                 print(f"Extracting '{archive_path}' to '{destination_path}'...")
                 szf.extractall(path=destination_path)
-                print("7z extraction complete.")
+            print("7z extraction complete.")
+        except ExtractionLimitExceeded as e:
+            self._discard(destination_path, e)
+            raise
         except py7zr.Bad7zFile as e:
             print(f"Error: The file '{archive_path}' is not a valid 7z file or is corrupted. {e}")
+            raise
 
         except py7zr.PasswordRequired as e:
             print(f"Error: The 7z archive '{archive_path}' is password-protected but no password was provided. {e}")
+            raise
 
         except py7zr.IncorrectPassword as e:
             print(f"Error: Incorrect password provided for '{archive_path}'. {e}")
+            raise
 
         except Exception as e:
             print(f"An unexpected error occurred during 7z extraction: {e}")
+            raise
 
 
 
@@ -189,6 +338,7 @@ class RarExtractor(ArchiveExtractor):
             rarfile.RarCannotExec: If the 'unrar' command-line tool is not found in the system's PATH.
             Exception: For other unexpected errors during extraction.
         """
+        import rarfile  # only loaded once a .rar archive turns up
         if not os.path.exists(archive_path):
             raise FileNotFoundError(f"RAR archive not found: {archive_path}")
         if os.path.isdir(archive_path):
@@ -200,32 +350,46 @@ class RarExtractor(ArchiveExtractor):
             with rarfile.RarFile(archive_path, 'r') as rf:
                 if password:
                     rf.setpassword(password) # Set password if provided
+                if self.budget is not None:
+                    declared = [(m.filename, m.file_size, m.compress_size) for m in rf.infolist()]
+                    self.budget.check_members(declared)
+                    # headers can understate sizes; count what is really read
+                    count_reads(rf, self.budget)
                 print(f"Extracting '{archive_path}' to '{destination_path}'...")
                 rf.extractall(destination_path)
                 print("RAR extraction complete.")
+        except ExtractionLimitExceeded as e:
+            self._discard(destination_path, e)
+            raise
         except rarfile.BadRarFile as e:
             print(f"Error: The file '{archive_path}' is not a valid RAR file or is corrupted. {e}")
+            raise
 
         except rarfile.RarKeyError as e:
             print(f"Error: Incorrect or missing password for '{archive_path}'. {e}")
+            raise
 
         except rarfile.RarCannotExec as e:
             print(f"Error: The 'unrar' command-line tool was not found. Please ensure it is installed and in your system's PATH. {e}")
+            raise
 
         except Exception as e:
             print(f"An unexpected error occurred during RAR extraction: {e}")
+            raise
 
 
 # --- Factory Function (Optional, for easy instantiation) ---
 
 # --- Factory Function (Optional, for easy instantiation) ---
 
-def get_extractor(file_path_or_name: str) -> ArchiveExtractor:
+def get_extractor(file_path_or_name: str, workers: int = 1, budget=None) -> ArchiveExtractor:
     """
     Factory function to get the appropriate extractor based on file extension.
 
     Args:
         file_path_or_name (str): The full file path or file name (e.g., "archive.zip", "/path/to/my/archive.tar.gz").
+        workers (int): Number of threads the extractor may use. Defaults to 1.
+        budget (ExtractionBudget, optional): Limits for this archive. Defaults to None.
 
     Returns:
         ArchiveExtractor: An instance of the concrete extractor class.
@@ -282,7 +446,7 @@ def get_extractor(file_path_or_name: str) -> ArchiveExtractor:
 
 
     if extractor_class:
-        return extractor_class()
+        return extractor_class(workers=workers, budget=budget)
     else:
         raise ValueError(f"No extractor found for file type: {file_path_or_name} (derived extension: {normalized_ext})")
 
@@ -6,9 +6,16 @@ import os
 import io
 import re
 import hashlib
+import argparse
 from PIL import Image
 import numpy as np
 import uuid
+from profiling import make_profiler, finish
+from pipeline import Pipeline, Stage, Job, profile_hook
+from near_duplicates import NearDuplicateFilter
+from vector_cache import VectorCache
+from array_store import ShardedArrayStore
+from vector_loader import STORAGE_DTYPES, to_storage
 
 def list_directory_contents(directory_path):
     """
@@ -90,29 +97,117 @@ def desaturate_image(image_path):
     
     return new_path
 
-def find_all_files(directory_path):
-    """ Finds all the files in directroy via stack """
-    folder_stack = [directory_path]
+def find_all_files(directory_path, target_pixels_on_side=100, grayscale=False, profiler=None,
+                   near_duplicates=None, cache=None, sizes=None, stores=None,
+                   dtype='float64', workers=1):
+    """ Finds all the files in directroy via stack
+    and preprocesses each one.
+    workers: threads preprocessing images, the walk
+      runs ahead of them on its own thread.
+    sizes, stores: optional list of sizes and a dict of
+      size -> ShardedArrayStore. Each image is then decoded
+      once and saved at every size (target_pixels_on_side
+      is not used).
+    profiler: optional profiling.StageProfiler for
+      the traverse and preprocess stages.
+    near_duplicates: optional NearDuplicateFilter,
+      near-duplicate images are skipped.
+    cache: optional VectorCache, images processed
+      before with the same settings are not redone.
+    dtype: storage dtype of the vectors, see
+      vector_loader.STORAGE_DTYPES.
+    """
     all_files = []
     folders = 0
 
-    while folder_stack:
-        current_folder = folder_stack.pop()
-        contents = list_directory_contents(current_folder)
+    def walk():
+        nonlocal folders
+        job = Job(directory_path)
+        folder_stack = [directory_path]
+        while folder_stack:
+            current_folder = folder_stack.pop()
+            contents = list_directory_contents(current_folder)
+
+            for item in contents:
+                if item[1]:
+                    folder_stack.append(item[0])
+                    folders += 1
+                else:
+                    all_files.append(item[0])
+                    yield job, item[0]
+
+    def preprocess(job, path, emit):
+        if sizes:
+            process_image_file_multi_resolution(path, sizes, stores, grayscale,
+                                                cache=cache, near_duplicates=near_duplicates,
+                                                dtype=dtype)
+        else:
+            process_image_file(path, target_pixels_on_side, grayscale,
+                               cache=cache, near_duplicates=near_duplicates,
+                               dtype=dtype)
 
-        for item in contents:
-            if item[1]:
-                folder_stack.append(item[0])
-                folders += 1
-            else:
-                all_files.append(item[0])
-                image_object = Image.open(item[0])
-                process_image_to_numpy_array(image_object, 100, )
+    hooks = [profile_hook(profiler)] if profiler is not None else []
+    Pipeline(walk(), [Stage('preprocess', preprocess, workers=workers)],
+             hooks=hooks, source_name='traverse').run()
 
     msg = f'Found {len(all_files)} files in {folders} folders'
     return msg, all_files
 
 
+def resize_to_fit(image_file_object, target_pixels_on_side):
+    """
+    Resizes an RGB copy of an image so its larger side is
+    'target_pixels_on_side', keeping its aspect ratio.
+
+    Args:
+        image_file_object: A PIL.Image.Image object (already opened).
+        target_pixels_on_side (int): Length of the larger side afterwards.
+
+    Returns:
+        PIL.Image.Image: The resized RGB image.
+    """
+    original_width, original_height = image_file_object.size
+
+    # Determine the scaling factor
+    # We scale based on the LARGER dimension to ensure the whole image fits
+    if original_width > original_height:
+        scale_factor = target_pixels_on_side / original_width
+    else:
+        scale_factor = target_pixels_on_side / original_height
+
+    new_width = int(original_width * scale_factor)
+    new_height = int(original_height * scale_factor)
+
+    # Resize the image while maintaining aspect ratio
+    # Ensure the resized image is in RGB mode for consistent color padding
+    # Using LANCZOS for high-quality downsampling
+    return image_file_object.convert("RGB").resize((new_width, new_height), Image.Resampling.LANCZOS)
+
+def pad_to_square(resized_img, target_pixels_on_side, background_color=(0, 0, 0)):
+    """
+    Centres an image on a square RGB background.
+
+    Args:
+        resized_img: A PIL.Image.Image no larger than the square.
+        target_pixels_on_side (int): Side of the square.
+        background_color (tuple): The RGB tuple (0-255) for the padding color.
+
+    Returns:
+        PIL.Image.Image: The padded square image.
+    """
+    # Create a new square image with the background color in RGB mode
+    padded_img = Image.new('RGB', (target_pixels_on_side, target_pixels_on_side), background_color)
+
+    # Calculate paste position to center the resized image
+    new_width, new_height = resized_img.size
+    paste_x = (target_pixels_on_side - new_width) // 2
+    paste_y = (target_pixels_on_side - new_height) // 2
+
+    # Paste the resized image onto the new background
+    padded_img.paste(resized_img, (paste_x, paste_y))
+
+    return padded_img
+
 def resize_and_pad_image(image_file_object, target_pixels_on_side, background_color=(0, 0, 0)):
     """
     Resizes an image to fit within a square of 'target_pixels_on_side'
@@ -135,40 +230,15 @@ def resize_and_pad_image(image_file_object, target_pixels_on_side, background_co
             print("Error: Input is not a PIL.Image.Image object. (resize)")
             return None
 
-        original_width, original_height = image_file_object.size
-
-        # Determine the scaling factor
-        # We scale based on the LARGER dimension to ensure the whole image fits
-        if original_width > original_height:
-            scale_factor = target_pixels_on_side / original_width
-        else:
-            scale_factor = target_pixels_on_side / original_height
-
-        new_width = int(original_width * scale_factor)
-        new_height = int(original_height * scale_factor)
-
-        # Resize the image while maintaining aspect ratio
-        # Ensure the resized image is in RGB mode for consistent color padding
-        resized_img = image_file_object.convert("RGB").resize((new_width, new_height), Image.Resampling.LANCZOS)
-        # Using LANCZOS for high-quality downsampling
-
-        # Create a new square image with the background color in RGB mode
-        padded_img = Image.new('RGB', (target_pixels_on_side, target_pixels_on_side), background_color)
-
-        # Calculate paste position to center the resized image
-        paste_x = (target_pixels_on_side - new_width) // 2
-        paste_y = (target_pixels_on_side - new_height) // 2
-
-        # Paste the resized image onto the new background
-        padded_img.paste(resized_img, (paste_x, paste_y))
-
-        return padded_img
+        resized_img = resize_to_fit(image_file_object, target_pixels_on_side)
+        return pad_to_square(resized_img, target_pixels_on_side, background_color)
 
     except Exception as e:
         print(f"An error occurred during resizing and padding: {e}")
         return None
 
-def process_image_to_numpy_array(image_file_object, target_pixels_on_side=64, grayscale=False):
+def process_image_to_numpy_array(image_file_object, target_pixels_on_side=64, grayscale=False,
+                                 near_duplicates=None, dtype='float64'):
     """
     Takes an image file object and converts it into a preprocessed NumPy array.
     This version uses the separate `resize_and_pad_image` function and
@@ -181,11 +251,18 @@ def process_image_to_numpy_array(image_file_object, target_pixels_on_side=64, gr
                                      Defaults to 64.
         grayscale (bool): If True, converts the image to grayscale AFTER padding.
                           If False (default), keeps the original color channels.
+        near_duplicates (NearDuplicateFilter, optional): If given, images within
+                          its distance of an image already processed are skipped.
+        dtype (str): Storage dtype. 'float64' (default), 'float32' and 'float16'
+                     are scaled to [0, 1]; 'uint8' keeps the raw pixels and is
+                     scaled when read back with vector_loader.
 
     Returns:
         numpy.ndarray: A flattened (1D) NumPy array of the preprocessed image.
-                       Pixel values will be scaled to the range [0, 1].
-                       Returns None if there's an error processing the image.
+                       Pixel values will be scaled to the range [0, 1]
+                       unless dtype is 'uint8'.
+                       Returns None if there's an error processing the image,
+                       or if it is a near duplicate.
     """
     try:
         # Step 1: Resize and pad the image.
@@ -194,6 +271,11 @@ def process_image_to_numpy_array(image_file_object, target_pixels_on_side=64, gr
         if padded_img is None:
             return None # Propagate error from padding function
 
+        # The hash is taken from the padded image we already have
+        if near_duplicates is not None and near_duplicates.is_duplicate_image(padded_img):
+            print("Skipping near-duplicate image.")
+            return None
+
         # Step 2: Convert to grayscale if specified
         if grayscale:
             padded_img = padded_img.convert('L') # 'L' mode for grayscale
@@ -203,8 +285,8 @@ def process_image_to_numpy_array(image_file_object, target_pixels_on_side=64, gr
         # Step 3: Convert PIL Image to NumPy array
         img_array = np.array(padded_img)
 
-        # Step 4: Rescale pixel values to 0-1
-        img_array = img_array / 255.0
+        # Step 4: Rescale pixel values to 0-1 (uint8 is scaled when read)
+        img_array = to_storage(img_array, dtype)
 
         # Step 5: Flatten the array
         flattened_img = img_array.flatten()
@@ -215,6 +297,168 @@ def process_image_to_numpy_array(image_file_object, target_pixels_on_side=64, gr
         print(f"An error occurred during image processing: {e}")
         return None
 
+def is_cached_duplicate(vector, side, near_duplicates):
+    """
+    Checks a cached vector against the near-duplicate filter, so a cache
+    hit is filtered the same way as a fresh decode.
+
+    Args:
+        vector (numpy.ndarray): Flattened vector of a padded image.
+        side (int): Side of the padded image.
+        near_duplicates (NearDuplicateFilter, optional): The filter, or None.
+
+    Returns:
+        bool: True if it is a near duplicate.
+    """
+    if near_duplicates is None:
+        return False
+    # rebuild the padded grayscale image from the vector to hash it
+    gray = vector.reshape(side, side, -1).astype(np.float64)
+    if vector.dtype != np.uint8:
+        gray *= 255.0
+    if gray.shape[2] == 3:
+        gray = gray @ np.array([0.299, 0.587, 0.114])
+    else:
+        gray = gray[:, :, 0]
+    return near_duplicates.filter_batch(gray[None, :, :])[0]
+
+def process_image_file(image_path, target_pixels_on_side=64, grayscale=False,
+                       cache=None, near_duplicates=None, dtype='float64'):
+    """
+    Preprocesses an image file, reusing the vector from an earlier run
+    when the same file content was processed with the same settings.
+
+    Args:
+        image_path (str): Path to the image file.
+        target_pixels_on_side (int): Side of the square output image.
+        grayscale (bool): If True, converts the image to grayscale after padding.
+        cache (VectorCache, optional): Cache of preprocessed vectors.
+        near_duplicates (NearDuplicateFilter, optional): Skips near duplicates.
+        dtype (str): Storage dtype, see process_image_to_numpy_array.
+
+    Returns:
+        numpy.ndarray: The flattened vector, or None if the image
+                       could not be processed or is a near duplicate.
+    """
+    if cache is None:
+        image_object = Image.open(image_path)
+        return process_image_to_numpy_array(image_object, target_pixels_on_side, grayscale,
+                                            near_duplicates=near_duplicates, dtype=dtype)
+
+    with open(image_path, 'rb') as image_file:
+        data = image_file.read()
+    key = cache.make_key(cache.content_hash(data), target_pixels_on_side, grayscale, dtype)
+    vector = cache.get(key)
+    if vector is not None:
+        if is_cached_duplicate(vector, target_pixels_on_side, near_duplicates):
+            print("Skipping near-duplicate image.")
+            return None
+        return vector
+
+    image_object = Image.open(io.BytesIO(data))
+    vector = process_image_to_numpy_array(image_object, target_pixels_on_side, grayscale,
+                                          near_duplicates=near_duplicates, dtype=dtype)
+    if vector is not None:
+        cache.put(key, vector)
+    return vector
+
+def process_image_multi_resolution(image_file_object, sizes, grayscale=False,
+                                   near_duplicates=None, fast_decode=False, dtype='float64'):
+    """
+    Produces vectors at several resolutions from a single decode.
+
+    The largest size is made with `resize_and_pad_image`; every smaller
+    size is resampled from the padded image of the next larger size, so
+    the full-resolution image is decoded and resampled once.
+
+    Args:
+        image_file_object: A PIL.Image.Image object (already opened).
+        sizes (list): Target side lengths, e.g. [64, 128, 224].
+        grayscale (bool): If True, converts each image to grayscale after padding.
+        near_duplicates (NearDuplicateFilter, optional): Skips near duplicates,
+                          hashed from the largest padded image.
+        fast_decode (bool): Let JPEG decode straight to a reduced scale that is
+                          still at least the largest size (PIL draft mode).
+        dtype (str): Storage dtype, see process_image_to_numpy_array.
+
+    Returns:
+        dict: Maps each size to its flattened vector.
+              Returns None if there's an error or the image is a near duplicate.
+    """
+    try:
+        sizes = sorted(set(sizes), reverse=True)
+        if fast_decode:
+            image_file_object.draft('RGB', (sizes[0], sizes[0]))
+
+        padded_img = resize_and_pad_image(image_file_object, sizes[0])
+        if padded_img is None:
+            return None
+        if near_duplicates is not None and near_duplicates.is_duplicate_image(padded_img):
+            print("Skipping near-duplicate image.")
+            return None
+
+        vectors = {}
+        for size in sizes:
+            if padded_img.size[0] != size:
+                padded_img = padded_img.resize((size, size), Image.Resampling.LANCZOS)
+            level = padded_img.convert('L') if grayscale else padded_img
+            vectors[size] = to_storage(np.array(level), dtype).flatten()
+        return vectors
+
+    except Exception as e:
+        print(f"An error occurred during multi-resolution processing: {e}")
+        return None
+
+def process_image_file_multi_resolution(image_path, sizes, stores, grayscale=False,
+                                        cache=None, near_duplicates=None, fast_decode=False,
+                                        dtype='float64'):
+    """
+    Preprocesses an image file at several resolutions and appends each
+    vector to the store for its resolution, keyed by the file's SHA-256.
+
+    Args:
+        image_path (str): Path to the image file.
+        sizes (list): Target side lengths.
+        stores (dict): Maps each size to a ShardedArrayStore.
+        grayscale (bool): If True, converts each image to grayscale after padding.
+        cache (VectorCache, optional): Skip the decode if every size is cached.
+        near_duplicates (NearDuplicateFilter, optional): Skips near duplicates.
+        fast_decode (bool): Use PIL draft mode for JPEG decoding.
+        dtype (str): Storage dtype, see process_image_to_numpy_array.
+
+    Returns:
+        dict: Maps each size to its vector, or None if the image was skipped.
+    """
+    with open(image_path, 'rb') as image_file:
+        data = image_file.read()
+    content_hash = VectorCache.content_hash(data)
+    keys = {size: VectorCache.make_key(content_hash, size, grayscale, dtype) for size in sizes}
+
+    vectors = None
+    if cache is not None:
+        cached = {size: cache.get(key) for size, key in keys.items()}
+        if all(vector is not None for vector in cached.values()):
+            # hashed from the largest size, as a fresh decode is
+            largest = max(cached)
+            if is_cached_duplicate(cached[largest], largest, near_duplicates):
+                print("Skipping near-duplicate image.")
+                return None
+            vectors = cached
+    if vectors is None:
+        vectors = process_image_multi_resolution(Image.open(io.BytesIO(data)), sizes, grayscale,
+                                                 near_duplicates=near_duplicates,
+                                                 fast_decode=fast_decode, dtype=dtype)
+        if vectors is None:
+            return None
+        if cache is not None:
+            for size, vector in vectors.items():
+                cache.put(keys[size], vector)
+
+    for size, vector in vectors.items():
+        if content_hash not in stores[size]:
+            stores[size].put(content_hash, vector)
+    return vectors
+
 def save_image(image_object, file_path):
     """
     Saves a PIL.Image.Image object to a specified file path.
@@ -286,7 +530,123 @@ def save_numpy_array(numpy_array, output_directory):
         print(f"An error occurred while saving NumPy array: {e}")
         return None
 
-output = find_all_files('test-image')
-print(output[0])
-print(output[1])
+def main():
+    parser = argparse.ArgumentParser(
+        description="Preprocess every image under a directory"
+    )
+    parser.add_argument(
+        'directory',
+        nargs='?',
+        default='test-image',
+        help='Default test-image. Folder of images to preprocess'
+    )
+    parser.add_argument(
+        '--size',
+        default=100,
+        type=int,
+        help='Default 100. Pixels on each side of the output'
+    )
+    parser.add_argument(
+        '--grayscale',
+        action='store_true',
+        help='convert images to grayscale after padding'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='record per-stage cProfile data and stack samples'
+    )
+    parser.add_argument(
+        '--profile-rate',
+        default=1.0,
+        type=float,
+        help='Default 1.0. Fraction of --profile runs that profile'
+    )
+    parser.add_argument(
+        '--profile-output',
+        default='profiles/preprocess',
+        help='Default profiles/preprocess. Prefix for output files'
+    )
+    parser.add_argument(
+        '--near-duplicates',
+        default=None,
+        type=int,
+        metavar='DISTANCE',
+        help='skip images within this Hamming distance of \
+            an image already processed (64 bit dHash)'
+    )
+    parser.add_argument(
+        '--cache',
+        default=None,
+        metavar='DIR',
+        help='reuse vectors computed by earlier runs, \
+            stored in this folder'
+    )
+    parser.add_argument(
+        '--cache-max-gb',
+        default=10.0,
+        type=float,
+        help='Default 10. Size limit of the --cache folder, \
+            least recently used vectors are evicted'
+    )
+    parser.add_argument(
+        '--sizes',
+        default=None,
+        type=int,
+        nargs='+',
+        help='produce several sizes from one decode, e.g. \
+            --sizes 64 128 224. Overrides --size'
+    )
+    parser.add_argument(
+        '--output',
+        default='vectors',
+        help='Default vectors. With --sizes, shards for each \
+            size go to <output>/<size>px'
+    )
+    parser.add_argument(
+        '--dtype',
+        default='float64',
+        choices=STORAGE_DTYPES,
+        help='Default float64. uint8 keeps raw pixels (8x smaller) \
+            and is scaled to [0, 1] float32 by vector_loader'
+    )
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help='Default 1. Images preprocessed at once'
+    )
+    args = parser.parse_args()
+
+    stores = None
+    if args.sizes:
+        stores = {size: ShardedArrayStore(os.path.join(args.output, f'{size}px')) for size in args.sizes}
+
+    cache = None
+    if args.cache:
+        cache = VectorCache(args.cache, max_bytes=int(args.cache_max_gb * 1024 ** 3))
+
+    near_duplicates = None
+    if args.near_duplicates is not None:
+        near_duplicates = NearDuplicateFilter(max_distance=args.near_duplicates)
+
+    profiler = make_profiler(args.profile, rate=args.profile_rate)
+    try:
+        output = find_all_files(args.directory, args.size, args.grayscale, profiler=profiler,
+                                near_duplicates=near_duplicates, cache=cache,
+                                sizes=args.sizes, stores=stores, dtype=args.dtype,
+                                workers=args.workers)
+    finally:
+        finish(profiler, args.profile_output)
+        if cache is not None:
+            cache.close()
+        for store in (stores or {}).values():
+            store.close()
+    print(output[0])
+    print(output[1])
+    if near_duplicates is not None:
+        print(f'Skipped {near_duplicates.dropped} near-duplicate images')
+
+if __name__ == '__main__':
+    main()
 
@@ -0,0 +1,80 @@
+##############################################
+# Spreads uploaded images over hashed        #
+# sub-prefixes, upload/3f/Ab3dE9x.jpg, so    #
+# S3 can serve each prefix at its own rate.  #
+##############################################
+
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+class KeyLayout:
+    """
+    Maps an image name to its key.
+
+    S3 scales request rates per prefix (about 3,500 PUT and 5,500 GET per
+    second each), so with partitions set every name is placed under one of
+    that many hex sub-prefixes. The sub-prefix comes from a hash of the
+    name alone, so anyone holding a name can find its key without a lookup.
+    """
+
+    def __init__(self, root='upload/', partitions=0):
+        """
+        Args:
+            root (str): Prefix every key goes under
+            partitions (int): Number of hashed sub-prefixes; 0 keeps the
+                flat upload/<name> layout
+        """
+        if partitions < 0:
+            raise ValueError(f"partitions must be 0 or more, not {partitions}")
+        self.root = root
+        self.partitions = partitions
+        # hex digits needed to write the largest partition number
+        self.width = len(f'{partitions - 1:x}') if partitions > 1 else 1
+
+    def partition(self, name):
+        """ Partition number of a name, or None for the flat layout. """
+        if not self.partitions:
+            return None
+        digest = hashlib.blake2b(name.encode(), digest_size=8).digest()
+        return int.from_bytes(digest, 'big') % self.partitions
+
+    def prefix(self, partition):
+        return f'{self.root}{partition:0{self.width}x}/'
+
+    def key(self, name):
+        """
+        Args:
+            name (str): Image name, e.g. 'Ab3dE9x.jpg'
+
+        Returns:
+            str: Its key, e.g. 'upload/3f/Ab3dE9x.jpg'
+        """
+        partition = self.partition(name)
+        if partition is None:
+            return f'{self.root}{name}'
+        return f'{self.prefix(partition)}{name}'
+
+    def prefixes(self):
+        """ Every prefix images may be under. """
+        if not self.partitions:
+            return [self.root]
+        return [self.prefix(partition) for partition in range(self.partitions)]
+
+
+def list_parallel(access, layout, workers=16):
+    """
+    List every object under a layout, one listing per prefix, several at once.
+
+    Args:
+        access (S3Access or LocalAccess): Where the objects are
+        layout (KeyLayout): The layout they were stored with
+        workers (int): Listings run at the same time
+
+    Returns:
+        list: Dicts with the Key, ETag, LastModified and Size of each object
+    """
+    prefixes = layout.prefixes()
+    with ThreadPoolExecutor(max_workers=max(1, min(workers, len(prefixes)))) as pool:
+        listings = pool.map(lambda prefix: access.list_objects(prefix=prefix), prefixes)
+        return [obj for listing in listings for obj in listing]
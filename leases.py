@@ -0,0 +1,278 @@
+##############################################
+# Splits archives between several nodes.     #
+# A node leases an archive before working on #
+# it and renews the lease while it works; a  #
+# crashed node's leases expire and are taken #
+# over by the others.                        #
+##############################################
+
+import os
+import json
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+PENDING = 'pending'
+DONE = 'done'
+
+
+class Lease:
+    """ One archive held by this node. """
+
+    def __init__(self, key, owner, expires, version=None):
+        self.key = key
+        self.owner = owner
+        self.expires = expires
+        self.version = version  # ETag (S3) or row version (SQLite) of our last write
+        self.done = False       # set by the caller once the archive is finished
+        self.lost = False       # a renewal failed, another node may have it now
+        self.finished = False   # handed back, no more renewals
+        # one write at a time, so a renewal never moves the version
+        # a completion or release is conditional on
+        self.lock = threading.Lock()
+
+
+class S3LeaseBackend:
+    """
+    Leases stored as small JSON objects next to the archives.
+
+    Every change is a conditional write: a new lease is created with
+    If-None-Match: *, and renewals, takeovers and completion use If-Match
+    on the ETag last seen, so at most one node wins each race. Expiry is
+    compared against each node's wall clock, which NTP keeps close enough
+    on EC2 for leases of a few minutes.
+    """
+
+    def __init__(self, s3access, prefix='_leases/'):
+        """
+        Args:
+            s3access (S3Access): Bucket holding the lease objects
+            prefix (str): Key prefix for the lease objects, one per archive
+        """
+        self.s3access = s3access
+        self.prefix = prefix
+
+    def _lease_key(self, key):
+        return self.prefix + key
+
+    @staticmethod
+    def _body(owner, expires, state):
+        return json.dumps({'owner': owner, 'expires': expires, 'state': state}).encode()
+
+    def acquire(self, key, owner, ttl):
+        """
+        Returns:
+            Lease: The new lease, or None if another node holds the key
+                or it is already done
+        """
+        expires = time.time() + ttl
+        body = self._body(owner, expires, PENDING)
+        lease_key = self._lease_key(key)
+        etag = self.s3access.put_object_conditional(lease_key, body, if_none_match='*')
+        if etag:
+            return Lease(key, owner, expires, etag)
+        if etag is None:
+            return None
+
+        data, current = self.s3access.get_object_with_etag(lease_key)
+        if data is None:
+            return None
+        try:
+            held = json.loads(data)
+        except ValueError:
+            held = {}
+        if held.get('state') == DONE or held.get('expires', 0) > time.time():
+            return None
+        # expired, take it over unless someone else just did
+        etag = self.s3access.put_object_conditional(lease_key, body, if_match=current)
+        if not etag:
+            return None
+        print(f"Took over expired lease on {key} from {held.get('owner')}")
+        return Lease(key, owner, expires, etag)
+
+    def _update(self, lease, expires, state):
+        etag = self.s3access.put_object_conditional(
+            self._lease_key(lease.key), self._body(lease.owner, expires, state),
+            if_match=lease.version)
+        if not etag:
+            return False
+        lease.version = etag
+        lease.expires = expires
+        return True
+
+    def renew(self, lease, ttl):
+        return self._update(lease, time.time() + ttl, PENDING)
+
+    def complete(self, lease):
+        return self._update(lease, lease.expires, DONE)
+
+    def release(self, lease):
+        # expire it now so the next node to look takes it
+        return self._update(lease, 0, PENDING)
+
+
+class SQLiteLeaseBackend:
+    """
+    Leases in a local SQLite file, for several processes on one machine
+    or for trying the coordination out without a bucket.
+    """
+
+    def __init__(self, path='leases.sqlite'):
+        """
+        Args:
+            path (str): Database file, shared by every process taking part
+        """
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, isolation_level=None, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._db.execute(
+            'CREATE TABLE IF NOT EXISTS leases ('
+            ' key TEXT PRIMARY KEY, owner TEXT, expires REAL, state TEXT, version INTEGER)')
+
+    @contextmanager
+    def _transaction(self):
+        # IMMEDIATE takes the write lock up front, so check-then-write is atomic
+        with self._lock:
+            self._db.execute('BEGIN IMMEDIATE')
+            try:
+                yield self._db
+            except BaseException:
+                self._db.execute('ROLLBACK')
+                raise
+            self._db.execute('COMMIT')
+
+    def acquire(self, key, owner, ttl):
+        expires = time.time() + ttl
+        with self._transaction() as db:
+            row = db.execute('SELECT owner, expires, state, version FROM leases WHERE key = ?',
+                             (key,)).fetchone()
+            if row is None:
+                version = 1
+                db.execute('INSERT INTO leases VALUES (?, ?, ?, ?, ?)',
+                           (key, owner, expires, PENDING, version))
+            else:
+                held_owner, held_expires, state, version = row
+                if state == DONE or held_expires > time.time():
+                    return None
+                version += 1
+                db.execute('UPDATE leases SET owner = ?, expires = ?, state = ?, version = ? WHERE key = ?',
+                           (owner, expires, PENDING, version, key))
+                print(f'Took over expired lease on {key} from {held_owner}')
+        return Lease(key, owner, expires, version)
+
+    def _update(self, lease, expires, state):
+        with self._transaction() as db:
+            updated = db.execute(
+                'UPDATE leases SET expires = ?, state = ?, version = version + 1'
+                ' WHERE key = ? AND owner = ? AND version = ?',
+                (expires, state, lease.key, lease.owner, lease.version)).rowcount
+        if not updated:
+            return False
+        lease.version += 1
+        lease.expires = expires
+        return True
+
+    def renew(self, lease, ttl):
+        return self._update(lease, time.time() + ttl, PENDING)
+
+    def complete(self, lease):
+        return self._update(lease, lease.expires, DONE)
+
+    def release(self, lease):
+        return self._update(lease, 0, PENDING)
+
+
+def default_owner():
+    """ hostname:pid, unique across the nodes of one run. """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+class LeaseManager:
+    """
+    Claims archives for this node and keeps the claims alive.
+
+    A heartbeat thread renews every held lease each ttl / 3 seconds, so a
+    lease only expires if the node stops. Take a lease with acquire() when
+    work on an archive starts, and hand it back with finish() once the
+    work is over (stages.LeasedFetch and stages.archive_source). A lease
+    finished without done set is released for another node to retry.
+    """
+
+    def __init__(self, backend, owner=None, ttl=300.0, heartbeat=None):
+        """
+        Args:
+            backend: S3LeaseBackend or SQLiteLeaseBackend
+            owner (str, optional): Name of this node, defaults to hostname:pid
+            ttl (float): Seconds a lease lasts without a renewal
+            heartbeat (float, optional): Seconds between renewals, ttl / 3 by default
+        """
+        self.backend = backend
+        self.owner = owner or default_owner()
+        self.ttl = ttl
+        self.heartbeat = heartbeat or ttl / 3
+        self.claimed = 0
+        self.skipped = 0
+        self._held = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._renew_loop, name='lease-heartbeat', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        """ Stop the heartbeat. Leases still held will expire on their own. """
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _renew_loop(self):
+        while not self._stop.wait(self.heartbeat):
+            with self._lock:
+                leases = list(self._held.values())
+            for lease in leases:
+                with lease.lock:
+                    if lease.lost or lease.finished:
+                        continue
+                    if not self.backend.renew(lease, self.ttl):
+                        lease.lost = True
+                        print(f'Lost the lease on {lease.key}, another node may be processing it')
+
+    def acquire(self, key):
+        """
+        Lease key for this node and keep it renewed until finish().
+
+        Returns:
+            Lease: The lease, or None if the key is taken or done
+        """
+        lease = self.backend.acquire(key, self.owner, self.ttl)
+        if lease is None:
+            self.skipped += 1
+            return None
+        self.claimed += 1
+        with self._lock:
+            self._held[key] = lease
+        self._start()
+        return lease
+
+    def finish(self, lease):
+        """
+        Stop renewing a lease. It is marked done if lease.done is set,
+        otherwise released for another node to retry.
+        """
+        with self._lock:
+            self._held.pop(lease.key, None)
+        with lease.lock:
+            lease.finished = True
+            if lease.done:
+                if not self.backend.complete(lease):
+                    print(f'Could not mark {lease.key} done, the lease was lost')
+            elif not lease.lost:
+                self.backend.release(lease)
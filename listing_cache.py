@@ -0,0 +1,98 @@
+##############################################
+# Remembers which archives were processed,   #
+# so nightly runs only pick up new ones.     #
+##############################################
+
+import os
+import json
+import tempfile
+
+
+class ListingCache:
+    """Local record of processed archive keys with their ETag and LastModified."""
+
+    def __init__(self, path):
+        """
+        Initialize the cache from a JSON file, if one exists.
+
+        @Args:
+            path (str): Location of the cache file
+        """
+        self.path = path
+        self.last_key = None
+        self.entries = {}
+        self.load()
+
+    def load(self):
+        """ Reads the cache file. A missing file is an empty cache. """
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as cache_file:
+                data = json.load(cache_file)
+            self.last_key = data.get('last_key')
+            self.entries = data.get('entries', {})
+            print(f'Loaded {len(self.entries)} processed archives from {self.path}')
+        except (OSError, ValueError) as e:
+            print(f"Error reading listing cache {self.path}, starting empty: {e}")
+
+    @staticmethod
+    def _stamp(obj):
+        """ The parts of a listing entry that tell us it changed. """
+        last_modified = obj['LastModified']
+        if hasattr(last_modified, 'isoformat'):
+            last_modified = last_modified.isoformat()
+        return {'etag': obj['ETag'], 'last_modified': last_modified}
+
+    def is_current(self, obj):
+        """
+        Check if an archive was already processed in its current version.
+
+        Args:
+            obj (dict): A listing entry from S3Access.list_objects
+
+        Returns:
+            bool: True if the key was processed with the same ETag and LastModified
+        """
+        return self.entries.get(obj['Key']) == self._stamp(obj)
+
+    def record(self, obj):
+        """
+        Mark an archive as processed.
+
+        Args:
+            obj (dict): A listing entry from S3Access.list_objects
+        """
+        self.entries[obj['Key']] = self._stamp(obj)
+
+    def advance(self, listing):
+        """
+        Move the last-seen position forward over every processed archive.
+
+        The position stops before the first archive that is new or failed,
+        so the next StartAfter listing still includes it.
+
+        Args:
+            listing (list): Listing entries in key order, as returned by S3
+        """
+        for obj in listing:
+            if not self.is_current(obj):
+                break
+            self.last_key = obj['Key']
+
+    def save(self):
+        """ Writes the cache to a temporary file and swaps it into place. """
+        directory = os.path.dirname(os.path.abspath(self.path))
+        os.makedirs(directory, exist_ok=True)
+        data = {'last_key': self.last_key, 'entries': self.entries}
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.listing-', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as tmp_file:
+                json.dump(data, tmp_file)
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            os.replace(tmp_path, self.path)
+        except Exception:
+            os.remove(tmp_path)
+            raise
+        print(f'Saved {len(self.entries)} processed archives to {self.path}')
@@ -0,0 +1,287 @@
+##############################################
+# A folder that stands in for the S3 bucket  #
+# in local and offline runs. Same methods as #
+# S3Access, keys are paths under the root.   #
+##############################################
+
+import os
+import errno
+import random
+import shutil
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+# link() failing with these means "can't link here", not a real error
+_NO_LINK = {errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EOPNOTSUPP}
+
+
+def copy_file(source_path, destination_path):
+    """
+    Copy a file's bytes in the kernel where possible.
+
+    copy_file_range lets the filesystem share extents (reflinks on XFS,
+    Btrfs) or at least skip the round trip through user space; anything
+    that can't falls back to shutil, which uses sendfile on Linux.
+    """
+    with open(source_path, 'rb') as source, open(destination_path, 'wb') as destination:
+        remaining = os.fstat(source.fileno()).st_size
+        if hasattr(os, 'copy_file_range'):
+            try:
+                while remaining > 0:
+                    copied = os.copy_file_range(source.fileno(), destination.fileno(), remaining)
+                    if copied == 0:
+                        break
+                    remaining -= copied
+                return
+            except OSError as e:
+                if e.errno not in (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EOPNOTSUPP):
+                    raise
+                source.seek(0)
+                destination.seek(0)
+                destination.truncate()
+        shutil.copyfileobj(source, destination)
+
+
+class LocalAccess:
+    """Local folder access class with the same operations as S3Access."""
+
+    def __init__(self, root):
+        """
+        Initialize LocalAccess on a folder.
+
+        @Args:
+            root (str): Folder playing the part of the bucket
+        """
+        self.root = os.path.abspath(root)
+        self.bucket_name = self.root
+        self.linked = 0
+        self.copied = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key):
+        """ Where the object for key lives on disk. """
+        path = os.path.abspath(os.path.join(self.root, key))
+        if os.path.commonpath([path, self.root]) != self.root:
+            raise ValueError(f"Key {key} is outside {self.root}")
+        return path
+
+    def _temp_path(self, key):
+        directory = os.path.dirname(self.path(key))
+        os.makedirs(directory, exist_ok=True)
+        descriptor, temp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+        os.close(descriptor)
+        return temp_path
+
+    def _publish(self, temp_path, key, if_absent):
+        """ Move a finished temp file to key, atomically. """
+        path = self.path(key)
+        if not if_absent:
+            os.replace(temp_path, path)
+            return True
+        try:
+            # link() refuses to overwrite, like If-None-Match: *
+            os.link(temp_path, path)
+            return True
+        except FileExistsError:
+            return False
+        finally:
+            os.remove(temp_path)
+
+    def list_objects(self, prefix='_compressed', start_after=None):
+        """
+        List every file whose key starts with prefix, in key order.
+
+        Returns:
+            list: Dicts with the Key, ETag, LastModified and Size of each file
+        """
+        objects = []
+        base = os.path.dirname(prefix)
+        top = self.path(base) if base else self.root
+        for directory, folders, files in os.walk(top):
+            # only go into folders that can hold a matching key, so listing
+            # _compressed does not walk everything under upload/
+            relative = os.path.relpath(directory, self.root).replace(os.sep, '/')
+            relative = '' if relative == '.' else relative + '/'
+            folders[:] = [folder for folder in folders
+                          if (relative + folder + '/').startswith(prefix)
+                          or prefix.startswith(relative + folder + '/')]
+            for name in files:
+                if name.startswith('.tmp-'):
+                    continue
+                full_path = os.path.join(directory, name)
+                key = os.path.relpath(full_path, self.root).replace(os.sep, '/')
+                if not key.startswith(prefix) or (start_after and key <= start_after):
+                    continue
+                stat = os.stat(full_path)
+                objects.append({
+                    'Key': key,
+                    # not an MD5, but it changes whenever the file does
+                    'ETag': f'"{stat.st_mtime_ns:x}-{stat.st_size:x}"',
+                    'LastModified': datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc),
+                    'Size': stat.st_size,
+                })
+        objects.sort(key=lambda obj: obj['Key'])
+        return objects
+
+    def get_root_sources(self):
+        """ Gets everything from root """
+        return [x['Key'] for x in self.list_objects(prefix='_compressed')]
+
+    def get_sources(self, size=None):
+        if size is None or size == 0:
+            return self.get_root_sources()
+        return self.list_root_random(size=size)
+
+    def list_root_random(self, size=5):
+        """ For testing. Gets random files in Root."""
+        keys = self.get_root_sources()
+        return random.sample(keys, k=min(size, len(keys)))
+
+    def put_file(self, key, source_path, if_absent=False):
+        """
+        Store a file that is already on disk under key without copying
+        its bytes: a hard link on the same filesystem, a kernel copy
+        otherwise.
+
+        Args:
+            key (str): Key name for the object
+            source_path (str): The file to store
+            if_absent (bool): Leave an existing object alone
+
+        Returns:
+            bool: True if stored, False if if_absent and the key exists,
+                  None on any other error
+        """
+        try:
+            path = self.path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            try:
+                if if_absent:
+                    os.link(source_path, path)
+                else:
+                    temp_path = self._temp_path(key)
+                    os.remove(temp_path)
+                    os.link(source_path, temp_path)
+                    os.replace(temp_path, path)
+                with self._lock:
+                    self.linked += 1
+                return True
+            except FileExistsError:
+                return False
+            except OSError as e:
+                if e.errno not in _NO_LINK:
+                    raise
+            # another filesystem (or one without hard links)
+            temp_path = self._temp_path(key)
+            copy_file(source_path, temp_path)
+            stored = self._publish(temp_path, key, if_absent)
+            if stored:
+                with self._lock:
+                    self.copied += 1
+            return stored
+
+        except (OSError, ValueError) as e:
+            print(f"Error storing {source_path} as {key}: {e}")
+            return None
+
+    def put_object(self, key, file_object):
+        """
+        Write a file object under key.
+
+        Returns:
+            bool: True if successful, False otherwise
+        """
+        return self._put_object(key, file_object, if_absent=False) is True
+
+    def put_object_if_absent(self, key, file_object):
+        """
+        Write a file object only if nothing is stored under key yet.
+
+        Returns:
+            bool: True if written, False if the key already exists,
+                  None on any other error
+        """
+        return self._put_object(key, file_object, if_absent=True)
+
+    def _put_object(self, key, file_object, if_absent):
+        try:
+            temp_path = self._temp_path(key)
+            with open(temp_path, 'wb') as temp_file:
+                if isinstance(file_object, (bytes, bytearray)):
+                    temp_file.write(file_object)
+                else:
+                    shutil.copyfileobj(file_object, temp_file)
+            return self._publish(temp_path, key, if_absent)
+        except (OSError, ValueError) as e:
+            print(f"Error writing object {key}: {e}")
+            return None
+
+    def get_object(self, key):
+        """
+        Returns:
+            bytes: File content as bytes, or None if error
+        """
+        try:
+            with open(self.path(key), 'rb') as object_file:
+                return object_file.read()
+        except (OSError, ValueError) as e:
+            print(f"Error retrieving object {key}: {e}")
+            return None
+
+    def get_object_stream(self, key):
+        """
+        Returns:
+            file: The file opened for reading, or None if error
+        """
+        try:
+            return open(self.path(key), 'rb')
+        except (OSError, ValueError) as e:
+            print(f"Error retrieving object {key}: {e}")
+            return None
+
+    def get_object_range(self, key, start, end):
+        """
+        Returns:
+            bytes: Bytes start to end (inclusive), or None if error
+        """
+        try:
+            with open(self.path(key), 'rb') as object_file:
+                return os.pread(object_file.fileno(), end - start + 1, start)
+        except (OSError, ValueError) as e:
+            print(f"Error retrieving bytes {start}-{end} of {key}: {e}")
+            return None
+
+    def get_object_size(self, key):
+        try:
+            return os.path.getsize(self.path(key))
+        except (OSError, ValueError) as e:
+            print(f"Error checking size of {key}: {e}")
+            return None
+
+    def object_exists(self, key):
+        try:
+            return os.path.isfile(self.path(key))
+        except ValueError:
+            return False
+
+    def rename_key(self, current_key, new_key):
+        try:
+            new_path = self.path(new_key)
+            os.makedirs(os.path.dirname(new_path), exist_ok=True)
+            os.replace(self.path(current_key), new_path)
+            print(f"Successfully renamed {current_key} to {new_key}")
+            return True
+        except (OSError, ValueError) as e:
+            print(f"Error renaming key {current_key} to {new_key}: {e}")
+            return False
+
+    def delete_object(self, key):
+        try:
+            os.remove(self.path(key))
+            print(f"Successfully deleted object {key}")
+            return True
+        except (OSError, ValueError) as e:
+            print(f"Error deleting object {key}: {e}")
+            return False
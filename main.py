@@ -3,13 +3,26 @@
 ##############################################
 
 import argparse
-import uuid
+import time
 import os
+import random
 import shutil
-import io
-import s3extractors
 from run_extract import ArchiveTraverse
-from s3_access import S3Access
+from s3_access import S3Access, S3RangedFile, get_s3_client
+from local_access import LocalAccess
+from throttle import AIMDController
+from profiling import make_profiler, finish
+from listing_cache import ListingCache
+from randomizer import NameAllocator
+from leases import LeaseManager, S3LeaseBackend, SQLiteLeaseBackend
+from pipeline import Pipeline, Stage
+from shard_sink import TarShardWriter
+from key_layout import KeyLayout
+from stages import archive_source, S3Fetch, LocalFetch, LeasedFetch, ExtractArchive
+from extraction_limits import ExtractionLimits, GiB
+from scheduler import plan, archive_key
+from catalog import MemberCatalog
+from manifest import ManifestWriter
 
 bucket = os.environ.get('S3_BUCKET_NAME')
 
@@ -27,7 +40,22 @@ def main():
         '--local',
         action='store_true',
         help='use only if running locally, and not intending \
-            to interact with s3'
+            to interact with s3. Archives are read from and \
+            images stored to --local-root instead of the bucket'
+    )
+    parser.add_argument(
+        '--local-root',
+        default='root/bucket',
+        help='Default root/bucket. Folder laid out like the \
+            bucket (_compressed/..., upload/...) for --local'
+    )
+    parser.add_argument(
+        '--workspace',
+        default=None,
+        help='Default /mnt/ebs_volume, or _workspace under \
+            --local-root with --local. Folder archives are \
+            extracted to. On the same filesystem as --local-root \
+            images are hard linked into upload/, not copied'
     )
     parser.add_argument(
         '--sample',
@@ -43,23 +71,338 @@ def main():
         help='overrides sample size. \
             All archives will be processed if used!'
     )
+    parser.add_argument(
+        '--workers',
+        default=1,
+        type=int,
+        help='Default 1. Threads used to decode archives \
+            that can be extracted in parallel (zip, 7z)'
+    )
+    parser.add_argument(
+        '--fetch-workers',
+        default=1,
+        type=int,
+        help='Default 1. Archives downloaded at once'
+    )
+    parser.add_argument(
+        '--extract-workers',
+        default=1,
+        type=int,
+        help='Default 1. Archives extracted at once, each \
+            with --workers threads'
+    )
+    parser.add_argument(
+        '--incremental',
+        action='store_true',
+        help='only process archives that are new or \
+            changed since the last incremental run. \
+            Overrides sample size'
+    )
+    parser.add_argument(
+        '--rescan',
+        action='store_true',
+        help='with --incremental, list the whole prefix \
+            instead of starting after the last-seen key'
+    )
+    parser.add_argument(
+        '--cache-file',
+        default='listing_cache.json',
+        help='Default listing_cache.json. Where --incremental \
+            keeps the processed archive keys'
+    )
+    parser.add_argument(
+        '--unique-names',
+        action='store_true',
+        help='draw upload names from an allocator seeded \
+            with the names already under upload/'
+    )
+    parser.add_argument(
+        '--conditional-writes',
+        action='store_true',
+        help='never overwrite an existing key under upload/, \
+            retry with a new name instead'
+    )
+    parser.add_argument(
+        '--upload-workers',
+        default=1,
+        type=int,
+        help='Default 1. Threads uploading to s3. In-flight \
+            requests adapt below this when s3 throttles'
+    )
+    parser.add_argument(
+        '--full-download',
+        action='store_true',
+        help='download zip archives whole instead of \
+            reading only the image members with ranged GETs'
+    )
+    parser.add_argument(
+        '--stream-tar',
+        action='store_true',
+        help='extract tar archives while they download and \
+            upload each image as soon as it is decoded'
+    )
+    parser.add_argument(
+        '--profile',
+        action='store_true',
+        help='record per-stage cProfile data and stack samples \
+            for the fetch, extract, traverse and upload stages'
+    )
+    parser.add_argument(
+        '--profile-rate',
+        default=1.0,
+        type=float,
+        help='Default 1.0. Fraction of --profile runs that \
+            actually profile, to leave it on in production'
+    )
+    parser.add_argument(
+        '--profile-output',
+        default='profiles/main',
+        help='Default profiles/main. Prefix for the .pstats \
+            and .collapsed files'
+    )
+    parser.add_argument(
+        '--resources',
+        default=None,
+        metavar='PATH',
+        help='sample RSS, open descriptors, used space on the \
+            workspace filesystem and I/O per stage and per \
+            archive, and write the peaks to this JSON file at \
+            the end of the run'
+    )
+    parser.add_argument(
+        '--resource-interval',
+        default=0.5,
+        type=float,
+        help='Default 0.5. Seconds between --resources samples'
+    )
+    parser.add_argument(
+        '--trace-memory',
+        action='store_true',
+        help='with --resources, also trace Python allocations \
+            and keep the top allocation sites of each stage. \
+            Slows the run down noticeably'
+    )
+    parser.add_argument(
+        '--near-duplicates',
+        default=None,
+        type=int,
+        metavar='DISTANCE',
+        help='drop images within this Hamming distance of an \
+            image already uploaded in this run (64 bit dHash)'
+    )
+    parser.add_argument(
+        '--leases',
+        default=None,
+        metavar='RUN_ID',
+        help='share the archives with every other node started \
+            with the same RUN_ID. Each archive is leased by one \
+            node; leases of crashed nodes expire and are retried'
+    )
+    parser.add_argument(
+        '--lease-backend',
+        default='s3',
+        choices=['s3', 'sqlite'],
+        help='Default s3. Where leases are kept: lock objects \
+            under _leases/RUN_ID/ in the bucket, or --lease-db'
+    )
+    parser.add_argument(
+        '--lease-db',
+        default='leases.sqlite',
+        help='Default leases.sqlite. Lease database for \
+            --lease-backend sqlite (processes on one machine)'
+    )
+    parser.add_argument(
+        '--lease-ttl',
+        default=300.0,
+        type=float,
+        help='Default 300. Seconds before a lease that is not \
+            renewed can be taken over by another node'
+    )
+    parser.add_argument(
+        '--node-id',
+        default=None,
+        help='Default hostname:pid. Name this node leases under'
+    )
+    parser.add_argument(
+        '--shards',
+        action='store_true',
+        help='pack images into tar shards under shards/, with \
+            a JSON index each, instead of one object per image'
+    )
+    parser.add_argument(
+        '--shard-mb',
+        default=256,
+        type=int,
+        help='Default 256. Size in MB at which a shard is uploaded'
+    )
+    parser.add_argument(
+        '--partitions',
+        default=0,
+        type=int,
+        help='Default 0. Spread images over this many hashed \
+            sub-prefixes, upload/3f/<name>, so s3 serves more \
+            requests per second. 0 keeps upload/<name>'
+    )
+    parser.add_argument(
+        '--schedule',
+        default='size',
+        choices=['listing', 'size', 'headers'],
+        help='Default size. Order archives are dispatched in: \
+            listing order, largest in the listing first, or \
+            largest unpacked size first (reads zip central \
+            directories, a few ranged GETs each)'
+    )
+    parser.add_argument(
+        '--split-gb',
+        default=8.0,
+        type=float,
+        help='Default 8. Split zips that unpack to more than \
+            this many GB into member ranges that different \
+            extract workers take. 0 never splits. Not used \
+            with --full-download'
+    )
+    parser.add_argument(
+        '--catalog',
+        default=None,
+        metavar='PATH',
+        help='write a row per stored image (archive, member, \
+            name, key, size, sha256, width, height) to this \
+            .parquet or .csv file at the end of the run, and \
+            store a dated copy under catalogs/ next to the images'
+    )
+    parser.add_argument(
+        '--manifest-batch',
+        default=10000,
+        type=int,
+        help='Default 10000. Write a manifest of the keys \
+            stored under manifests/ every this many uploads, \
+            so consumers need not list upload/. 0 writes none'
+    )
+    parser.add_argument(
+        '--max-extract-gb',
+        default=50.0,
+        type=float,
+        help='Default 50. Stop an archive that unpacks to more \
+            than this many GB, nested archives included'
+    )
+    parser.add_argument(
+        '--max-ratio',
+        default=100.0,
+        type=float,
+        help='Default 100. Stop an archive (or member) that \
+            expands more than this many times its compressed size'
+    )
+    parser.add_argument(
+        '--max-members',
+        default=1_000_000,
+        type=int,
+        help='Default 1000000. Stop an archive with more members'
+    )
+    parser.add_argument(
+        '--max-depth',
+        default=3,
+        type=int,
+        help='Default 3. Most levels of archives inside archives'
+    )
     args = parser.parse_args()
-    if args.all or args.sample < 1:
+    if args.all or args.sample < 1 or args.incremental:
         args.sample = None
     print(args)
+    profiler = make_profiler(args.profile, rate=args.profile_rate)
+
+    if args.local:
+        s3access = LocalAccess(args.local_root)
+        if args.leases:
+            args.lease_backend = 'sqlite'
+    else:
+        # one client for the whole run, pooled for every thread that uses it
+        get_s3_client(max_pool_connections=args.upload_workers + args.fetch_workers
+                      + args.extract_workers * args.workers)
+        controller = AIMDController(
+            initial=min(args.upload_workers, 8),
+            maximum=args.upload_workers)
+        s3access = S3Access(bucket, controller=controller)
+    key_layout = KeyLayout(partitions=args.partitions)
+    name_allocator = None
+    if args.unique_names:
+        name_allocator = NameAllocator.from_bucket(
+            s3access, layout=key_layout if args.partitions else None)
+
+    near_duplicates = None
+    if args.near_duplicates is not None:
+        from near_duplicates import NearDuplicateFilter  # pulls in numpy
+        near_duplicates = NearDuplicateFilter(max_distance=args.near_duplicates)
+
+    shard_writer = None
+    if args.shards and not args.test:
+        shard_writer = TarShardWriter(s3access, shard_bytes=args.shard_mb * 1024 * 1024)
+
+    catalog = MemberCatalog() if args.catalog else None
+    manifest = None
+    if args.manifest_batch and not args.test:
+        manifest = ManifestWriter(s3access, batch=args.manifest_batch)
 
     archiveTraverse = ArchiveTraverse(
-        local=False,
-        test=args.test)
+        local=args.local,
+        test=args.test,
+        workers=args.workers,
+        name_allocator=name_allocator,
+        conditional_writes=args.conditional_writes,
+        upload_workers=args.upload_workers,
+        s3access=s3access,
+        profiler=profiler,
+        near_duplicates=near_duplicates,
+        shard_writer=shard_writer,
+        key_layout=key_layout,
+        catalog=catalog,
+        manifest=manifest)
+
+    cache = None
+    if args.incremental:
+        cache = ListingCache(args.cache_file)
+        start_after = None if args.rescan else cache.last_key
+        listing = s3access.list_objects(prefix='_compressed', start_after=start_after)
+        listing = [x for x in listing if x['Key'][-1] != "/"]
+        pending = {x['Key']: x for x in listing if not cache.is_current(x)}
+        items = list(pending)
+        print(f'{len(items)} new or changed archives after {start_after}')
+    else:
+        listing = s3access.list_objects(prefix='_compressed')
+        listing = [x for x in listing if x['Key'][-1] != "/"]
+        items = [x['Key'] for x in listing]
+        if args.sample:
+            items = random.sample(items, k=min(args.sample, len(items)))
 
-    s3access = S3Access(bucket)
-    items = s3access.get_sources(size=args.sample)
 
+    leases = None
+    if args.leases:
+        if args.lease_backend == 's3':
+            backend = S3LeaseBackend(s3access, prefix=f'_leases/{args.leases}/')
+        else:
+            backend = SQLiteLeaseBackend(args.lease_db)
+        leases = LeaseManager(backend, owner=args.node_id, ttl=args.lease_ttl)
+        # start each node somewhere else in the list so they rarely
+        # race for the same archive (plan keeps this within size classes)
+        random.shuffle(items)
+
+    if args.schedule != 'listing':
+        sizes = {x['Key']: x['Size'] for x in listing}
+        # split parts of a zip are read with ranged reads, a full
+        # download would fetch the whole archive once per part
+        split_gb = 0 if args.full_download and not args.local else args.split_gb
+        items = plan(items, sizes,
+                     open_archive=lambda key: S3RangedFile(s3access, key, size=sizes.get(key)),
+                     headers=args.schedule == 'headers',
+                     split_bytes=int(split_gb * GiB),
+                     workers=args.fetch_workers,
+                     shuffle=leases is not None)
 
     print('Items found. List first 10')
     for i, object in enumerate(items):
         if i >= 9:
             break
+        elif archive_key(object) != object:
+            print(f'{object.key} (part {object.index + 1} of {object.count})')
         else:
             print(object)
 
@@ -77,23 +420,76 @@ def main():
     print('\n attempting extractions! \n')
 
 
-    for i in items:
-        job = uuid.uuid4()
-        workspace = os.path.join('/','mnt','ebs_volume')
-        save_point = os.path.join(workspace, str(job))
-        archive_object = s3access.get_object(i)
-        print(f'--extracting ${i}')
-        archive_object = io.BytesIO(archive_object)
-        extractor = s3extractors.get_extractor(i)
-        extractor.extract(archive_object=archive_object, 
-                          archive_key=i, 
-                          destination_path=save_point)
+    workspace = args.workspace
+    if workspace is None:
+        workspace = (os.path.join(s3access.root, '_workspace') if args.local
+                     else os.path.join('/','mnt','ebs_volume'))
+    limits = ExtractionLimits(max_total_bytes=int(args.max_extract_gb * GiB),
+                              max_ratio=args.max_ratio,
+                              max_members=args.max_members,
+                              max_depth=args.max_depth)
+
+    def finished(job):
+        # runs once every file from the archive is uploaded or dropped
+        if job.skipped:
+            return
+        if job.failed:
+            print(f'--{job.key} failed, it will be retried next run')
+            return
+        #shutil.rmtree(job.workspace)
+        if cache is not None:
+            cache.record(pending[job.key])
+        print(f'--extractions done for {job.key}')
+
+    monitor = None
+    if args.resources:
+        from resources import ResourceMonitor  # pulls in psutil
+        monitor = ResourceMonitor(workspace=workspace, interval=args.resource_interval,
+                                  trace_memory=args.trace_memory)
+
+    fetch = LocalFetch(s3access) if args.local else S3Fetch(
+        s3access, full_download=args.full_download, stream_tar=args.stream_tar)
+    if leases is not None:
+        fetch = LeasedFetch(fetch, leases)
+
+    pipeline = Pipeline(
+        archive_source(items, on_done=finished, leases=leases),
+        [Stage('fetch', fetch, workers=args.fetch_workers),
+         # fetched archives wait in memory, so only let a few queue up
+         Stage('extract', ExtractArchive(archiveTraverse, workspace, workers=args.workers,
+                                        limits=limits),
+               workers=args.extract_workers, queue_size=args.extract_workers)]
+        + archiveTraverse.stages(),
+        hooks=archiveTraverse.hooks() + ([monitor.hook] if monitor is not None else []))
 
-        # Traverse the extracted folder, move to s3
-        archiveTraverse.traverse_path(save_point)
-        #shutil.rmtree(save_point)
-        print('--extractions done for this file')
+    if monitor is not None:
+        monitor.start()
+    try:
+        pipeline.run()
+    finally:
+        if shard_writer is not None:
+            shard_writer.close()
+        if manifest is not None:
+            manifest.close()
+        if catalog is not None:
+            written = catalog.export(args.catalog)
+            if not args.test:
+                # one per run, so earlier runs' catalogs are kept
+                s3access.put_file(f'catalogs/{time.strftime("%Y%m%d-%H%M%S")}-'
+                                  f'{os.path.basename(written)}', written)
+        if cache is not None:
+            # save whatever finished, even if the run was cut short
+            cache.advance(listing)
+            cache.save()
+        finish(profiler, args.profile_output)
+        if leases is not None:
+            leases.stop()
+            print(f'Leased {leases.claimed} archives, {leases.skipped} taken by other nodes')
+        if monitor is not None:
+            monitor.stop()
+            monitor.report(args.resources)
 
+    pipeline.summary()
     print('\n all extractions completed \n')
 
 if __name__ == '__main__':
@@ -0,0 +1,110 @@
+##############################################
+# Manifests of what each run uploaded, so    #
+# consumers list manifests/ instead of       #
+# crawling millions of keys under upload/.   #
+##############################################
+
+import io
+import os
+import gzip
+import json
+import time
+import uuid
+import threading
+
+
+class ManifestWriter:
+    """
+    Collects one entry per stored image and writes them out every
+    `batch` entries as gzipped JSON lines:
+
+        manifests/<YYYYmmdd-HHMMSS>-<run>-<number>.jsonl.gz
+
+        {"key": "upload/3f/Ab3dE9x.jpg", "name": "Ab3dE9x.jpg",
+         "archive": "_compressed/x.zip", "member": "photos/1.jpg",
+         "size": 30211, "sha256": "..."}
+
+    Names start with the UTC time the manifest was written, so runs that
+    overlap, on one node or many, still add names that sort after the
+    ones already there. To pick up new manifests, list manifests/ with
+    StartAfter set a few minutes before the newest name already read, and
+    skip the names already read: a manifest whose upload was slow, or a
+    node whose clock runs behind, can land just before it. For shards,
+    key is the shard the image was packed into.
+    """
+
+    def __init__(self, access, prefix='manifests/', batch=10000, fallback_dir='manifests'):
+        """
+        Args:
+            access (S3Access or LocalAccess): Where manifests are written
+            prefix (str): Key prefix of the manifests
+            batch (int): Entries per manifest object
+            fallback_dir (str): Local folder for manifests that could not
+                be uploaded at close, so their entries are not lost
+        """
+        self.access = access
+        self.prefix = prefix
+        self.batch = max(1, batch)
+        self.fallback_dir = fallback_dir
+        self.run = uuid.uuid4().hex[:8]
+        self.written = []   # keys of the manifests written
+        self.entries = 0
+        self._pending = []
+        self._number = 0
+        self._lock = threading.Lock()
+
+    def add(self, key, name, archive, member, size, sha256):
+        """
+        Record one stored image.
+
+        Args:
+            key (str): Key it was stored at
+            name (str): Its random upload name
+            archive (str): Key of the archive it came from
+            member (str): Its path inside the archive
+            size (int): Bytes
+            sha256 (str): Hex digest of its contents
+        """
+        entry = json.dumps({'key': key, 'name': name, 'archive': archive, 'member': member,
+                            'size': size, 'sha256': sha256}, separators=(',', ':'))
+        with self._lock:
+            self._pending.append(entry)
+            self.entries += 1
+            if len(self._pending) < self.batch:
+                return
+            lines, self._pending = self._pending, []
+            self._number += 1
+            number = self._number
+        # write outside the lock, other threads keep adding
+        self._write(number, lines)
+
+    def _write(self, number, lines, final=False):
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        key = f'{self.prefix}{stamp}-{self.run}-{number:06d}.jsonl.gz'
+        body = gzip.compress(('\n'.join(lines) + '\n').encode())
+        if self.access.put_object(key, io.BytesIO(body)):
+            with self._lock:
+                self.written.append(key)
+            print(f'Wrote manifest {key} with {len(lines)} entries')
+            return
+        if not final:
+            # keep the entries, they go out with the next manifest
+            print(f'Manifest {key} was not written, retrying with the next one')
+            with self._lock:
+                self._pending[:0] = lines
+            return
+        os.makedirs(self.fallback_dir, exist_ok=True)
+        path = os.path.join(self.fallback_dir, os.path.basename(key))
+        with open(path, 'wb') as manifest_file:
+            manifest_file.write(body)
+        print(f'Manifest {key} was not written, left at {path}')
+
+    def close(self):
+        """ Write the last, partly filled manifest. """
+        with self._lock:
+            lines, self._pending = self._pending, []
+            self._number += 1
+            number = self._number
+        if lines:
+            self._write(number, lines, final=True)
+        print(f'{self.entries} uploads listed in {len(self.written)} manifests')
@@ -5,15 +5,12 @@
 ############################################################
 
 import os
-import uuid
-import pathlib
-import re
-import uuid
-import shutil
-import argparse
-from extractors import get_extractor
 from s3_access import S3Access
-from randomizer import rename
+from run_extract import ArchiveTraverse
+from pipeline import Pipeline, Stage
+from stages import (archive_source, local_archives, LocalFetch,
+                    S3Fetch, ExtractArchive, remove_workspace)
+from extraction_limits import ExtractionLimits
 
 s3_bucket = os.environ.get('S3_BUCKET_NAME')
 # Check first if we're runnin is EC2,
@@ -21,7 +18,7 @@ s3_bucket = os.environ.get('S3_BUCKET_NAME')
 
 if os.path.exists('/mnt/ebs_volume'):
     local_source = None # because we'll use s3
-    work_space = os.path('/mnt/ebs_volume')
+    work_space = '/mnt/ebs_volume'
     print(f'my workspace is: ${work_space}')
 else:
     local_source = os.path.abspath('root/zips')
@@ -31,111 +28,28 @@ else:
     results = os.path.abspath('root/results')
     print(f'my workspace is ${results}')
 
-def list_directory_contents(directory_path):
-    """
-    List everything within a directory and return a list of tuples.
-    
-    Args:
-        directory_path (str): Path to the directory to list contents of
-    
-    Returns:
-        list: List of tuples, each containing (absolute_path, is_folder_boolean)
-    """
-    result_list = []
-    
-    try:
-        # Check if the directory exists
-        if not os.path.exists(directory_path):
-            print(f"Error: Directory '{directory_path}' does not exist.")
-            return result_list
-        # Check if the path is actually a directory
-        if not os.path.isdir(directory_path):
-            print(f"Error: '{directory_path}' is not a directory.")
-            return result_list
-        
-        # List all items in the directory
-        for item in os.listdir(directory_path):
-            pattern = r'\.DS_Store$'  #pattern to be ignored
-            if re.search(pattern, item):
-                continue
-            # Construct the full path to the item
-            item_path = os.path.join(directory_path, item)
-            abs_item_path = os.path.abspath(item_path)
-            
-            # Check if it's a directory
-            is_folder = os.path.isdir(item_path)
-            
-            # Create tuple and append to list
-            item_tuple = (abs_item_path, is_folder)
-            result_list.append(item_tuple)
-                
-    except PermissionError:
-        print(f"Error: Permission denied accessing directory '{directory_path}'")
-    except Exception as e:
-        print(f"Error: {e}")
-    
-    return result_list
-
-def get_file_name(path):
-    return path.split('/')[-1]
-
-def traverse_path(directory):
-    """ Just get the files and list them """
-    folder_stack = [directory]
-    all_files = []
-
-    while folder_stack:
-        current_folder = folder_stack.pop()
-        contents = list_directory_contents(current_folder)
-        for item in contents:
-            if item[1]:
-                folder_stack.append(item[0])
-            else:
-                all_files.append(item[0])
-                file_name = get_file_name(item[0])
-                print(f'Move or Save to s3 here: {file_name}')
-                if not local_source:
-                    # Give the file a random name 
-                    # and place in s3 uploads.
-                    r_name = rename(file_name)
-                    print(f'{file_name} randomize to ${r_name}')
-                    print(f'{file_name} Will go to s3 from here!')
+# Locally, images are linked into root/results/upload/ under their
+# random names. From s3 it is still a dry run: names are only listed
+if local_source:
+    traverse = ArchiveTraverse(local=True, test=False, local_root=results)
+else:
+    traverse = ArchiveTraverse(test=True)
 
 if local_source:
     print(local_source)
     # Get a list of all compressed files from a local directory.
-    compressed_files = []
-    for item in os.listdir(local_source):
-        print(item)
-        pattern = r'\.DS_Store$'  #pattern to be ignored
-        if re.search(pattern, item):
-            continue
-        # Construct the full path to the item
-        path = os.path.join(local_source, item)
-        compressed_files.append(path)
-
-    for archive in compressed_files:
-        job = uuid.uuid4()
-        destination = os.path.join(work_space, str(job))
-        print(f'extracting to f{destination}')
-        extractor = get_extractor(archive)
-        extractor.extract(archive, destination)
-        print('Run next functions here')
-        traverse_path(destination)
-        print(f'completed job ${job}. Deleting temp folder')
-        shutil.rmtree(destination)
-
+    source = archive_source(local_archives(local_source), on_done=remove_workspace)
+    fetch = Stage('fetch', LocalFetch())
 else:
     print("extracting from an s3 Bucket")
     s3access = S3Access(s3_bucket)
     keys = s3access.list_root_random() # a list of Keys from the s3 bucket
-    for key in keys:
-        job = uuid.uuid()
-        save_point = os.path.join(work_space, str(job))
-        extract_point = os.path.join(save_point, 'output')
-        archive = s3access.get_object(key)
-        # Todo: Copy the Archive to Save Point
-        extractor = get_extractor(archive)
-        extractor.extract(archive, extract_point)
-        traverse_path(extract_point)
-        shutil.rmtree(save_point)
\ No newline at end of file
+    source = archive_source(keys, on_done=remove_workspace)
+    fetch = Stage('fetch', S3Fetch(s3access, full_download=True))
+
+# the default limits: an archive that would fill the workspace is stopped
+extract = ExtractArchive(traverse, work_space, limits=ExtractionLimits())
+pipeline = Pipeline(source, [fetch, Stage('extract', extract)]
+                    + traverse.stages())
+pipeline.run()
+pipeline.summary()
@@ -0,0 +1,296 @@
+##############################################
+# Near-duplicate detection with perceptual   #
+# hashes. Catches the same photo re-saved at #
+# another size or JPEG quality.              #
+##############################################
+
+import threading
+from array import array
+import numpy as np
+
+HASH_BITS = 64
+
+
+def _area_downsample(images, rows, cols):
+    """
+    Shrink a batch of grayscale images by averaging equal-ish blocks.
+
+    Args:
+        images (np.ndarray): Shape (N, H, W)
+        rows (int): Output height
+        cols (int): Output width
+
+    Returns:
+        np.ndarray: Shape (N, rows, cols), float64
+    """
+    images = np.asarray(images, dtype=np.float64)
+    _, height, width = images.shape
+    row_edges = (np.arange(rows) * height) // rows
+    col_edges = (np.arange(cols) * width) // cols
+    sums = np.add.reduceat(np.add.reduceat(images, row_edges, axis=1), col_edges, axis=2)
+    row_counts = np.diff(np.append(row_edges, height))
+    col_counts = np.diff(np.append(col_edges, width))
+    return sums / np.outer(row_counts, col_counts)
+
+
+def _pack(bits):
+    """ (N, 64) booleans -> N Python ints, first bit most significant. """
+    packed = np.packbits(bits.reshape(len(bits), -1), axis=1)
+    return [int(x) for x in packed.view('>u8').ravel()]
+
+
+def dhash_batch(images):
+    """
+    Difference hash of each image: is each cell brighter than its
+    right-hand neighbour, on a 9x8 grid.
+
+    Args:
+        images (np.ndarray): Grayscale batch, shape (N, H, W)
+
+    Returns:
+        list: One 64 bit int per image
+    """
+    small = _area_downsample(images, 8, 9)
+    return _pack(small[:, :, 1:] > small[:, :, :-1])
+
+
+_DCT_SIZE = 32
+_dct_matrix = None
+
+def _dct():
+    global _dct_matrix
+    if _dct_matrix is None:
+        n = np.arange(_DCT_SIZE)
+        matrix = np.cos(np.pi * (2 * n[None, :] + 1) * n[:, None] / (2 * _DCT_SIZE))
+        matrix[0] /= np.sqrt(2)
+        _dct_matrix = matrix * np.sqrt(2 / _DCT_SIZE)
+    return _dct_matrix
+
+
+def phash_batch(images):
+    """
+    DCT hash of each image: the lowest 8x8 frequencies of a 32x32
+    downsample, compared against their median.
+
+    Args:
+        images (np.ndarray): Grayscale batch, shape (N, H, W)
+
+    Returns:
+        list: One 64 bit int per image
+    """
+    small = _area_downsample(images, _DCT_SIZE, _DCT_SIZE)
+    dct = _dct()
+    low = (dct @ small @ dct.T)[:, :8, :8].reshape(len(small), 64)
+    # the DC term only says how bright the image is, leave it out of the median
+    median = np.median(low[:, 1:], axis=1, keepdims=True)
+    return _pack(low > median)
+
+
+HASHES = {
+    'dhash': dhash_batch,
+    'phash': phash_batch,
+}
+
+
+def hamming(a, b):
+    return (a ^ b).bit_count()
+
+
+class BKTree:
+    """
+    Burkhard-Keller tree over Hamming distance.
+
+    Children sit under the distance to their parent, so the triangle
+    inequality prunes every subtree outside [d - radius, d + radius].
+    """
+
+    def __init__(self):
+        self.root = None
+        self.size = 0
+
+    def add(self, value):
+        self.size += 1
+        if self.root is None:
+            self.root = (value, {})
+            return
+        node = self.root
+        while True:
+            distance = hamming(value, node[0])
+            child = node[1].get(distance)
+            if child is None:
+                node[1][distance] = (value, {})
+                return
+            node = child
+
+    def query(self, value, radius):
+        """
+        Args:
+            value (int): Hash to look up
+            radius (int): Largest Hamming distance to report
+
+        Returns:
+            list: (distance, hash) pairs within the radius
+        """
+        found = []
+        if self.root is None:
+            return found
+        pending = [self.root]
+        while pending:
+            node_value, children = pending.pop()
+            distance = hamming(value, node_value)
+            if distance <= radius:
+                found.append((distance, node_value))
+            for child_distance, child in children.items():
+                if distance - radius <= child_distance <= distance + radius:
+                    pending.append(child)
+        return found
+
+    def __len__(self):
+        return self.size
+
+
+class MultiIndexHash:
+    """
+    Multi-index hashing for a fixed radius.
+
+    The 64 bits are cut into radius + 1 chunks. Two hashes within the
+    radius must agree exactly on at least one chunk, so each chunk gets a
+    table from chunk value to the hashes that have it, and only those
+    candidates are compared. Buckets are uint64 arrays checked with one
+    vectorized popcount, which keeps lookups well under a millisecond at
+    tens of millions of hashes.
+    """
+
+    def __init__(self, radius):
+        """
+        Args:
+            radius (int): Largest distance looked up, 0 to HASH_BITS - 1,
+                so that each of the radius + 1 chunks is at least one bit
+        """
+        if not 0 <= radius < HASH_BITS:
+            raise ValueError(f"radius must be between 0 and {HASH_BITS - 1}, got {radius}")
+        self.radius = radius
+        chunks = radius + 1
+        widths = [HASH_BITS // chunks + (1 if i < HASH_BITS % chunks else 0) for i in range(chunks)]
+        self._chunks = []
+        shift = HASH_BITS
+        for width in widths:
+            shift -= width
+            self._chunks.append((shift, (1 << width) - 1))
+        self._tables = [{} for _ in self._chunks]
+        self.size = 0
+
+    def add(self, value):
+        self.size += 1
+        for (shift, mask), table in zip(self._chunks, self._tables):
+            bucket = table.get((value >> shift) & mask)
+            if bucket is None:
+                bucket = table[(value >> shift) & mask] = array('Q')
+            bucket.append(value)
+
+    def query(self, value, radius=None):
+        """
+        Args:
+            value (int): Hash to look up
+            radius (int, optional): Largest distance to report, at most
+                the radius the index was built for
+
+        Returns:
+            list: (distance, hash) pairs within the radius
+        """
+        radius = self.radius if radius is None else min(radius, self.radius)
+        found = {}
+        probe = np.uint64(value)
+        for (shift, mask), table in zip(self._chunks, self._tables):
+            bucket = table.get((value >> shift) & mask)
+            if not bucket:
+                continue
+            candidates = np.frombuffer(bucket, dtype=np.uint64)
+            distances = np.bitwise_count(candidates ^ probe)
+            for index in np.flatnonzero(distances <= radius):
+                found[int(candidates[index])] = int(distances[index])
+        return [(distance, match) for match, distance in found.items()]
+
+    def __len__(self):
+        return self.size
+
+
+class NearDuplicateFilter:
+    """
+    Remembers the hashes of images already kept and flags new images
+    within max_distance of any of them.
+    """
+
+    def __init__(self, max_distance=4, method='dhash', index='mih'):
+        """
+        Args:
+            max_distance (int): Largest Hamming distance that counts as a duplicate
+            method (str): 'dhash' or 'phash'
+            index (str): 'mih' (multi-index hash) or 'bktree'
+        """
+        if method not in HASHES:
+            raise ValueError(f"Unknown hash method: {method}")
+        if not 0 <= max_distance < HASH_BITS:
+            raise ValueError(f"max_distance must be between 0 and {HASH_BITS - 1}, got {max_distance}")
+        self.max_distance = max_distance
+        self.hash_batch = HASHES[method]
+        if index == 'mih':
+            self.index = MultiIndexHash(max_distance)
+        elif index == 'bktree':
+            self.index = BKTree()
+        else:
+            raise ValueError(f"Unknown index type: {index}")
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def check_and_add(self, value):
+        """
+        Args:
+            value (int): Hash of a new image
+
+        Returns:
+            bool: True if it is a near duplicate (and was not added)
+        """
+        with self._lock:
+            if self.index.query(value, self.max_distance):
+                self.dropped += 1
+                return True
+            self.index.add(value)
+            return False
+
+    def filter_batch(self, images):
+        """
+        Args:
+            images (np.ndarray): Grayscale batch, shape (N, H, W)
+
+        Returns:
+            list: One bool per image, True for near duplicates
+        """
+        return [self.check_and_add(value) for value in self.hash_batch(images)]
+
+    def is_duplicate_image(self, image_file_object):
+        """
+        Args:
+            image_file_object: A PIL.Image.Image, e.g. the padded image
+                from functions.resize_and_pad_image
+
+        Returns:
+            bool: True if it is a near duplicate
+        """
+        gray = np.asarray(image_file_object.convert('L'))
+        return self.filter_batch(gray[None, :, :])[0]
+
+if __name__ == "__main__":
+    print('radius guard')
+    for radius in [-1, HASH_BITS]:
+        try:
+            MultiIndexHash(radius)
+        except ValueError as e:
+            print(f'rejected: {e}')
+        else:
+            raise AssertionError(f'radius {radius} was accepted')
+    for radius in [0, HASH_BITS - 1]:
+        index = MultiIndexHash(radius)
+        index.add(0)
+        assert index.query(0) == [(0, 0)]
+        print(f'radius {radius} ok')
@@ -0,0 +1,249 @@
+##############################################
+# Staged pipeline engine shared by main.py,  #
+# move-to-uploads.py, run_extract.py and the #
+# functions.py preprocessing driver.         #
+# Stages run in their own threads, joined by #
+# bounded queues.                            #
+##############################################
+
+import queue
+import threading
+import time
+from collections import Counter
+
+_END = object()
+
+
+class Job:
+    """
+    One unit of work as a whole, e.g. an archive, tracked while its
+    pieces move through the stages.
+
+    Every value in flight holds a reference on its job. A stage
+    releases the value it took once it is handled, after taking
+    references for the values it passed on, so the count reaches zero
+    exactly when nothing from the job is left in the pipeline. on_done
+    then runs once, in whichever thread let go last.
+
+    Stages may hang their own state on the job (workspace, lease, ...).
+    """
+
+    def __init__(self, key, on_done=None):
+        """
+        Args:
+            key (str): Name of the job, e.g. the archive key
+            on_done (callable, optional): Called with the job when finished
+        """
+        self.key = key
+        self.on_done = on_done
+        self.failed = False
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def hold(self):
+        with self._lock:
+            self._pending += 1
+
+    def release(self):
+        with self._lock:
+            self._pending -= 1
+            finished = self._pending == 0
+        if finished and self.on_done is not None:
+            try:
+                self.on_done(self)
+            except Exception as e:
+                print(f'Error finishing {self.key}: {e}')
+
+
+class Stage:
+    """
+    One step of a pipeline.
+
+    A plain stage calls func(job, value, emit) for each value, where
+    emit(value) passes a value on to the next stage under the same job;
+    it may emit any number of values. A batch stage (batch_size set)
+    calls func(batch) with up to batch_size (job, value) pairs that are
+    already waiting, and passes on the pairs it returns.
+    """
+
+    def __init__(self, name, func, workers=1, batch_size=None, queue_size=None):
+        """
+        Args:
+            name (str): Stage name, used by hooks and in the stats
+            func (callable): The work, see above
+            workers (int): Threads running this stage
+            batch_size (int, optional): Make this a batch stage
+            queue_size (int, optional): Bound of the stage's input queue,
+                defaults to the pipeline's queue_size
+        """
+        self.name = name
+        self.func = func
+        self.workers = max(1, workers)
+        self.batch_size = batch_size
+        self.queue_size = queue_size
+
+
+class Pipeline:
+    """
+    Runs a source and a chain of stages until everything has drained.
+
+    The source is an iterable of (job, value) pairs and runs in its own
+    thread. Each stage reads from a bounded queue, so a slow stage holds
+    the ones before it back instead of letting work pile up in memory.
+    A value that raises is dropped and its job marked failed.
+    """
+
+    def __init__(self, source, stages, hooks=(), queue_size=64, source_name='source'):
+        """
+        Args:
+            source (iterable): Yields (job, value) pairs
+            stages (list): Stage objects, in order
+            hooks (list): Callables taking (stage name, values) and returning
+                a context manager that wraps each call into a stage,
+                e.g. profile_hook(profiler)
+            queue_size (int): Default bound of each stage's input queue
+            source_name (str): Stage name the source reports to the hooks
+        """
+        self.source = source
+        self.stages = [stage for stage in stages if stage is not None]
+        self.hooks = list(hooks)
+        self.source_name = source_name
+        self._queues = [queue.Queue(maxsize=stage.queue_size or queue_size) for stage in self.stages]
+        self._running = [stage.workers for stage in self.stages]
+        self._lock = threading.Lock()
+        self.counts = Counter()   # (stage name, 'in' / 'out' / 'failed') -> values
+        self.seconds = Counter()  # stage name -> seconds spent in its func
+
+    def _call(self, name, values, func, *args):
+        start = time.perf_counter()
+        contexts = [hook(name, values) for hook in self.hooks]
+        for context in contexts:
+            context.__enter__()
+        try:
+            return func(*args)
+        finally:
+            for context in reversed(contexts):
+                context.__exit__(None, None, None)
+            with self._lock:
+                self.seconds[name] += time.perf_counter() - start
+
+    def _put(self, index, job, value):
+        """ Hand a value to stage index, or drop it after the last stage. """
+        with self._lock:
+            self.counts[(self.stages[index - 1].name if index else self.source_name, 'out')] += 1
+        if index == len(self.stages):
+            return
+        job.hold()
+        self._queues[index].put((job, value))
+
+    def _run_source(self):
+        iterator = iter(self.source)
+        try:
+            while True:
+                try:
+                    job, value = self._call(self.source_name, None, next, iterator)
+                except StopIteration:
+                    break
+                self._put(0, job, value)
+        except Exception as e:
+            print(f'Error in {self.source_name}, no more work will be read: {e}')
+        finally:
+            if self.stages:
+                for _ in range(self.stages[0].workers):
+                    self._queues[0].put(_END)
+
+    def _take(self, index):
+        """ The next value, or the next batch of waiting values, for stage index. """
+        stage = self.stages[index]
+        first = self._queues[index].get()
+        if first is _END or not stage.batch_size:
+            return first, first is _END
+        batch = [first]
+        while len(batch) < stage.batch_size:
+            try:
+                item = self._queues[index].get_nowait()
+            except queue.Empty:
+                break
+            if item is _END:
+                return batch, True
+            batch.append(item)
+        return batch, False
+
+    def _run_stage(self, index):
+        stage = self.stages[index]
+        while True:
+            taken, ended = self._take(index)
+            if taken is not _END:
+                items = taken if stage.batch_size else [taken]
+                with self._lock:
+                    self.counts[(stage.name, 'in')] += len(items)
+                try:
+                    if stage.batch_size:
+                        for job, value in self._call(stage.name, items, stage.func, items):
+                            self._put(index + 1, job, value)
+                    else:
+                        job, value = taken
+                        emit = lambda new_value, job=job: self._put(index + 1, job, new_value)
+                        self._call(stage.name, items, stage.func, job, value, emit)
+                except Exception as e:
+                    print(f'Error in {stage.name}: {e}')
+                    with self._lock:
+                        self.counts[(stage.name, 'failed')] += len(items)
+                    for job, _ in items:
+                        job.failed = True
+                for job, _ in items:
+                    job.release()
+            if ended:
+                break
+        with self._lock:
+            self._running[index] -= 1
+            last = self._running[index] == 0
+        if last and index + 1 < len(self.stages):
+            for _ in range(self.stages[index + 1].workers):
+                self._queues[index + 1].put(_END)
+
+    def run(self):
+        """
+        Run until the source is exhausted and every stage has drained.
+
+        Returns:
+            Counter: (stage name, 'in' / 'out' / 'failed') -> number of values
+        """
+        threads = [threading.Thread(target=self._run_source, name=self.source_name, daemon=True)]
+        for index, stage in enumerate(self.stages):
+            for worker in range(stage.workers):
+                threads.append(threading.Thread(
+                    target=self._run_stage, args=(index,), name=f'{stage.name}-{worker}', daemon=True))
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return self.counts
+
+    def summary(self):
+        """ Print values in / out and busy time per stage. """
+        print('Pipeline:')
+        for name in [self.source_name] + [stage.name for stage in self.stages]:
+            print(f"  {name:<12} in {self.counts[(name, 'in')]:>8}  out {self.counts[(name, 'out')]:>8}"
+                  f"  failed {self.counts[(name, 'failed')]:>6}  {self.seconds[name]:10.2f}s")
+
+
+def profile_hook(profiler):
+    """ Hook reporting each stage to a profiling.StageProfiler. """
+    def hook(name, values):
+        return profiler.stage(name)
+    return hook
+
+
+def single_job(key, values, on_done=None):
+    """
+    Source giving every value to one job, for a pipeline over one
+    directory or one list of files.
+    """
+    job = Job(key, on_done)
+    job.hold()
+    try:
+        for value in values:
+            yield job, value
+    finally:
+        job.release()
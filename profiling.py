@@ -0,0 +1,212 @@
+##############################################
+# Per-stage profiling for main.py and the    #
+# functions.py preprocessing driver.         #
+# Writes pstats files and collapsed stacks   #
+# for flamegraph.pl / speedscope.            #
+##############################################
+
+import os
+import sys
+import time
+import random
+import pstats
+import cProfile
+import threading
+from collections import Counter, defaultdict
+from contextlib import contextmanager, nullcontext
+
+
+class StageProfiler:
+    """
+    Profiles named pipeline stages (extract, traverse, upload, ...).
+
+    Two kinds of data are kept per stage:
+      - cProfile data, one Profile per stage and thread, merged on dump.
+      - Stack samples taken every `interval` seconds from every thread that
+        is inside a stage, labelled with that stage. Sampling costs almost
+        nothing while threads sit in C code (zlib, lzma, sockets).
+    """
+
+    def __init__(self, interval=0.01, use_cprofile=True):
+        """
+        Args:
+            interval (float): Seconds between stack samples
+            use_cprofile (bool): Also collect deterministic cProfile data
+        """
+        self.interval = interval
+        self.use_cprofile = use_cprofile
+        self.samples = Counter()
+        self.seconds = defaultdict(float)
+        self.calls = Counter()
+        self._profiles = {}    # (stage, thread id) -> cProfile.Profile
+        self._stacks = {}      # thread id -> [(stage, profile or None), ...]
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        """ Start the background stack sampler. """
+        if self._sampler is None:
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample_loop, name='stage-profiler', daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        """ Stop the background stack sampler. """
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+
+    def _profile_for(self, name, thread_id):
+        key = (name, thread_id)
+        with self._lock:
+            profile = self._profiles.get(key)
+            if profile is None:
+                profile = self._profiles[key] = cProfile.Profile()
+        return profile
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Attribute everything run inside the block to a stage.
+
+        Stages may nest; the innermost stage owns the time, and the outer
+        stage's cProfile is paused while an inner one runs.
+
+        Args:
+            name (str): Stage name, e.g. 'extract'
+        """
+        thread_id = threading.get_ident()
+        stack = self._stacks.setdefault(thread_id, [])
+        outer = stack[-1][1] if stack else None
+        profile = None
+        if self.use_cprofile:
+            if outer is not None:
+                outer.disable()
+            profile = self._profile_for(name, thread_id)
+            try:
+                profile.enable()
+            except ValueError:
+                # another profiler already holds the interpreter hook
+                # (Python 3.12+ allows one at a time); keep the samples
+                profile = None
+        stack.append((name, profile))
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            if profile is not None:
+                profile.disable()
+            stack.pop()
+            if outer is not None:
+                outer.enable()
+            with self._lock:
+                self.seconds[name] += elapsed
+                self.calls[name] += 1
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            frames = sys._current_frames()
+            for thread_id, stack in list(self._stacks.items()):
+                if not stack:
+                    continue
+                frame = frames.get(thread_id)
+                if frame is None:
+                    continue
+                names = []
+                while frame is not None:
+                    code = frame.f_code
+                    names.append(f'{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})')
+                    frame = frame.f_back
+                names.append(stack[-1][0])
+                self.samples[';'.join(reversed(names))] += 1
+
+    def dump(self, prefix):
+        """
+        Write the collected data.
+
+        Files written:
+            <prefix>.<stage>.pstats  cProfile data for each stage
+            <prefix>.collapsed       "stage;frame;frame count" lines
+
+        Args:
+            prefix (str): Path prefix for the output files
+
+        Returns:
+            list: The paths written
+        """
+        directory = os.path.dirname(prefix)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        written = []
+
+        by_stage = defaultdict(list)
+        with self._lock:
+            for (name, _), profile in self._profiles.items():
+                by_stage[name].append(profile)
+        for name, profiles in by_stage.items():
+            try:
+                stats = pstats.Stats(profiles[0])
+            except TypeError:
+                continue # never enabled, nothing recorded
+            for profile in profiles[1:]:
+                try:
+                    stats.add(profile)
+                except TypeError:
+                    pass
+            path = f'{prefix}.{name}.pstats'
+            stats.dump_stats(path)
+            written.append(path)
+
+        path = f'{prefix}.collapsed'
+        with open(path, 'w') as collapsed:
+            for stack, count in self.samples.most_common():
+                collapsed.write(f'{stack} {count}\n')
+        written.append(path)
+        return written
+
+    def summary(self):
+        """ Print wall time per stage. """
+        print('Stage profile:')
+        for name, seconds in sorted(self.seconds.items(), key=lambda x: -x[1]):
+            print(f'  {name:<12} {seconds:10.2f}s  {self.calls[name]:>8} calls')
+
+
+def make_profiler(enabled, rate=1.0, interval=0.01, use_cprofile=True):
+    """
+    Build a profiler for this run, or None.
+
+    Args:
+        enabled (bool): The --profile flag
+        rate (float): Fraction of runs to profile, so it can stay switched
+            on in production and only cost anything on a sample of runs
+        interval (float): Seconds between stack samples
+        use_cprofile (bool): Also collect cProfile data
+
+    Returns:
+        StageProfiler: A started profiler, or None if this run is not profiled
+    """
+    if not enabled or random.random() >= rate:
+        return None
+    profiler = StageProfiler(interval=interval, use_cprofile=use_cprofile)
+    profiler.start()
+    return profiler
+
+
+def stage(profiler, name):
+    """ profiler.stage(name), or a no-op when there is no profiler. """
+    if profiler is None:
+        return nullcontext()
+    return profiler.stage(name)
+
+
+def finish(profiler, prefix):
+    """ Stop the profiler and write its output, if there is one. """
+    if profiler is None:
+        return
+    profiler.stop()
+    profiler.summary()
+    for path in profiler.dump(prefix):
+        print(f'Profile written to: {path}')
@@ -4,12 +4,22 @@
 # To upload.                                 #
 ##############################################
 
+import os
+import math
 import random
 import string
+import hashlib
+import threading
+from key_layout import list_parallel
+
+CHARACTERS = string.ascii_letters + string.digits
+NAME_LENGTH = 7
+_BYTE_TO_CHAR = bytes(ord(CHARACTERS[b % len(CHARACTERS)]) for b in range(256))
+_REJECTED_BYTES = bytes(range(4 * len(CHARACTERS), 256))
 
 def random_name():
-    characters = string.ascii_letters + string.digits
-    array = [random.choice(characters) for i in range(7)]
+    characters = CHARACTERS
+    array = [random.choice(characters) for i in range(NAME_LENGTH)]
     return ''.join(array)
 
 def rename(file_name):
@@ -21,6 +31,105 @@ def rename(file_name):
         new_name = random_name() + f'.{ext}'
         return new_name
 
+class BloomFilter():
+    """ Set membership in a fixed bit array.
+    Never misses a name that was added, and
+    rarely (error_rate) reports one that wasn't.
+    """
+    def __init__(self, capacity, error_rate=0.001):
+        """
+        @capacity number of names expected to be added.
+        @error_rate false positive rate at that capacity.
+        """
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, item):
+        # Double hashing: k positions from one 128 bit digest
+        digest = hashlib.blake2b(item.encode(), digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.size for i in range(self.hashes)]
+
+    def add(self, item):
+        for position in self._positions(item):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, item):
+        return all(
+            self.bits[position >> 3] & (1 << (position & 7))
+            for position in self._positions(item))
+
+    def add_if_absent(self, item):
+        """ Add an item, and report whether it looked new. """
+        new = False
+        bits = self.bits
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not bits[position >> 3] & mask:
+                bits[position >> 3] |= mask
+                new = True
+        return new
+
+class NameAllocator():
+    """ Hands out random names that have not been used yet.
+    Names are cut from one os.urandom draw per batch. A Bloom filter
+    seeded with the names already under upload/ rules
+    out collisions without asking S3 about each one.
+    """
+    def __init__(self, existing=(), capacity=1_000_000, error_rate=0.001, batch_size=4096):
+        """
+        @existing names (without extension) already in use.
+        @capacity names the filter is sized for, including new ones.
+        @error_rate chance a free name is skipped as taken.
+        @batch_size names generated per refill.
+        """
+        existing = list(existing)
+        self.seen = BloomFilter(max(capacity, 2 * len(existing)), error_rate)
+        for name in existing:
+            self.seen.add(name)
+        self.batch_size = batch_size
+        self._batch = []
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_bucket(cls, s3access, prefix='upload/', layout=None, **kwargs):
+        """ Seed the allocator from a listing of the upload prefix.
+        With a key_layout.KeyLayout its sub-prefixes are listed in parallel.
+        """
+        if layout is not None:
+            keys = [x['Key'] for x in list_parallel(s3access, layout)]
+        else:
+            keys = [x['Key'] for x in s3access.list_objects(prefix=prefix)]
+        names = [key.split('/')[-1].split('.')[0] for key in keys]
+        print(f'Seeded name allocator with {len(names)} existing names')
+        return cls(existing=names, **kwargs)
+
+    def _refill(self):
+        # 248 = 4 * 62, so dropping bytes >= 248 keeps the draw uniform
+        raw = os.urandom(NAME_LENGTH * self.batch_size * 256 // 240)
+        chars = raw.translate(_BYTE_TO_CHAR, _REJECTED_BYTES).decode('ascii')
+        for i in range(0, len(chars) - NAME_LENGTH + 1, NAME_LENGTH):
+            name = chars[i:i + NAME_LENGTH]
+            if self.seen.add_if_absent(name):
+                self._batch.append(name)
+
+    def random_name(self):
+        with self._lock:
+            while not self._batch:
+                self._refill()
+            return self._batch.pop()
+
+    def rename(self, file_name):
+        """ Same contract as rename(), with a name that is not taken. """
+        ext = file_name.split('.')[-1]
+        if ext not in ['jpg','png','jpeg']:
+            print('not an image file!')
+            return None
+        else:
+            return self.random_name() + f'.{ext}'
+
 if __name__ == "__main__":
     print('here are some randoms')
     for i in range(4):
@@ -35,4 +144,9 @@ if __name__ == "__main__":
     ]
 
     for name in files:
-        print(rename(name))
\ No newline at end of file
+        print(rename(name))
+
+    print('now from an allocator')
+    allocator = NameAllocator(existing=[random_name() for i in range(1000)])
+    for name in files:
+        print(allocator.rename(name))
\ No newline at end of file
@@ -0,0 +1,202 @@
+##############################################
+# Memory, descriptor, disk and I/O peaks per #
+# pipeline stage and per archive, so an OOM  #
+# can be traced to the stage that caused it  #
+# and instances sized from real numbers.     #
+##############################################
+
+import os
+import json
+import time
+import threading
+import tracemalloc
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+import psutil
+
+# sampled fields, kept as peaks
+PEAK_FIELDS = ['rss', 'fds', 'filesystem_used']
+# process I/O counters, kept as totals per stage
+IO_FIELDS = ['read_bytes', 'write_bytes', 'read_chars', 'write_chars']
+
+
+class ResourceMonitor:
+    """
+    Samples the process every `interval` seconds, and whenever a stage call
+    ends, and charges each sample to the stages and archives in flight.
+
+    RSS, open descriptors and the used space on the filesystem the
+    workspace is on are kept as peaks. That is the whole filesystem, not
+    the workspace folder alone: summing the folder on every sample would
+    cost more than it tells. I/O counters are process-wide, so a stage is charged
+    what the process read and wrote while one of its calls was running;
+    with stages overlapping, the same bytes are counted for each of them.
+
+    With trace_memory, tracemalloc runs too. When a stage call ends, the
+    peak of Python allocations since the previous call (of any stage)
+    ended is charged to its stage, and the top allocation sites are kept
+    whenever the stage's peak is beaten.
+    """
+
+    def __init__(self, workspace=None, interval=0.5, trace_memory=False, top=10):
+        """
+        Args:
+            workspace (str, optional): Folder whose filesystem usage is sampled
+            interval (float): Seconds between background samples
+            trace_memory (bool): Also trace Python allocations (slower)
+            top (int): Allocation sites kept per stage with trace_memory
+        """
+        self.workspace = workspace
+        self.interval = interval
+        self.trace_memory = trace_memory
+        self.top = top
+        self.process = psutil.Process()
+        self.stages = defaultdict(Counter)    # stage -> field -> peak or total
+        self.archives = defaultdict(Counter)  # archive key -> field -> peak
+        self.run = Counter()
+        self.allocations = {}                 # stage -> top allocation sites
+        self._active_stages = Counter()
+        self._active_jobs = Counter()
+        self._last_sample = 0.0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._sampler = None
+
+    def start(self):
+        """ Start sampling in the background. """
+        if self.trace_memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+        if self._sampler is None:
+            self._stop.clear()
+            self._sampler = threading.Thread(target=self._sample_loop, name='resource-monitor', daemon=True)
+            self._sampler.start()
+
+    def stop(self):
+        """ Stop sampling (and tracing). """
+        if self._sampler is not None:
+            self._stop.set()
+            self._sampler.join()
+            self._sampler = None
+        self.sample()
+        if self.trace_memory and tracemalloc.is_tracing():
+            tracemalloc.stop()
+
+    def _sample_loop(self):
+        while not self._stop.wait(self.interval):
+            self.sample()
+
+    def _io(self):
+        try:
+            counters = self.process.io_counters()
+        except (psutil.Error, AttributeError):
+            # not every platform has them (macOS)
+            return Counter()
+        return Counter({field: getattr(counters, field, 0) for field in IO_FIELDS})
+
+    def sample(self):
+        """ Take one sample and charge it to everything in flight. """
+        try:
+            values = {'rss': self.process.memory_info().rss,
+                      'fds': self.process.num_fds() if hasattr(self.process, 'num_fds')
+                      else self.process.num_handles()}
+            if self.workspace and os.path.exists(self.workspace):
+                values['filesystem_used'] = psutil.disk_usage(self.workspace).used
+        except psutil.Error as e:
+            print(f'Could not sample resources: {e}')
+            return
+        with self._lock:
+            self._last_sample = time.monotonic()
+            targets = [self.run]
+            targets += [self.stages[stage] for stage in self._active_stages]
+            targets += [self.archives[key] for key in self._active_jobs]
+            for target in targets:
+                for field in PEAK_FIELDS:
+                    if field in values and values[field] > target[field]:
+                        target[field] = values[field]
+
+    def hook(self, name, values):
+        """ Pipeline hook: pass as Pipeline(..., hooks=[monitor.hook]). """
+        keys = [job.key for job, _ in values] if values else []
+        return self._track(name, keys)
+
+    @contextmanager
+    def _track(self, stage, keys):
+        with self._lock:
+            self._active_stages[stage] += 1
+            for key in keys:
+                self._active_jobs[key] += 1
+        io_before = self._io()
+        try:
+            yield
+        finally:
+            # calls much shorter than the interval would otherwise go unseen
+            if time.monotonic() - self._last_sample > self.interval / 10:
+                self.sample()
+            io_after = self._io()
+            with self._lock:
+                for field in IO_FIELDS:
+                    self.stages[stage][field] += io_after[field] - io_before[field]
+                self._active_stages[stage] -= 1
+                if not self._active_stages[stage]:
+                    del self._active_stages[stage]
+                for key in keys:
+                    self._active_jobs[key] -= 1
+                    if not self._active_jobs[key]:
+                        del self._active_jobs[key]
+            if self.trace_memory and tracemalloc.is_tracing():
+                self._trace(stage)
+
+    def _trace(self, stage):
+        with self._lock:
+            # tracemalloc has one peak for the process, restart it per call
+            current, peak = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            if peak <= self.stages[stage]['traced_peak']:
+                return
+            self.stages[stage]['traced_peak'] = peak
+        snapshot = tracemalloc.take_snapshot()
+        sites = [{'site': str(stat.traceback), 'bytes': stat.size, 'count': stat.count}
+                 for stat in snapshot.statistics('lineno')[:self.top]]
+        with self._lock:
+            self.allocations[stage] = sites
+
+    def summary(self):
+        """
+        Returns:
+            dict: {'run': {...}, 'stages': {stage: {...}},
+                   'archives': {key: {...}}, 'allocations': {stage: [...]}}
+        """
+        with self._lock:
+            return {
+                'run': dict(self.run),
+                'stages': {stage: dict(fields) for stage, fields in self.stages.items()},
+                'archives': {key: dict(fields) for key, fields in self.archives.items()},
+                'allocations': dict(self.allocations),
+            }
+
+    def report(self, path=None, archives=5):
+        """
+        Print the peaks per stage and the archives with the highest RSS,
+        and write the whole summary as JSON to path if given.
+        """
+        summary = self.summary()
+        mb = 1024 * 1024
+        print(f"Resources: peak RSS {summary['run'].get('rss', 0) / mb:.0f} MB, "
+              f"{summary['run'].get('fds', 0)} descriptors")
+        for stage, fields in summary['stages'].items():
+            print(f"  {stage:<12} RSS {fields.get('rss', 0) / mb:8.0f} MB"
+                  f"  fds {fields.get('fds', 0):>5}"
+                  f"  read {fields.get('read_chars', 0) / mb:9.0f} MB"
+                  f"  written {fields.get('write_chars', 0) / mb:9.0f} MB"
+                  + (f"  traced {fields['traced_peak'] / mb:6.0f} MB" if 'traced_peak' in fields else ''))
+        largest = sorted(summary['archives'].items(), key=lambda item: item[1].get('rss', 0), reverse=True)
+        for key, fields in largest[:archives]:
+            print(f"  {key}: RSS {fields.get('rss', 0) / mb:.0f} MB, workspace filesystem "
+                  f"{fields.get('filesystem_used', 0) / mb:.0f} MB used")
+        if path:
+            directory = os.path.dirname(os.path.abspath(path))
+            os.makedirs(directory, exist_ok=True)
+            with open(path, 'w') as summary_file:
+                json.dump(summary, summary_file, indent=2)
+            print(f'Resource summary written to {path}')
+        return summary
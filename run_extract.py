@@ -6,13 +6,92 @@ import os
 import re
 import uuid
 from randomizer import rename
+from profiling import stage
+from pipeline import Stage, profile_hook
 from s3_access import S3Access
+from local_access import LocalAccess
+from key_layout import KeyLayout
+from catalog import file_digest
+from extraction_limits import ExtractionLimitExceeded
 import extractors # for edge case of zips within zips
 
 class ArchiveTraverse():
-    def __init__(self, local=False, test=True):
+    def __init__(self, local=False, test=True, workers=1,
+                 name_allocator=None, conditional_writes=False,
+                 upload_workers=1, s3access=None, profiler=None,
+                 near_duplicates=None, hash_side=64,
+                 local_root='root/results', shard_writer=None,
+                 key_layout=None, catalog=None, manifest=None):
+        """
+        @local store under local_root instead of s3
+          (unless s3access is given).
+        @name_allocator a randomizer.NameAllocator to draw
+          collision-free names from. Defaults to randomizer.rename.
+        @conditional_writes only create keys that don't exist
+          yet, drawing a new name if one is taken.
+        @upload_workers threads uploading files at once.
+        @s3access the S3Access to upload through. One is
+          made for S3_BUCKET_NAME on first use if not given.
+        @profiler a profiling.StageProfiler to report
+          the traverse and upload stages to.
+        @near_duplicates a near_duplicates.NearDuplicateFilter.
+          Images close to one already uploaded are dropped.
+        @hash_side side of the padded image that is hashed.
+        @local_root folder laid out like the bucket,
+          files land in local_root/upload/.
+        @shard_writer a shard_sink.TarShardWriter. Images
+          are packed into its tar shards instead of
+          being stored one object each.
+        @key_layout a key_layout.KeyLayout placing each
+          name under upload/. Defaults to flat upload/<name>.
+        @catalog a catalog.MemberCatalog getting a row
+          for every file stored.
+        @manifest a manifest.ManifestWriter listing
+          every file stored.
+        """
         self.local = local
         self.test = test
+        self.workers = workers
+        self.name_allocator = name_allocator
+        self.conditional_writes = conditional_writes
+        self.upload_workers = max(1, upload_workers)
+        self.s3access = s3access
+        self.profiler = profiler
+        self.near_duplicates = near_duplicates
+        self.hash_side = hash_side
+        self.local_root = local_root
+        self.shard_writer = shard_writer
+        self.key_layout = key_layout or KeyLayout()
+        self.catalog = catalog
+        self.manifest = manifest
+
+    def rename(self, file_name):
+        if self.name_allocator is not None:
+            return self.name_allocator.rename(file_name)
+        return rename(file_name)
+
+    def upload(self, s3access, r_name, file_tuple):
+        """ Store one file under upload/, at the
+        key the layout gives its name.
+        With conditional writes a taken name
+        is swapped for a fresh one and retried.
+        Returns (name, key) once stored, else None.
+        """
+        if not self.conditional_writes:
+            key = self.key_layout.key(r_name)
+            if s3access.put_file(key, file_tuple[0]):
+                return r_name, key
+            return None
+        for _ in range(3):
+            key = self.key_layout.key(r_name)
+            stored = s3access.put_file(key, file_tuple[0], if_absent=True)
+            if stored:
+                return r_name, key
+            if stored is None:
+                return None
+            r_name = self.rename(file_tuple[1])
+            print(f'{file_tuple[1]} retrying as {r_name}')
+        return None
 
     @staticmethod
     def detect_archive(path):
@@ -35,27 +114,44 @@ class ArchiveTraverse():
             normalized_ext = '.tar'
         if normalized_ext in [
             '.gz','.bz2','.xz','.tgz','.tbz2','.txz','.tar',
-            '.rar','.7z','zip']:
+            '.rar','.7z','.zip']:
             return True
         else:
             return False
 
     @staticmethod
-    def extract_to_stack(job_root, archive_file):
+    def is_image(file_name):
+        """ True for the image types we upload """
+        return file_name.split('.')[-1] in ['jpeg','jpg','png']
+
+    @classmethod
+    def is_wanted(cls, member_name):
+        """ Archive members worth extracting:
+        images, and archives that may hold images.
+        """
+        return cls.is_image(member_name) or cls.detect_archive(member_name)
+
+    @staticmethod
+    def extract_to_stack(job_root, archive_file, workers=1, budget=None):
         """ This handles the case of a Zip file 
         Found within the Zip Files...
         @job_root this is found in the Traverse function.
           Intended to extract the contents of the zip
           file to a new folder there.
+        @workers threads the extractor may use.
+        @budget ExtractionBudget of the archive it was found in,
+          the nested archive is checked against it too.
         """
         save_point = os.path.join(job_root, str(uuid.uuid4()))
         print('Extracting a nested acrhive!')
-        extractor = extractors.get_extractor(archive_file)
+        if budget is not None:
+            budget = budget.nested(archive_file, os.path.getsize(archive_file))
+        extractor = extractors.get_extractor(archive_file, workers=workers, budget=budget)
         extractor.extract(
             archive_path=archive_file, 
             destination_path=save_point)
 
-        return save_point # will be added to stack
+        return save_point, budget # will be added to stack
 
     @staticmethod
     def get_file_name(path):
@@ -107,48 +203,167 @@ class ArchiveTraverse():
 
         return result_list
 
-    def traverse_path(self, directory):
-        """ Just get the files and list them """
-        extraction_root = directory
-        print(f'Extraction root for this task = ${extraction_root}')
-        folder_stack = [directory]
-        all_files = []
-
+    def walk(self, directory, extraction_root, emit, budget=None, prefix=''):
+        """ Pass on every file under directory as a
+        (path, filename, member) tuple, unpacking nested
+        archives under extraction_root as they are found.
+        member is the file's path inside the archive
+        directory was extracted from, after prefix;
+        files of nested archives get the nested
+        archive's member path as their prefix.
+        budget is the ExtractionBudget of the archive
+        directory was extracted from, if any.
+        """
+        folder_stack = [(directory, budget, directory, prefix)]
         while folder_stack:
-            current_folder = folder_stack.pop()
+            current_folder, folder_budget, root, folder_prefix = folder_stack.pop()
             contents = self.list_directory_contents(current_folder)
             for item in contents:
                 if item[1]: # if is folder
-                    folder_stack.append(item[0])
+                    folder_stack.append((item[0], folder_budget, root, folder_prefix))
                 else:
-                    # handle two cases:
-                    # If Compressed, extract to folder and
-                    # palce folder in folder_stack
-                    if self.detect_archive(item[0]):
-                        msg = f'{item[0]} is a an archive! Extracting under ${current_folder}'
-                        folder = self.extract_to_stack(extraction_root, item[0])
-                        folder_stack.append(folder)
-                    # Is not .jpg, .png, or .jpeg, continue
-                    else:
-                        file_name = self.get_file_name(item[0])
-                        if file_name.split('.')[1] in ['jpeg','jpg','png']:
-                            all_files.append((item[0],file_name))
-        for file_tuple in all_files:
-            """ file_tuple = (path, filename) """
-            bucket = os.environ.get('S3_BUCKET_NAME')
+                    self.walk_file(item[0], extraction_root, emit, folder_stack, folder_budget,
+                                   root, folder_prefix)
+
+    def walk_file(self, path, extraction_root, emit, folder_stack=None, budget=None,
+                  root=None, prefix=''):
+        """ One file: a nested archive is extracted and
+        its folder walked (or pushed onto folder_stack),
+        anything else is passed on.
+        root is the folder its archive was extracted to,
+        extraction_root if not given.
+        """
+        member = prefix + os.path.relpath(path, root or extraction_root).replace(os.sep, '/')
+        if self.detect_archive(path):
+            print(f'{path} is an archive! Extracting under {extraction_root}')
             try:
-                with open(file_tuple[0], 'rb') as file_object:
-                    r_name = rename(file_tuple[1])
-                    if self.test:
-                        sub = 'dry run only'
-                    else:
-                        sub = f'storing to s3: {bucket}'
-                    msg = f'{file_tuple[1]} becomes {r_name} - {sub}'
-                    print(msg)
-                    if self.test == False and r_name is not None:
-                        key = f'upload/{r_name}'
-                        s3access = S3Access(bucket)
-                        s3access.put_object(key, file_object)
+                with stage(self.profiler, 'extract'):
+                    folder, budget = self.extract_to_stack(extraction_root, path, self.workers, budget)
+            except ExtractionLimitExceeded:
+                raise
             except Exception as e:
-                print(file_tuple)
-                print(e)
+                # a bad archive inside a good one stays bad, so failing the
+                # outer job would only retry (and re-upload) it forever
+                print(f'Error: could not extract nested archive {member}, skipping it. {e}')
+                return
+            # named after the nested archive, not its random folder
+            if folder_stack is None:
+                self.walk(folder, extraction_root, emit, budget, member + '/')
+            else:
+                folder_stack.append((folder, budget, folder, member + '/'))
+        else:
+            emit((path, self.get_file_name(path), member))
+
+    def classify(self, job, file_tuple, emit):
+        """ Keep only the image types we upload. """
+        if self.is_image(file_tuple[1]):
+            emit(file_tuple)
+
+    def dedupe(self, batch):
+        """ Batch stage dropping near-duplicate images. """
+        kept = set(id(file_tuple) for file_tuple in
+                   self.drop_near_duplicates([file_tuple for _, file_tuple in batch]))
+        return [(job, file_tuple) for job, file_tuple in batch if id(file_tuple) in kept]
+
+    def sink(self, job, file_tuple, emit):
+        stored = self.upload_file(file_tuple)
+        if stored is None or (self.catalog is None and self.manifest is None):
+            return
+        member = file_tuple[2] if len(file_tuple) > 2 else file_tuple[0]
+        # hashed once for both
+        size, sha256 = file_digest(file_tuple[0])
+        name, key = stored
+        if self.catalog is not None:
+            self.catalog.add_file(job.key, member, file_tuple[0], name, key, size, sha256)
+        if self.manifest is not None and key: # nothing stored on a dry run
+            self.manifest.add(key, name, job.key, member, size, sha256.hex())
+
+    def hooks(self):
+        """ Pipeline hooks for this traverse's profiler. """
+        return [profile_hook(self.profiler)] if self.profiler is not None else []
+
+    def stages(self):
+        """ The classify, dedupe and upload stages, to run
+        after whatever produces (path, filename, member) tuples.
+        """
+        return [
+            Stage('classify', self.classify),
+            Stage('dedupe', self.dedupe, batch_size=256) if self.near_duplicates is not None else None,
+            Stage('upload', self.sink, workers=self.upload_workers),
+        ]
+
+    def load_for_hash(self, path):
+        """ The padded grayscale image the hash is taken from,
+        or None if the file can't be read as an image.
+        """
+        # PIL and numpy are only needed with near_duplicates set
+        import numpy as np
+        from PIL import Image
+        from functions import resize_and_pad_image
+        try:
+            with Image.open(path) as image:
+                # JPEG can decode straight to a reduced size
+                image.draft('L', (self.hash_side, self.hash_side))
+                padded = resize_and_pad_image(image, self.hash_side)
+            if padded is None:
+                return None
+            return np.asarray(padded.convert('L'))
+        except Exception as e:
+            print(f'Could not hash {path}: {e}')
+            return None
+
+    def drop_near_duplicates(self, all_files, batch_size=256):
+        """ Remove near-duplicate images from a list of
+        (path, filename) tuples, hashing in batches.
+        Unreadable files are kept, the upload decides.
+        """
+        import numpy as np
+        kept = []
+        for start in range(0, len(all_files), batch_size):
+            batch = all_files[start:start + batch_size]
+            arrays = [self.load_for_hash(file_tuple[0]) for file_tuple in batch]
+            readable = [i for i, array in enumerate(arrays) if array is not None]
+            duplicate = [False] * len(batch)
+            if readable:
+                flags = self.near_duplicates.filter_batch(np.stack([arrays[i] for i in readable]))
+                for i, flag in zip(readable, flags):
+                    duplicate[i] = flag
+            for file_tuple, flag in zip(batch, duplicate):
+                if flag:
+                    print(f'{file_tuple[1]} is a near duplicate, skipping')
+                else:
+                    kept.append(file_tuple)
+        return kept
+
+    def upload_file(self, file_tuple):
+        """ file_tuple = (path, filename, member)
+        Returns (name, key) of the stored file, with
+        the shard's key for shards and '' on a dry run,
+        or None if it was not stored.
+        """
+        try:
+            if self.s3access is None and not self.test:
+                if self.local:
+                    self.s3access = LocalAccess(self.local_root)
+                else:
+                    self.s3access = S3Access(os.environ.get('S3_BUCKET_NAME'))
+            r_name = self.rename(file_tuple[1])
+            if self.test:
+                sub = 'dry run only'
+            elif self.shard_writer is not None:
+                sub = f'packing into {self.shard_writer.prefix}'
+            else:
+                sub = f'storing to {self.s3access.bucket_name}'
+            msg = f'{file_tuple[1]} becomes {r_name} - {sub}'
+            print(msg)
+            if r_name is None:
+                return None
+            if self.test:
+                return r_name, ''
+            if self.shard_writer is not None:
+                return r_name, self.shard_writer.add(file_tuple[0], r_name)
+            return self.upload(self.s3access, r_name, file_tuple)
+        except Exception as e:
+            print(file_tuple)
+            print(e)
+            return None
@@ -1,20 +1,104 @@
-import boto3
+import io
 import random
+import threading
+from collections import OrderedDict
 from botocore.exceptions import ClientError
+from throttle import is_throttle_error, is_throttle_response
+
+_client = None
+_client_pool_size = 0
+_client_lock = threading.Lock()
+# set by _record_throttle when an attempt of this thread's call was throttled
+_attempts = threading.local()
+
+
+def _record_throttle(response=None, **kwargs):
+    """
+    needs-retry handler noting a throttled attempt, which adaptive retries
+    would otherwise hide. Retries of resets, timeouts and 500s are not
+    throttling and are not noted. Returns None, so retrying is unchanged.
+    """
+    if response is not None and is_throttle_response(response[1]):
+        _attempts.throttled = True
+
+
+def get_s3_client(max_pool_connections=None):
+    """
+    Get the process-wide S3 client, creating it on first use.
+
+    boto3 clients are thread-safe once built, so every S3Access and
+    every worker thread shares this one and its connection pool.
+    Retries use botocore's adaptive mode, which rate limits the client
+    when S3 answers SlowDown.
+
+    Args:
+        max_pool_connections (int, optional): Pooled connections wanted,
+            usually the worker count. The client is rebuilt if a larger
+            pool is asked for than the current one has.
+
+    Returns:
+        botocore.client.S3: The shared client
+    """
+    global _client, _client_pool_size
+    # boto3 takes a while to import, leave it until s3 is used
+    import boto3
+    from botocore.config import Config
+    wanted = max(10, max_pool_connections or 0)
+    with _client_lock:
+        if _client is None or wanted > _client_pool_size:
+            config = Config(
+                max_pool_connections=wanted,
+                retries={'mode': 'adaptive', 'max_attempts': 10},
+            )
+            # boto3.client() on the default session is not thread-safe,
+            # which is one more reason to build it here under the lock
+            _client = boto3.client('s3', config=config)
+            _client.meta.events.register('needs-retry.s3', _record_throttle)
+            _client_pool_size = wanted
+        return _client
 
 
 class S3Access:
     """S3 access class for managing S3 bucket operations."""
 
-    def __init__(self, bucket_name):
+    def __init__(self, bucket_name, controller=None):
         """
         Initialize S3Access with a bucket name.
 
         @Args:
             bucket_name (str): Name of the S3 bucket to connect to
+            controller (AIMDController, optional): Limits concurrent
+                object requests and backs off when S3 throttles
         """
         self.bucket_name = bucket_name
-        self.s3_client = boto3.client('s3')
+        self.s3_client = get_s3_client()
+        self.controller = controller
+
+    def _call(self, operation, **params):
+        """
+        Run one client call, reporting its latency and any throttling
+        to the controller when there is one.
+
+        Args:
+            operation (str): Client method name, e.g. 'put_object'
+            **params: Arguments for the client method
+
+        Returns:
+            dict: The client response
+        """
+        method = getattr(self.s3_client, operation)
+        if self.controller is None:
+            return method(**params)
+        with self.controller.request() as request:
+            _attempts.throttled = False
+            try:
+                response = method(**params)
+            except ClientError as e:
+                request.throttled = is_throttle_error(e) or _attempts.throttled
+                raise
+            # a call that succeeded after retries may still have been throttled
+            request.throttled = _attempts.throttled
+            return response
 
     def get_root_sources(self):
         """ Gets everything from root """
@@ -42,6 +126,36 @@ class S3Access:
         keys = [x['Key'] for x in keys if x['Key'][-1] != "/"]
         return random.sample(keys, k=size)
 
+    def list_objects(self, prefix='_compressed', start_after=None):
+        """
+        List every object under a prefix, following continuation tokens.
+
+        Args:
+            prefix (str): Key prefix to list under
+            start_after (str, optional): Only return keys that sort after
+                this one. Defaults to None (list from the start)
+
+        Returns:
+            list: Dicts with the Key, ETag, LastModified and Size of each object
+        """
+        params = {'Bucket': self.bucket_name, 'Prefix': prefix}
+        if start_after:
+            params['StartAfter'] = start_after
+        objects = []
+        try:
+            paginator = self.s3_client.get_paginator('list_objects_v2')
+            for page in paginator.paginate(**params):
+                for obj in page.get('Contents', []):
+                    objects.append({
+                        'Key': obj['Key'],
+                        'ETag': obj['ETag'],
+                        'LastModified': obj['LastModified'],
+                        'Size': obj['Size'],
+                    })
+        except ClientError as e:
+            print(f"Error listing {prefix}: {e}")
+        return objects
+
     def list_sources(self):
         """
         List all objects in the sources folder of the S3 bucket.
@@ -85,14 +199,16 @@ class S3Access:
                 'Key': current_key
             }
 
-            self.s3_client.copy_object(
+            self._call(
+                'copy_object',
                 Bucket=self.bucket_name,
                 CopySource=copy_source,
                 Key=new_key
             )
 
             # Delete the original object
-            self.s3_client.delete_object(
+            self._call(
+                'delete_object',
                 Bucket=self.bucket_name,
                 Key=current_key
             )
@@ -116,7 +232,8 @@ class S3Access:
             bool: True if successful, False otherwise
         """
         try:
-            self.s3_client.put_object(
+            self._call(
+                'put_object',
                 Bucket=self.bucket_name,
                 Key=key,
                 Body=file_object
@@ -129,6 +246,110 @@ class S3Access:
             print(f"Error uploading object to {key}: {e}")
             return False
 
+    def put_object_if_absent(self, key, file_object):
+        """
+        Upload a file object only if nothing is stored under the key yet,
+        using a conditional write (If-None-Match: *).
+
+        Args:
+            key (str): Key name for the S3 object
+            file_object: File-like object to upload (must support read())
+
+        Returns:
+            bool: True if uploaded, False if the key already exists,
+                  None on any other error
+        """
+        try:
+            self._call(
+                'put_object',
+                Bucket=self.bucket_name,
+                Key=key,
+                Body=file_object,
+                IfNoneMatch='*'
+            )
+
+            print(f"Successfully uploaded object to {key}")
+            return True
+
+        except ClientError as e:
+            if e.response['Error']['Code'] in ('PreconditionFailed', '412'):
+                print(f"Object {key} already exists, not overwritten")
+                return False
+            print(f"Error uploading object to {key}: {e}")
+            return None
+
+    def put_file(self, key, source_path, if_absent=False):
+        """
+        Upload a file from disk.
+
+        Args:
+            key (str): Key name for the S3 object
+            source_path (str): The file to upload
+            if_absent (bool): Only create the key, see put_object_if_absent
+
+        Returns:
+            bool: True if uploaded, False if not (or, with if_absent, if the
+                  key already exists), None on any other error with if_absent
+        """
+        with open(source_path, 'rb') as file_object:
+            if if_absent:
+                return self.put_object_if_absent(key, file_object)
+            return self.put_object(key, file_object)
+
+    def put_object_conditional(self, key, body, if_match=None, if_none_match=None):
+        """
+        Upload an object only if the stored object still matches, so two
+        writers racing on the same key cannot both win.
+
+        Args:
+            key (str): Key name for the S3 object
+            body (bytes): Content to upload
+            if_match (str, optional): ETag the current object must have
+            if_none_match (str, optional): '*' to only create the key
+
+        Returns:
+            str: The new object's ETag if written, False if the condition
+                 failed, None on any other error
+        """
+        params = {'Bucket': self.bucket_name, 'Key': key, 'Body': body}
+        if if_match is not None:
+            params['IfMatch'] = if_match
+        if if_none_match is not None:
+            params['IfNoneMatch'] = if_none_match
+        try:
+            response = self._call('put_object', **params)
+            return response['ETag']
+
+        except ClientError as e:
+            # 409 ConditionalRequestConflict: another conditional write won the race
+            if e.response['Error']['Code'] in ('PreconditionFailed', '412', 'ConditionalRequestConflict'):
+                return False
+            print(f"Error writing object {key}: {e}")
+            return None
+
+    def get_object_with_etag(self, key):
+        """
+        Get an object's content together with its ETag.
+
+        Args:
+            key (str): Key name of the S3 object to retrieve
+
+        Returns:
+            tuple: (bytes, ETag), or (None, None) if missing or error
+        """
+        try:
+            response = self._call(
+                'get_object',
+                Bucket=self.bucket_name,
+                Key=key
+            )
+            return response['Body'].read(), response['ETag']
+
+        except ClientError as e:
+            if e.response['Error']['Code'] not in ('NoSuchKey', '404'):
+                print(f"Error retrieving object {key}: {e}")
+            return None, None
+
     def get_object(self, key):
         """
         Get an object from S3 with the specified key.
@@ -140,7 +361,8 @@ class S3Access:
             bytes: File content as bytes, or None if error
         """
         try:
-            response = self.s3_client.get_object(
+            response = self._call(
+                'get_object',
                 Bucket=self.bucket_name,
                 Key=key
             )
@@ -153,6 +375,76 @@ class S3Access:
             print(f"Error retrieving object {key}: {e}")
             return None
 
+    def get_object_stream(self, key):
+        """
+        Open an object in S3 for sequential reading without buffering it.
+
+        Args:
+            key (str): Key name of the S3 object to retrieve
+
+        Returns:
+            StreamingBody: The response body to read from, or None if error
+        """
+        try:
+            response = self._call(
+                'get_object',
+                Bucket=self.bucket_name,
+                Key=key
+            )
+            print(f"Streaming object {key}")
+            return response['Body']
+
+        except ClientError as e:
+            print(f"Error retrieving object {key}: {e}")
+            return None
+
+    def get_object_range(self, key, start, end):
+        """
+        Get a byte range of an object from S3.
+
+        Args:
+            key (str): Key name of the S3 object to read
+            start (int): First byte to fetch
+            end (int): Last byte to fetch (inclusive)
+
+        Returns:
+            bytes: The requested bytes, or None if error
+        """
+        try:
+            response = self._call(
+                'get_object',
+                Bucket=self.bucket_name,
+                Key=key,
+                Range=f'bytes={start}-{end}'
+            )
+            return response['Body'].read()
+
+        except ClientError as e:
+            print(f"Error retrieving bytes {start}-{end} of {key}: {e}")
+            return None
+
+    def get_object_size(self, key):
+        """
+        Get the size of an object in S3.
+
+        Args:
+            key (str): Key name of the S3 object
+
+        Returns:
+            int: Size in bytes, or None if error
+        """
+        try:
+            response = self._call(
+                'head_object',
+                Bucket=self.bucket_name,
+                Key=key
+            )
+            return response['ContentLength']
+
+        except ClientError as e:
+            print(f"Error checking size of {key}: {e}")
+            return None
+
     def object_exists(self, key):
         """
         Check if an object exists in S3 with the specified key.
@@ -164,7 +456,8 @@ class S3Access:
             bool: True if object exists, False otherwise
         """
         try:
-            self.s3_client.head_object(
+            self._call(
+                'head_object',
                 Bucket=self.bucket_name,
                 Key=key
             )
@@ -188,7 +481,8 @@ class S3Access:
             bool: True if successful, False otherwise
         """
         try:
-            self.s3_client.delete_object(
+            self._call(
+                'delete_object',
                 Bucket=self.bucket_name,
                 Key=key
             )
@@ -199,3 +493,129 @@ class S3Access:
         except ClientError as e:
             print(f"Error deleting object {key}: {e}")
             return False
+
+
+class S3RangedFile(io.RawIOBase):
+    """
+    Read-only, seekable file object over an S3 object.
+
+    Bytes are fetched lazily with ranged GETs in fixed-size blocks, and the
+    most recently read blocks are kept in memory. zipfile.ZipFile can read
+    the central directory from the tail and then only the members it needs.
+    """
+
+    def __init__(self, s3access, key, size=None, block_size=256 * 1024,
+                 cache_blocks=64, _cache=None):
+        """
+        @Args:
+            s3access (S3Access): Where to fetch the bytes from
+            key (str): Key name of the S3 object
+            size (int, optional): Object size, looked up with a HEAD if omitted
+            block_size (int): Bytes fetched per ranged GET
+            cache_blocks (int): Blocks kept in memory
+        """
+        super().__init__()
+        self.s3access = s3access
+        self.key = key
+        self.name = key
+        self.size = size if size is not None else s3access.get_object_size(key)
+        if self.size is None:
+            raise OSError(f"Cannot open {key}: size unknown")
+        self.block_size = block_size
+        self.cache_blocks = cache_blocks
+        self.position = 0
+        # shared between reopened handles, so threads reuse each other's reads
+        self._cache = _cache if _cache is not None else {
+            'blocks': OrderedDict(),
+            'lock': threading.Lock(),
+            'bytes_fetched': 0,
+            'requests': 0,
+        }
+
+    def reopen(self):
+        """ A new handle with its own position, sharing the block cache. """
+        return S3RangedFile(self.s3access, self.key, self.size, self.block_size,
+                            self.cache_blocks, _cache=self._cache)
+
+    @property
+    def bytes_fetched(self):
+        return self._cache['bytes_fetched']
+
+    @property
+    def requests(self):
+        return self._cache['requests']
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.position
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            position = offset
+        elif whence == io.SEEK_CUR:
+            position = self.position + offset
+        elif whence == io.SEEK_END:
+            position = self.size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if position < 0:
+            raise ValueError(f"Negative seek position {position}")
+        self.position = position
+        return self.position
+
+    def _fetch(self, start, end):
+        """ One ranged GET for bytes start..end-1. """
+        data = self.s3access.get_object_range(self.key, start, end - 1)
+        if data is None:
+            raise OSError(f"Failed to read bytes {start}-{end - 1} of {self.key}")
+        with self._cache['lock']:
+            self._cache['bytes_fetched'] += len(data)
+            self._cache['requests'] += 1
+        return data
+
+    def _block(self, index):
+        cache = self._cache
+        with cache['lock']:
+            data = cache['blocks'].get(index)
+            if data is not None:
+                cache['blocks'].move_to_end(index)
+                return data
+        start = index * self.block_size
+        data = self._fetch(start, min(start + self.block_size, self.size))
+        with cache['lock']:
+            cache['blocks'][index] = data
+            while len(cache['blocks']) > self.cache_blocks:
+                cache['blocks'].popitem(last=False)
+        return data
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        end = min(self.position + size, self.size)
+        if end <= self.position:
+            return b''
+        if end - self.position >= 2 * self.block_size:
+            # large member: one request for the span, not block by block
+            data = self._fetch(self.position, end)
+        else:
+            parts = []
+            for index in range(self.position // self.block_size, (end - 1) // self.block_size + 1):
+                block = self._block(index)
+                block_start = index * self.block_size
+                parts.append(block[max(self.position - block_start, 0):end - block_start])
+            data = b''.join(parts)
+        self.position = end
+        return data
+
+    def readall(self):
+        return self.read(-1)
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
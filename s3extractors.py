@@ -1,10 +1,11 @@
 import abc
+import io
 import zipfile
 import tarfile
 import os
 import shutil
-import rarfile
-import py7zr
+from concurrent.futures import ThreadPoolExecutor
+from extraction_limits import ExtractionLimitExceeded, GuardedZipFile, count_reads
 
 # --- Abstract Base Class ---
 
@@ -15,6 +16,18 @@ class ArchiveExtractor(abc.ABC):
     Defines the interface for all archive extractors.
     """
 
+    def __init__(self, workers: int = 1, budget=None):
+        """
+        Args:
+            workers (int): Number of threads to use for formats that can be
+                           extracted in parallel. Defaults to 1 (serial).
+            budget (ExtractionBudget, optional): Size, ratio and member limits.
+                           Going over one raises ExtractionLimitExceeded and
+                           removes what was extracted. Defaults to None (no limits).
+        """
+        self.workers = max(1, workers or 1)
+        self.budget = budget
+
     @abc.abstractmethod
     def extract(self, archive_object, archive_key: str, destination_path: str):
         """
@@ -34,6 +47,17 @@ class ArchiveExtractor(abc.ABC):
         """
         raise NotImplementedError("Subclasses must implement the 'extract' method.")
 
+    def _discard(self, destination_path: str, error):
+        """
+        Removes a partly extracted archive that went over its limits.
+
+        Args:
+            destination_path (str): The directory the archive was extracted to.
+            error (ExtractionLimitExceeded): The limit that was hit.
+        """
+        print(f"Error: {error}. Removing '{destination_path}'.")
+        shutil.rmtree(destination_path, ignore_errors=True)
+
     def _ensure_destination_path(self, destination_path: str):
         """
         Ensures the destination directory exists.
@@ -44,6 +68,28 @@ class ArchiveExtractor(abc.ABC):
         os.makedirs(destination_path, exist_ok=True)
         print(f"Ensured destination path: {destination_path}")
 
+    def _open_stream(self, archive_object):
+        """
+        Opens an independent read handle on the same archive data, so
+        parallel workers never share a file position.
+
+        Args:
+            archive_object: The seekable archive object passed to extract().
+
+        Returns:
+            A new file-like object positioned at the start of the archive.
+
+        Raises:
+            ValueError: If the archive object cannot be reopened.
+        """
+        if isinstance(archive_object, io.BytesIO):
+            # getvalue() hands back the shared buffer, so this does not copy
+            return io.BytesIO(archive_object.getvalue())
+        if hasattr(archive_object, 'reopen'):
+            # e.g. s3_access.S3RangedFile, which shares its block cache
+            return archive_object.reopen()
+        raise ValueError(f"Cannot open a parallel stream on {type(archive_object).__name__}")
+
 # --- Concrete Implementations ---
 
 class ZipExtractor(ArchiveExtractor):
@@ -51,13 +97,16 @@ class ZipExtractor(ArchiveExtractor):
     Concrete implementation for extracting .zip files.
     """
 
-    def extract(self, archive_object, archive_key: str, destination_path: str):
+    def extract(self, archive_object, archive_key: str, destination_path: str, member_filter=None):
         """
         Extracts the contents of a .zip file.
 
         Args:
             archive_path (str): The path to the .zip file.
             destination_path (str): The directory where contents will be extracted.
+            member_filter (callable, optional): Called with each member name; only
+                members it returns True for are extracted. On a ranged S3 source
+                the other members are never downloaded. Defaults to None (all).
 
         Raises:
             FileNotFoundError: If the .zip file does not exist.
@@ -68,15 +117,87 @@ class ZipExtractor(ArchiveExtractor):
         self._ensure_destination_path(destination_path)
 
         try:
-            with zipfile.ZipFile(archive_object, 'r') as zip_ref:
-                print(f"Extracting '{archive_key}' to '{destination_path}'...")
-                zip_ref.extractall(destination_path)
+            with GuardedZipFile(archive_object, 'r', budget=self.budget) as zip_ref:
+                members = zip_ref.infolist()
+                if member_filter is not None:
+                    members = [m for m in members if member_filter(m.filename)]
+                if self.budget is not None:
+                    self.budget.check_members([(m.filename, m.file_size, m.compress_size) for m in members])
+                if self.workers > 1 and len(members) > 1:
+                    print(f"Extracting '{archive_key}' to '{destination_path}' "
+                          f"({len(members)} members on {self.workers} threads)...")
+                    self._extract_parallel(archive_object, members, destination_path)
+                else:
+                    print(f"Extracting '{archive_key}' to '{destination_path}'...")
+                    zip_ref.extractall(destination_path, members=members)
                 print("Zip extraction complete.")
+        except ExtractionLimitExceeded as e:
+            self._discard(destination_path, e)
+            raise
         except zipfile.BadZipFile as e:
             print(f"Error: The file '{archive_key}' is not a valid zip file or is corrupted. {e}")
+            raise
 
         except Exception as e:
             print(f"An unexpected error occurred during zip extraction: {e}")
+            raise
+
+    def _extract_parallel(self, archive_object, members, destination_path):
+        """
+        Inflates the members on several threads. zlib releases the GIL while
+        decompressing, so the threads genuinely run side by side.
+
+        Args:
+            archive_object: The seekable archive object passed to extract().
+            members (list): The zipfile.ZipInfo entries to extract.
+            destination_path (str): The directory where contents will be extracted.
+        """
+        bins = self._partition_members(members, self.workers)
+        with ThreadPoolExecutor(max_workers=len(bins)) as pool:
+            futures = [
+                pool.submit(self._extract_members, archive_object, chunk, destination_path)
+                for chunk in bins
+            ]
+            for future in futures:
+                future.result() # re-raise worker errors here
+
+    @staticmethod
+    def _partition_members(members, count):
+        """
+        Splits the members into at most 'count' groups of similar compressed
+        size, largest members first.
+
+        Args:
+            members (list): The zipfile.ZipInfo entries to split.
+            count (int): The number of groups wanted.
+
+        Returns:
+            list: Non-empty lists of zipfile.ZipInfo entries.
+        """
+        bins = [[] for _ in range(min(count, len(members)))]
+        loads = [0] * len(bins)
+        for member in sorted(members, key=lambda m: m.compress_size, reverse=True):
+            lightest = loads.index(min(loads))
+            bins[lightest].append(member)
+            loads[lightest] += member.compress_size
+        return [chunk for chunk in bins if chunk]
+
+    def _extract_members(self, archive_object, members, destination_path):
+        """
+        Extracts a group of members through a ZipFile handle of its own.
+
+        Args:
+            archive_object: The seekable archive object passed to extract().
+            members (list): The zipfile.ZipInfo entries to extract.
+            destination_path (str): The directory where contents will be extracted.
+        """
+        with GuardedZipFile(self._open_stream(archive_object), 'r', budget=self.budget) as zip_ref:
+            for member in members:
+                try:
+                    zip_ref.extract(member, destination_path)
+                except FileExistsError:
+                    # another thread created the same parent directory first
+                    zip_ref.extract(member, destination_path)
 
 
 class TarExtractor(ArchiveExtractor):
@@ -84,6 +205,22 @@ class TarExtractor(ArchiveExtractor):
     Concrete implementation for extracting .tar, .tar.gz, .tar.bz2, etc. files.
     """
 
+    def _guarded(self, tar_ref):
+        """
+        Yields the members one at a time, counting each against the budget
+        before it is written. A tar member's size in its header is exactly
+        what gets written, so the check is made ahead of the bytes.
+
+        Args:
+            tar_ref (tarfile.TarFile): The archive being read.
+        """
+        for member in tar_ref:
+            if self.budget is not None:
+                self.budget.count_member(member.name)
+                if member.isfile():
+                    self.budget.add(member.size)
+            yield member
+
     def extract(self, archive_object, archive_key: str, destination_path: str):
         """
         Extracts the contents of a .tar (or compressed tar) file.
@@ -101,15 +238,59 @@ class TarExtractor(ArchiveExtractor):
 
         try:
             # tarfile automatically detects compression type (gz, bz2, xz)
-            with tarfile.open(archive_object, 'r:*') as tar_ref:
+            with tarfile.open(fileobj=archive_object, mode='r:*') as tar_ref:
                 print(f"Extracting '{archive_key}' to '{destination_path}'...")
-                tar_ref.extractall(destination_path)
+                tar_ref.extractall(destination_path, members=self._guarded(tar_ref))
                 print("Tar extraction complete.")
+        except ExtractionLimitExceeded as e:
+            self._discard(destination_path, e)
+            raise
         except tarfile.ReadError as e:
             print(f"Error: The file '{archive_key}' is not a valid tar file or is corrupted. {e}")
+            raise
 
         except Exception as e:
             print(f"An unexpected error occurred during tar extraction: {e}")
+            raise
+
+    def stream_extract(self, stream, archive_key: str, destination_path: str, on_member=None):
+        """
+        Extracts a .tar (or compressed tar) file while it is being read,
+        using tarfile's pipe mode. Nothing is buffered beyond the member
+        being written, so extraction starts with the first bytes received.
+
+        Args:
+            stream: A non-seekable readable stream, e.g. an S3 StreamingBody.
+            archive_key (str): The key of the archive, for messages.
+            destination_path (str): The directory where contents will be extracted.
+            on_member (callable, optional): Called with the path of each regular
+                file as soon as it has been written.
+
+        Raises:
+            tarfile.ReadError: If the stream is not a valid tar archive.
+            Exception: For other unexpected errors during extraction.
+        """
+        self._ensure_destination_path(destination_path)
+
+        try:
+            # 'r|*' reads forward only and detects gz, bz2 or xz
+            with tarfile.open(fileobj=stream, mode='r|*') as tar_ref:
+                print(f"Streaming '{archive_key}' to '{destination_path}'...")
+                for member in self._guarded(tar_ref):
+                    tar_ref.extract(member, destination_path)
+                    if member.isfile() and on_member is not None:
+                        on_member(os.path.join(destination_path, member.name))
+                print("Tar extraction complete.")
+        except ExtractionLimitExceeded as e:
+            self._discard(destination_path, e)
+            raise
+        except tarfile.ReadError as e:
+            print(f"Error: The file '{archive_key}' is not a valid tar file or is corrupted. {e}")
+            raise
+
+        except Exception as e:
+            print(f"An unexpected error occurred during tar extraction: {e}")
+            raise
 
 
 class SevenZExtractor(ArchiveExtractor):
@@ -133,24 +314,107 @@ class SevenZExtractor(ArchiveExtractor):
             py7zr.IncorrectPassword: If the provided password is incorrect.
             Exception: For other unexpected errors during extraction.
         """
+        import py7zr  # only loaded once a .7z archive turns up
         self._ensure_destination_path(destination_path)
 
         try:
             with py7zr.SevenZipFile(archive_object, mode='r', password=password) as szf:
-                print(f"Extracting '{archive_key}' to '{destination_path}'...")
-                szf.extractall(path=destination_path)
-                print("7z extraction complete.")
+                if self.budget is not None:
+                    # py7zr writes each member up to its size in the header and
+                    # no further, so checking the declared sizes bounds what is
+                    # written. Its progress callback runs on a thread of its own
+                    # and cannot stop the extraction, so nothing is counted live
+                    declared = [(f.filename, f.uncompressed or 0, None) for f in szf.files]
+                    self.budget.check_members(declared)
+                    self.budget.add(sum(size for _, size, _ in declared))
+                # py7zr only decodes blocks in parallel when it opens the file
+                # itself; on a file object it is serial, so split them here
+                blocks = self._independent_blocks(szf) if self.workers > 1 else []
+                if len(blocks) < 2:
+                    print(f"Extracting '{archive_key}' to '{destination_path}'...")
+                    szf.extractall(path=destination_path)
+            if len(blocks) >= 2:
+                print(f"Extracting '{archive_key}' to '{destination_path}' "
+                      f"({len(blocks)} blocks on {min(self.workers, len(blocks))} threads)...")
+                with ThreadPoolExecutor(max_workers=min(self.workers, len(blocks))) as pool:
+                    futures = [
+                        pool.submit(self._extract_block, archive_object, destination_path, password, targets)
+                        for targets in blocks
+                    ]
+                    for future in futures:
+                        future.result() # re-raise worker errors here
+            print("7z extraction complete.")
+        except ExtractionLimitExceeded as e:
+            self._discard(destination_path, e)
+            raise
         except py7zr.Bad7zFile as e:
             print(f"Error: The file '{archive_key}' is not a valid 7z file or is corrupted. {e}")
+            raise
 
         except py7zr.PasswordRequired as e:
             print(f"Error: The 7z archive '{archive_key}' is password-protected but no password was provided. {e}")
+            raise
 
         except py7zr.IncorrectPassword as e:
             print(f"Error: Incorrect password provided for '{archive_key}'. {e}")
+            raise
 
         except Exception as e:
             print(f"An unexpected error occurred during 7z extraction: {e}")
+            raise
+
+    @staticmethod
+    def _independent_blocks(szf):
+        """
+        Groups the archive members by the folder (solid block) that holds them.
+
+        Each folder is an independent compressed stream, so each group can be
+        decoded on its own worker. Members with no data (directories, empty
+        files) are attached to the first group.
+
+        Args:
+            szf (py7zr.SevenZipFile): An archive opened for reading.
+
+        Returns:
+            list: Lists of member names, largest block first. Empty when the
+                  archive cannot safely be split.
+        """
+        main_streams = szf.header.main_streams
+        if main_streams is None:
+            return []
+        names = [f.filename for f in szf.files]
+        if len(names) != len(set(names)):
+            # py7zr renames duplicated members by position; keep that serial
+            return []
+
+        blocks = []
+        for folder in main_streams.unpackinfo.folders:
+            if not folder.files:
+                continue
+            size = sum(f.uncompressed for f in folder.files)
+            blocks.append((size, [f.filename for f in folder.files]))
+        blocks.sort(key=lambda block: block[0], reverse=True)
+        blocks = [targets for _, targets in blocks]
+
+        empty = [f.filename for f in szf.files if f.emptystream]
+        if blocks and empty:
+            blocks[0].extend(empty)
+        return blocks
+
+    def _extract_block(self, archive_object, destination_path, password, targets):
+        """
+        Decodes a single block on its own stream.
+
+        Args:
+            archive_object: The seekable archive object passed to extract().
+            destination_path (str): The directory where contents will be extracted.
+            password (str): Password for encrypted 7z archives, or None.
+            targets (list): Names of the members stored in this block.
+        """
+        import py7zr
+        stream = self._open_stream(archive_object)
+        with py7zr.SevenZipFile(stream, mode='r', password=password) as szf:
+            szf.extract(path=destination_path, targets=targets)
 
 
 
@@ -175,6 +439,7 @@ class RarExtractor(ArchiveExtractor):
             rarfile.RarCannotExec: If the 'unrar' command-line tool is not found in the system's PATH.
             Exception: For other unexpected errors during extraction.
         """
+        import rarfile  # only loaded once a .rar archive turns up
 
         self._ensure_destination_path(destination_path)
 
@@ -182,32 +447,46 @@ class RarExtractor(ArchiveExtractor):
             with rarfile.RarFile(archive_object, 'r') as rf:
                 if password:
                     rf.setpassword(password) # Set password if provided
+                if self.budget is not None:
+                    declared = [(m.filename, m.file_size, m.compress_size) for m in rf.infolist()]
+                    self.budget.check_members(declared)
+                    # headers can understate sizes; count what is really read
+                    count_reads(rf, self.budget)
                 print(f"Extracting '{archive_key}' to '{destination_path}'...")
                 rf.extractall(destination_path)
                 print("RAR extraction complete.")
+        except ExtractionLimitExceeded as e:
+            self._discard(destination_path, e)
+            raise
         except rarfile.BadRarFile as e:
             print(f"Error: The file '{archive_key}' is not a valid RAR file or is corrupted. {e}")
+            raise
 
         except rarfile.RarKeyError as e:
             print(f"Error: Incorrect or missing password for '{archive_key}'. {e}")
+            raise
 
         except rarfile.RarCannotExec as e:
             print(f"Error: The 'unrar' command-line tool was not found. Please ensure it is installed and in your system's PATH. {e}")
+            raise
 
         except Exception as e:
             print(f"An unexpected error occurred during RAR extraction: {e}")
+            raise
 
 
 # --- Factory Function (Optional, for easy instantiation) ---
 
 # --- Factory Function (Optional, for easy instantiation) ---
 
-def get_extractor(file_path_or_name: str) -> ArchiveExtractor:
+def get_extractor(file_path_or_name: str, workers: int = 1, budget=None) -> ArchiveExtractor:
     """
     Factory function to get the appropriate extractor based on file extension.
 
     Args:
         file_path_or_name (str): The full file path or file name (e.g., "archive.zip", "/path/to/my/archive.tar.gz").
+        workers (int): Number of threads the extractor may use. Defaults to 1.
+        budget (ExtractionBudget, optional): Limits for this archive. Defaults to None.
 
     Returns:
         ArchiveExtractor: An instance of the concrete extractor class.
@@ -264,7 +543,7 @@ def get_extractor(file_path_or_name: str) -> ArchiveExtractor:
 
 
     if extractor_class:
-        return extractor_class()
+        return extractor_class(workers=workers, budget=budget)
     else:
         raise ValueError(f"No extractor found for file type: {file_path_or_name} (derived extension: {normalized_ext})")
 
@@ -0,0 +1,141 @@
+##############################################
+# Orders archives largest first, so the big  #
+# ones start early and no worker is left     #
+# finishing one huge archive on its own at   #
+# the end. Very large zips are split into    #
+# parts that different workers extract.      #
+##############################################
+
+import random
+import zipfile
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+
+GB = 1024 ** 3
+
+
+class ArchivePart(namedtuple('ArchivePart', 'key index count members size archive_size')):
+    """
+    One member range of a split zip.
+
+    Attributes:
+        key (str): The archive
+        index (int): Which part, from 0
+        count (int): How many parts the archive was split into
+        members (frozenset): Names of the members in this part
+        size (int): Uncompressed bytes in this part
+        archive_size (int): Size of the whole archive, so it can be opened
+            without looking its size up again
+    """
+
+
+def archive_key(value):
+    """ The archive key of a scheduled value, a key or an ArchivePart. """
+    return value.key if isinstance(value, ArchivePart) else value
+
+
+def _is_zip(key):
+    return key.lower().endswith('.zip')
+
+
+def _split(key, infos, archive_size, split_bytes):
+    """
+    Cut a zip's members into parts of about split_bytes uncompressed.
+
+    Members stay in the order they are stored, so each part reads one
+    stretch of the archive.
+    """
+    parts = [[]]
+    filled = 0
+    for info in sorted(infos, key=lambda info: info.header_offset):
+        if parts[-1] and filled + info.file_size > split_bytes:
+            parts.append([])
+            filled = 0
+        parts[-1].append(info)
+        filled += info.file_size
+    return [ArchivePart(key, index, len(parts), frozenset(info.filename for info in part),
+                        sum(info.file_size for info in part), archive_size)
+            for index, part in enumerate(parts)]
+
+
+def _size_class(size):
+    """ Powers of two: sizes within 2x of each other share a class. """
+    return max(int(size), 0).bit_length()
+
+
+def plan(keys, sizes, open_archive=None, headers=False, split_bytes=0, workers=16,
+         shuffle=False):
+    """
+    Order archives longest job first.
+
+    Archives are ranked by their uncompressed size, which is what
+    extraction time follows. It is read from the central directory of
+    the zips that are opened, and estimated for every other archive from
+    its listing size, scaled by how much the opened zips expanded. Zips
+    that unpack to more than split_bytes become several ArchivePart
+    values, one per member range.
+
+    Args:
+        keys (list): Archive keys
+        sizes (dict): Key -> size in bytes from the listing. Keys without
+            a size go last
+        open_archive (callable, optional): Key -> seekable file object,
+            e.g. an S3RangedFile. Needed for headers and split_bytes
+        headers (bool): Read the central directory of every zip
+        split_bytes (int): Split zips that unpack to more than this; 0
+            leaves every archive whole. Only zips of at least this size
+            in the listing are read for splitting, unless headers is set
+        workers (int): Central directories read at once
+        shuffle (bool): Order archives within each size class (sizes
+            within 2x) at random, so nodes sharing the work through
+            leases do not all start on the same archives
+
+    Returns:
+        list: Keys and ArchiveParts, largest first
+    """
+    def wanted(key):
+        if open_archive is None or not _is_zip(key):
+            return False
+        return headers or (split_bytes and sizes.get(key, 0) >= split_bytes)
+
+    def read(key):
+        try:
+            with open_archive(key) as archive_file, zipfile.ZipFile(archive_file) as zip_ref:
+                return key, [info for info in zip_ref.infolist() if not info.is_dir()]
+        except (OSError, zipfile.BadZipFile) as e:
+            print(f'Could not read the members of {key}, scheduling it whole: {e}')
+            return key, None
+
+    to_read = [key for key in keys if wanted(key)]
+    members = {}
+    if to_read:
+        with ThreadPoolExecutor(max_workers=max(1, min(workers, len(to_read)))) as pool:
+            members = dict(pool.map(read, to_read))
+
+    # listing sizes are compressed; scale them by what the opened zips
+    # unpacked to, so every archive is ranked in the same unit
+    opened = [key for key, infos in members.items() if infos is not None and sizes.get(key)]
+    compressed = sum(sizes[key] for key in opened)
+    ratio = sum(info.file_size for key in opened for info in members[key]) / compressed if compressed else 1.0
+
+    ranked = []
+    for key in keys:
+        infos = members.get(key)
+        if infos is None:
+            ranked.append((sizes[key] * ratio if key in sizes else -1, key))
+            continue
+        unpacked = sum(info.file_size for info in infos)
+        if split_bytes and unpacked > split_bytes:
+            parts = _split(key, infos, sizes.get(key), split_bytes)
+            print(f'Splitting {key} ({unpacked / GB:.1f} GB unpacked) into {len(parts)} parts')
+            ranked.extend((part.size, part) for part in parts)
+        else:
+            ranked.append((unpacked, key))
+    if shuffle:
+        # sort is stable, so the shuffle survives within each class
+        random.shuffle(ranked)
+        ranked.sort(key=lambda entry: _size_class(entry[0]), reverse=True)
+    else:
+        # sort is stable, so equal sizes keep the listing order
+        ranked.sort(key=lambda entry: entry[0], reverse=True)
+    return [value for _, value in ranked]
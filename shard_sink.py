@@ -0,0 +1,123 @@
+##############################################
+# Packs many small images into large tar     #
+# shards (WebDataset layout) so an upload is #
+# one PUT per shard instead of per image.    #
+##############################################
+
+import io
+import os
+import json
+import time
+import uuid
+import hashlib
+import tarfile
+import tempfile
+import threading
+
+
+class TarShardWriter:
+    """
+    Appends files to a local tar and uploads it once it passes
+    shard_bytes, together with an index of its members.
+
+    Each shard is <prefix><run>-<number>.tar, next to
+    <prefix><run>-<number>.json:
+
+        {"shard": "shards/....tar", "members": [
+            {"name": "Ab3dE9x.jpg", "offset": 512, "size": 30211,
+             "sha256": "..."}, ...]}
+
+    offset is where the member's bytes start in the tar, so a reader can
+    fetch one image with a single ranged GET. Member names are the random
+    upload names; WebDataset groups members by the name before the first dot.
+    """
+
+    def __init__(self, access, prefix='shards/', shard_bytes=256 * 1024 * 1024, workspace=None):
+        """
+        Args:
+            access (S3Access or LocalAccess): Where finished shards go
+            prefix (str): Key prefix of the shards and indexes
+            shard_bytes (int): Size at which a shard is closed and uploaded
+            workspace (str, optional): Folder for shards being written,
+                defaults to the system temp folder
+        """
+        self.access = access
+        self.prefix = prefix
+        self.shard_bytes = shard_bytes
+        self.workspace = workspace or tempfile.gettempdir()
+        # one run token per writer, so nodes writing at once never collide
+        self.run = f'{time.strftime("%Y%m%d")}-{uuid.uuid4().hex[:8]}'
+        self.shards = 0
+        self.members = 0
+        self._number = 0
+        self._lock = threading.Lock()
+        self._open()
+
+    def _open(self):
+        self._number += 1
+        self._name = f'{self.prefix}{self.run}-{self._number:06d}'
+        self._path = os.path.join(self.workspace, os.path.basename(self._name) + '.tar')
+        self._tar = tarfile.open(self._path, mode='w', format=tarfile.PAX_FORMAT)
+        self._index = []
+
+    def add(self, path, name):
+        """
+        Append one file to the current shard.
+
+        Args:
+            path (str): The file to add
+            name (str): Member name in the shard, e.g. the random upload name
+
+        Returns:
+            str: Key the shard holding it will be uploaded to
+        """
+        with open(path, 'rb') as file_object:
+            data = file_object.read()
+        info = tarfile.TarInfo(name)
+        info.size = len(data)
+        info.mtime = int(time.time())
+        digest = hashlib.sha256(data).hexdigest()
+        with self._lock:
+            # the data follows the header (longer for PAX names)
+            header = info.tobuf(self._tar.format, self._tar.encoding, self._tar.errors)
+            offset = self._tar.offset + len(header)
+            self._tar.addfile(info, io.BytesIO(data))
+            self._index.append({'name': name, 'offset': offset,
+                                'size': info.size, 'sha256': digest})
+            self.members += 1
+            shard_key = f'{self._name}.tar'
+            if self._tar.offset < self.shard_bytes:
+                return shard_key
+            finished = self._roll()
+        # upload outside the lock, other threads keep filling the next shard
+        self._upload(*finished)
+        return shard_key
+
+    def _roll(self):
+        self._tar.close()
+        finished = (self._name, self._path, self._index)
+        self._open()
+        return finished
+
+    def _upload(self, name, path, index):
+        if not index:
+            os.remove(path)
+            return
+        if self.access.put_file(f'{name}.tar', path):
+            body = json.dumps({'shard': f'{name}.tar', 'members': index}).encode()
+            self.access.put_object(f'{name}.json', io.BytesIO(body))
+            os.remove(path)
+            with self._lock:
+                self.shards += 1
+            print(f'Uploaded shard {name}.tar with {len(index)} images')
+        else:
+            # keep it on disk rather than lose the images
+            print(f'Shard {name}.tar was not uploaded, left at {path}')
+
+    def close(self):
+        """ Upload the last, partly filled shard. """
+        with self._lock:
+            self._tar.close()
+            finished = (self._name, self._path, self._index)
+        self._upload(*finished)
+        print(f'{self.members} images written to {self.shards} shards')
@@ -0,0 +1,299 @@
+##############################################
+# Archive stages for pipeline.Pipeline:      #
+# where archives come from, fetching them    #
+# and unpacking them. The classify, dedupe   #
+# and upload stages are on ArchiveTraverse.  #
+##############################################
+
+import io
+import os
+import re
+import uuid
+import shutil
+import threading
+import extractors
+import s3extractors
+from s3_access import S3RangedFile
+from run_extract import ArchiveTraverse
+from pipeline import Job
+from extraction_limits import ExtractionLimitExceeded
+from scheduler import ArchivePart
+
+
+def archive_source(keys, on_done=None, leases=None):
+    """
+    One job per archive.
+
+    Args:
+        keys (list): Archive keys or local paths, or scheduler.ArchivePart
+            values. The parts of a split archive share one job, which
+            finishes once every part has been through the pipeline
+        on_done (callable, optional): Called with each job once everything
+            from its archive has been through the pipeline
+        leases (LeaseManager, optional): The manager LeasedFetch takes
+            leases from. A job's lease is completed when the job finishes,
+            or released for another node if it failed.
+
+    Yields:
+        tuple: (Job, key or ArchivePart)
+    """
+    def finished(job):
+        try:
+            if on_done is not None:
+                on_done(job)
+        finally:
+            if leases is not None and job.lease is not None:
+                job.lease.done = not job.failed
+                leases.finish(job.lease)
+
+    split = {}  # key -> [job, parts not yet yielded]
+    try:
+        for value in keys:
+            part = value if isinstance(value, ArchivePart) else None
+            key = part.key if part else value
+            if part is not None and key in split:
+                job = split[key][0]
+            else:
+                job = Job(key, finished)
+                job.lease = None
+                job.skipped = False
+                if part is not None:
+                    # held until the last part is handed over
+                    job.hold()
+                    split[key] = [job, part.count]
+            yield job, value
+            if part is not None:
+                split[key][1] -= 1
+                if split[key][1] == 0:
+                    del split[key]
+                    job.release()
+    finally:
+        # stopped early: parts never handed over mean the archive is incomplete
+        for job, _ in split.values():
+            job.failed = True
+            job.release()
+
+
+class LeasedFetch:
+    """
+    Wraps a fetch stage so an archive is only fetched once this node holds
+    its lease. The lease is taken when a fetch worker gets to the archive,
+    not when it is queued, so a node never holds (and renews) leases on
+    archives still waiting in its queues, which the other nodes could be
+    working on.
+
+    An archive leased by another node, or already done, is dropped with
+    job.skipped set.
+    """
+
+    def __init__(self, fetch, leases):
+        """
+        Args:
+            fetch (callable): The fetch stage, S3Fetch or LocalFetch
+            leases (LeaseManager): Where leases are taken
+        """
+        self.fetch = fetch
+        self.leases = leases
+        self._lock = threading.Lock()
+
+    def __call__(self, job, value, emit):
+        with self._lock:
+            # the first part of a split archive to get here takes the lease
+            if job.lease is None and not job.skipped:
+                job.lease = self.leases.acquire(job.key)
+                if job.lease is None:
+                    job.skipped = True
+                    print(f'--{job.key} is leased by another node or done')
+        if job.skipped:
+            return
+        self.fetch(job, value, emit)
+
+
+def local_archives(directory):
+    """ Paths of the archives in a local folder. """
+    archives = []
+    for item in sorted(os.listdir(directory)):
+        if re.search(r'\.DS_Store$', item):
+            continue
+        archives.append(os.path.join(directory, item))
+    return archives
+
+
+def remove_workspace(job):
+    """ on_done helper: delete the folder the job was extracted to. """
+    workspace = getattr(job, 'workspace', None)
+    if workspace and os.path.exists(workspace):
+        shutil.rmtree(workspace)
+
+
+class S3Fetch:
+    """
+    Fetch stage: archive key or ArchivePart -> (kind, archive object, part)
+    for ExtractArchive. part is None for a whole archive.
+
+    Kinds:
+        'ranged'  zip read with ranged GETs, only the wanted members are fetched
+        'stream'  tar extracted while it downloads
+        'bytes'   anything else, downloaded whole
+    """
+
+    def __init__(self, s3access, full_download=False, stream_tar=False):
+        """
+        Args:
+            s3access (S3Access): Bucket holding the archives
+            full_download (bool): Download zips whole instead of ranged reads
+            stream_tar (bool): Stream tar archives
+        """
+        self.s3access = s3access
+        self.full_download = full_download
+        self.stream_tar = stream_tar
+
+    def __call__(self, job, value, emit):
+        part = value if isinstance(value, ArchivePart) else None
+        key = job.key
+        if key.lower().endswith('.zip') and not self.full_download:
+            # the central directory says where each member is,
+            # so only the members we keep are fetched
+            try:
+                emit(('ranged', S3RangedFile(self.s3access, key,
+                                             size=part.archive_size if part else None), part))
+            except OSError as e:
+                print(e)
+                job.failed = True
+            return
+        if self.stream_tar and isinstance(s3extractors.get_extractor(key), s3extractors.TarExtractor):
+            stream = self.s3access.get_object_stream(key)
+            if stream is None:
+                job.failed = True
+                return
+            emit(('stream', stream, part))
+            return
+        archive_object = self.s3access.get_object(key)
+        if archive_object is None:
+            job.failed = True
+            return
+        emit(('bytes', io.BytesIO(archive_object), part))
+
+
+class LocalFetch:
+    """
+    Fetch stage for archives already on disk: the archive is read in
+    place. Keys are paths under a LocalAccess root, or plain paths
+    (local_archives) when there is none.
+    """
+
+    def __init__(self, access=None):
+        """
+        Args:
+            access (LocalAccess, optional): Folder the keys are under
+        """
+        self.access = access
+
+    def __call__(self, job, value, emit):
+        path = self.access.path(job.key) if self.access is not None else job.key
+        emit(('path', path, value if isinstance(value, ArchivePart) else None))
+
+
+class ExtractArchive:
+    """
+    Extract stage: (kind, archive object, part) -> (path, filename, member) of
+    every file in the archive, nested archives included.
+
+    Each archive gets its own folder under workspace, kept on the job as
+    job.workspace. The parts of a split zip are extracted to subfolders
+    of it, and count against one shared budget.
+    """
+
+    def __init__(self, traverse, workspace, workers=1, limits=None):
+        """
+        Args:
+            traverse (ArchiveTraverse): Walks the extracted folder
+            workspace (str): Folder the archives are extracted under
+            workers (int): Threads each extractor may decode with
+            limits (ExtractionLimits, optional): Bounds on what one archive
+                may unpack to. An archive going over them is deleted from
+                the workspace and its job fails.
+        """
+        self.traverse = traverse
+        self.workspace = workspace
+        self.workers = workers
+        self.limits = limits
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def compressed_size(kind, archive_object):
+        """ Size of the archive as fetched, None when it is still streaming. """
+        if kind == 'path':
+            return os.path.getsize(archive_object)
+        if kind == 'ranged':
+            return archive_object.size
+        if kind == 'bytes':
+            return archive_object.getbuffer().nbytes
+        return None
+
+    def __call__(self, job, fetched, emit):
+        kind, archive_object, part = fetched
+        with self._lock:
+            # the first part of a split archive to get here sets these up
+            if getattr(job, 'workspace', None) is None:
+                job.workspace = os.path.join(self.workspace, str(uuid.uuid4()))
+                job.budget = None
+                if self.limits is not None:
+                    job.budget = self.limits.budget(job.key, self.compressed_size(kind, archive_object))
+        save_point = job.workspace
+        member_filter = None
+        if part is not None:
+            save_point = os.path.join(job.workspace, f'part-{part.index}')
+            member_filter = part.members.__contains__
+            print(f'--part {part.index + 1} of {part.count} of {job.key}, {len(part.members)} members')
+        try:
+            self.extract(job, kind, archive_object, save_point, job.budget, emit, member_filter)
+        except ExtractionLimitExceeded as e:
+            print(f'--{job.key} stopped: {e}')
+            shutil.rmtree(save_point, ignore_errors=True)
+            raise
+
+    def extract(self, job, kind, archive_object, save_point, budget, emit, member_filter=None):
+        if kind == 'path':
+            extractor = extractors.get_extractor(archive_object, workers=self.workers, budget=budget)
+            print(f'--extracting {job.key}')
+            if member_filter is None:
+                extractor.extract(archive_path=archive_object, destination_path=save_point)
+            else:
+                extractor.extract(archive_path=archive_object, destination_path=save_point,
+                                  member_filter=member_filter)
+        elif kind == 'stream':
+            extractor = s3extractors.get_extractor(job.key, workers=self.workers, budget=budget)
+            print(f'--streaming {job.key}')
+            # members go on as soon as they are written
+            try:
+                extractor.stream_extract(
+                    archive_object, job.key, save_point,
+                    on_member=lambda path: self.traverse.walk_file(path, save_point, emit,
+                                                                   budget=budget))
+            finally:
+                archive_object.close()
+            return
+        elif kind == 'ranged':
+            extractor = s3extractors.get_extractor(job.key, workers=self.workers, budget=budget)
+            print(f'--extracting {job.key} with ranged reads')
+            extractor.extract(archive_object=archive_object,
+                              archive_key=job.key,
+                              destination_path=save_point,
+                              member_filter=lambda name: ArchiveTraverse.is_wanted(name)
+                              and (member_filter is None or member_filter(name)))
+            print(f'--fetched {archive_object.bytes_fetched} of {archive_object.size} bytes '
+                  f'in {archive_object.requests} requests')
+        else:
+            extractor = s3extractors.get_extractor(job.key, workers=self.workers, budget=budget)
+            print(f'--extracting {job.key}')
+            if member_filter is None:
+                extractor.extract(archive_object=archive_object,
+                                  archive_key=job.key,
+                                  destination_path=save_point)
+            else:
+                extractor.extract(archive_object=archive_object,
+                                  archive_key=job.key,
+                                  destination_path=save_point,
+                                  member_filter=member_filter)
+        self.traverse.walk(save_point, save_point, emit, budget)
@@ -0,0 +1,203 @@
+##############################################
+# Member offset index for uncompressed tars, #
+# built in one streaming pass, so a single   #
+# image can be fetched from a huge tar with  #
+# one ranged GET instead of a full scan.     #
+##############################################
+
+import io
+import os
+import gzip
+import json
+import hashlib
+import tarfile
+import argparse
+
+INDEX_PREFIX = '_tar_index/'
+
+
+def index_key(key):
+    """ Key of the sidecar index for a tar, kept out of _compressed so it
+    is never listed as an archive. """
+    return f'{INDEX_PREFIX}{key}.json.gz'
+
+
+def build_index(access, key, chunk_size=1024 * 1024):
+    """
+    Read a tar once, start to end, and store where each member is.
+
+    The sidecar is gzipped JSON in the layout of the shard indexes
+    (shard_sink.TarShardWriter), with the header offset added:
+
+        {"tar": "_compressed/x.tar", "size": 1073741824, "members": [
+            {"name": "a/b.jpg", "header": 0, "offset": 512,
+             "size": 30211, "sha256": "..."}, ...]}
+
+    Args:
+        access (S3Access or LocalAccess): Where the tar is
+        key (str): The tar's key. It must not be compressed, a compressed
+            stream has no offsets to seek to
+        chunk_size (int): Bytes read at a time while hashing
+
+    Returns:
+        dict: The index, or None if the tar could not be read
+    """
+    if not key.lower().endswith('.tar'):
+        raise ValueError(f'{key} is not an uncompressed .tar, it cannot be read by offset')
+    stream = access.get_object_stream(key)
+    if stream is None:
+        return None
+    members = []
+    try:
+        # pipe mode reads straight through, nothing is seeked or buffered
+        with tarfile.open(fileobj=stream, mode='r|') as tar_ref:
+            for member in tar_ref:
+                if not member.isfile():
+                    continue
+                digest = hashlib.sha256()
+                member_file = tar_ref.extractfile(member)
+                for block in iter(lambda: member_file.read(chunk_size), b''):
+                    digest.update(block)
+                members.append({'name': member.name, 'header': member.offset,
+                                'offset': member.offset_data, 'size': member.size,
+                                'sha256': digest.hexdigest()})
+            size = tar_ref.offset
+    except tarfile.TarError as e:
+        print(f'Could not index {key}: {e}')
+        return None
+    finally:
+        stream.close()
+
+    index = {'tar': key, 'size': size, 'members': members}
+    body = gzip.compress(json.dumps(index, separators=(',', ':')).encode())
+    if not access.put_object(index_key(key), io.BytesIO(body)):
+        print(f'Could not store the index of {key}')
+        return None
+    print(f'Indexed {len(members)} members of {key} in {len(body)} bytes')
+    return index
+
+
+class TarMemberReader:
+    """
+    Reads single members of an indexed tar, or of a shard, with one ranged
+    GET each.
+    """
+
+    def __init__(self, access, key, index=None):
+        """
+        Args:
+            access (S3Access or LocalAccess): Where the tar is
+            key (str): The tar's key
+            index (dict, optional): Its index; loaded from the sidecar (or,
+                for a shard, from the .json next to it) if not given
+        """
+        self.access = access
+        self.key = key
+        self.index = index if index is not None else self._load()
+        if self.index is None:
+            raise FileNotFoundError(f'No index for {key}, build one with build_index')
+        self.members = {member['name']: member for member in self.index['members']}
+
+    def _load(self):
+        if self.access.object_exists(index_key(self.key)):
+            body = self.access.get_object(index_key(self.key))
+            if body is not None:
+                return json.loads(gzip.decompress(body))
+        # shards carry their own index next to them
+        shard_index = self.key[:-len('.tar')] + '.json'
+        if self.key.endswith('.tar') and self.access.object_exists(shard_index):
+            return json.loads(self.access.get_object(shard_index))
+        return None
+
+    def names(self):
+        return list(self.members)
+
+    def read(self, name, verify=True):
+        """
+        Fetch one member.
+
+        Args:
+            name (str): Member name as stored in the tar
+            verify (bool): Check the bytes against the indexed SHA-256,
+                which catches an index left over from an older tar
+
+        Returns:
+            bytes: The member's contents
+        """
+        member = self.members[name]
+        if member['size'] == 0:
+            return b''
+        data = self.access.get_object_range(self.key, member['offset'],
+                                            member['offset'] + member['size'] - 1)
+        if data is None or len(data) != member['size']:
+            raise OSError(f'Could not read {name} from {self.key}')
+        if verify and hashlib.sha256(data).hexdigest() != member['sha256']:
+            raise OSError(f'{name} in {self.key} does not match its index, rebuild the index')
+        return data
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Index uncompressed tars, or read single members from them"
+    )
+    parser.add_argument(
+        'command',
+        choices=['build', 'list', 'get'],
+        help='build: index the tars given (or every .tar \
+            in _compressed without one). list: member names. \
+            get: write one member to --out'
+    )
+    parser.add_argument(
+        'keys',
+        nargs='*',
+        help='tar keys; for get, the tar key then the member name'
+    )
+    parser.add_argument(
+        '--local-root',
+        default=None,
+        help='read a local folder laid out like the bucket \
+            instead of S3_BUCKET_NAME'
+    )
+    parser.add_argument(
+        '--rebuild',
+        action='store_true',
+        help='with build, index tars that already have an index'
+    )
+    parser.add_argument(
+        '--out',
+        default=None,
+        help='Default the member\'s file name. Where get writes to'
+    )
+    args = parser.parse_args()
+
+    if args.local_root:
+        from local_access import LocalAccess
+        access = LocalAccess(args.local_root)
+    else:
+        from s3_access import S3Access
+        access = S3Access(os.environ.get('S3_BUCKET_NAME'))
+
+    if args.command == 'build':
+        keys = args.keys or [x['Key'] for x in access.list_objects(prefix='_compressed')
+                             if x['Key'].lower().endswith('.tar')]
+        for key in keys:
+            if not args.rebuild and access.object_exists(index_key(key)):
+                print(f'{key} is already indexed')
+                continue
+            build_index(access, key)
+    elif args.command == 'list':
+        for key in args.keys:
+            for name in TarMemberReader(access, key).names():
+                print(name)
+    else:
+        if len(args.keys) != 2:
+            parser.error('get takes the tar key and the member name')
+        key, name = args.keys
+        data = TarMemberReader(access, key).read(name)
+        out = args.out or os.path.basename(name)
+        with open(out, 'wb') as out_file:
+            out_file.write(data)
+        print(f'Wrote {len(data)} bytes to {out}')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,145 @@
+##############################################
+# Adaptive concurrency for S3 requests.      #
+# Backs off when S3 throttles, ramps up      #
+# while latency holds steady.                #
+##############################################
+
+import time
+import threading
+from contextlib import contextmanager
+
+THROTTLE_CODES = {
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'ServiceUnavailable',
+    '503',
+}
+
+def is_throttle_error(error):
+    """
+    Check if a botocore ClientError means S3 asked us to slow down.
+
+    Args:
+        error (ClientError): The error raised by a client call
+
+    Returns:
+        bool: True for SlowDown / 503 style errors
+    """
+    return is_throttle_response(getattr(error, 'response', {}))
+
+
+def is_throttle_response(response):
+    """
+    Check if a parsed S3 response asks us to slow down.
+
+    Args:
+        response (dict): Parsed response, as in ClientError.response
+
+    Returns:
+        bool: True for SlowDown / 503 style errors
+    """
+    response = response or {}
+    code = response.get('Error', {}).get('Code', '')
+    status = response.get('ResponseMetadata', {}).get('HTTPStatusCode')
+    return code in THROTTLE_CODES or status == 503
+
+
+class _Request:
+    """ What the caller learned about one request. """
+    __slots__ = ('throttled',)
+
+    def __init__(self):
+        self.throttled = False
+
+
+class AIMDController:
+    """
+    Caps in-flight requests with additive increase / multiplicative decrease.
+
+    Every request that completes without throttling while latency stays
+    within latency_tolerance of the best latency seen adds roughly
+    increase / limit, so the limit grows by about `increase` per round
+    trip. A throttled request cuts the limit by `decrease`, at most once
+    per cooldown so one burst of SlowDowns counts as one signal.
+    """
+
+    def __init__(self, initial=8, minimum=1, maximum=64, increase=1.0,
+                 decrease=0.5, latency_tolerance=1.5, cooldown=1.0):
+        """
+        Args:
+            initial (int): Starting concurrency limit
+            minimum (int): Lowest the limit may fall to
+            maximum (int): Highest the limit may grow to, usually the worker count
+            increase (float): Additive step per round trip of successes
+            decrease (float): Factor applied to the limit when throttled
+            latency_tolerance (float): How far above the baseline latency
+                may drift before the limit stops growing
+            cooldown (float): Seconds between two decreases
+        """
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = float(min(max(initial, self.minimum), self.maximum))
+        self.increase = increase
+        self.decrease = decrease
+        self.latency_tolerance = latency_tolerance
+        self.cooldown = cooldown
+        self.in_flight = 0
+        self.latency = None   # moving average of request latency
+        self.baseline = None  # best moving average since the last decrease
+        self.throttled = 0
+        self._last_decrease = 0.0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        """ Block until a request slot is free. """
+        with self._condition:
+            while self.in_flight >= int(self.limit):
+                self._condition.wait()
+            self.in_flight += 1
+
+    def release(self, latency, throttled=False):
+        """
+        Free a slot and adjust the limit.
+
+        Args:
+            latency (float): Seconds the request took
+            throttled (bool): True if S3 throttled or retried the request
+        """
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                self.throttled += 1
+                now = time.monotonic()
+                if now - self._last_decrease >= self.cooldown:
+                    self._last_decrease = now
+                    self.limit = max(self.minimum, self.limit * self.decrease)
+                    self.baseline = self.latency
+                    print(f'S3 throttled, concurrency limit now {int(self.limit)}')
+            else:
+                if self.latency is None:
+                    self.latency = latency
+                else:
+                    self.latency = 0.9 * self.latency + 0.1 * latency
+                if self.baseline is None or self.latency < self.baseline:
+                    self.baseline = self.latency
+                if self.latency <= self.baseline * self.latency_tolerance:
+                    self.limit = min(self.maximum, self.limit + self.increase / self.limit)
+            self._condition.notify_all()
+
+    @contextmanager
+    def request(self):
+        """
+        Hold a slot for the duration of one request.
+
+        Set `.throttled` on the yielded object if the response showed
+        throttling. Exceptions are passed through after the slot is freed.
+        """
+        self.acquire()
+        request = _Request()
+        start = time.monotonic()
+        try:
+            yield request
+        finally:
+            self.release(time.monotonic() - start, request.throttled)
@@ -0,0 +1,65 @@
+##############################################
+# Cache of preprocessed image vectors, keyed #
+# by image content and preprocessing         #
+# settings, so reruns skip work already done #
+##############################################
+
+import hashlib
+from array_store import ShardedArrayStore
+
+
+class VectorCache:
+    """
+    Size-bounded LRU cache of preprocessed vectors on top of a
+    ShardedArrayStore.
+
+    Keys combine the SHA-256 of the source file bytes with every setting
+    that changes the output (target size, grayscale, dtype), so the same
+    image processed with other settings is a different entry.
+    """
+
+    def __init__(self, directory, max_bytes=10 * 1024 ** 3, low_water=0.9):
+        """
+        Args:
+            directory (str): Folder for the cache shards and index
+            max_bytes (int): Most bytes of vectors to keep
+            low_water (float): When over budget, evict down to this
+                fraction of max_bytes so eviction runs in batches
+        """
+        self.store = ShardedArrayStore(directory)
+        self.max_bytes = max_bytes
+        self.low_water = low_water
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def content_hash(data):
+        """ SHA-256 hex digest of the source image bytes. """
+        return hashlib.sha256(data).hexdigest()
+
+    @staticmethod
+    def make_key(content_hash, target_pixels_on_side, grayscale, dtype):
+        mode = 'L' if grayscale else 'RGB'
+        return f'{content_hash}:{target_pixels_on_side}:{mode}:{dtype}'
+
+    def get(self, key):
+        """
+        Returns:
+            np.ndarray: The cached vector, or None on a miss
+        """
+        vector = self.store.get(key)
+        if vector is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return vector
+
+    def put(self, key, vector):
+        self.store.put(key, vector)
+        if self.store.total_bytes() > self.max_bytes:
+            evicted = self.store.evict(int(self.max_bytes * self.low_water))
+            print(f'Vector cache evicted {evicted} entries')
+
+    def close(self):
+        self.store.close()
+        print(f'Vector cache: {self.hits} hits, {self.misses} misses')
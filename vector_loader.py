@@ -0,0 +1,99 @@
+##############################################
+# Compact storage dtypes for image vectors   #
+# and a batch loader that scales them to     #
+# [0, 1] float32 only when they are read.    #
+##############################################
+
+import os
+import numpy as np
+
+# uint8 keeps the raw pixels (1 byte each) and is scaled on read,
+# the float types are stored already scaled to [0, 1]
+STORAGE_DTYPES = ('float64', 'float32', 'float16', 'uint8')
+
+
+def to_storage(pixels, dtype='float64'):
+    """
+    Convert raw pixels to the dtype they are stored in.
+
+    Args:
+        pixels (np.ndarray): uint8 pixel values, 0-255
+        dtype (str): One of STORAGE_DTYPES
+
+    Returns:
+        np.ndarray: The pixels as uint8, or scaled to [0, 1] as a float type
+    """
+    if dtype not in STORAGE_DTYPES:
+        raise ValueError(f"Unknown storage dtype: {dtype}")
+    if dtype == 'uint8':
+        return np.asarray(pixels, dtype=np.uint8)
+    if dtype == 'float64':
+        return np.asarray(pixels) / 255.0
+    # scale in float32 so float16 is only rounded once
+    scaled = np.asarray(pixels, dtype=np.float32) * np.float32(1 / 255)
+    return scaled.astype(dtype, copy=False)
+
+
+def normalize(vector, out=None):
+    """
+    Scale a stored vector to [0, 1] float32.
+
+    Args:
+        vector (np.ndarray): A vector as stored, any of STORAGE_DTYPES
+        out (np.ndarray, optional): float32 array to write into
+
+    Returns:
+        np.ndarray: float32 values in [0, 1]
+    """
+    if out is None:
+        out = np.empty(vector.shape, dtype=np.float32)
+    if vector.dtype == np.uint8:
+        np.multiply(vector, np.float32(1 / 255), out=out, casting='unsafe')
+    else:
+        out[...] = vector
+    return out
+
+
+def _iter_npy(directory):
+    for name in sorted(os.listdir(directory)):
+        if name.endswith('.npy'):
+            # mmap so only the rows in the current batch are paged in
+            yield name[:-len('.npy')], np.load(os.path.join(directory, name), mmap_mode='r')
+
+
+def iter_batches(source, batch_size=256):
+    """
+    Read stored vectors in float32 batches, scaling each batch as it is built.
+
+    Args:
+        source: A ShardedArrayStore, or a folder of .npy files written by
+            functions.save_numpy_array
+        batch_size (int): Vectors per batch
+
+    Yields:
+        tuple: (list of keys, np.ndarray of shape (n, length), float32)
+    """
+    if isinstance(source, str):
+        vectors = _iter_npy(source)
+    else:
+        vectors = source.iter_arrays()
+
+    keys = []
+    batch = None
+    for key, vector in vectors:
+        vector = vector.reshape(-1)
+        if batch is not None and batch.shape[1] != len(vector):
+            yield keys, batch[:len(keys)]
+            keys = []
+            batch = None
+        if batch is None:
+            # a new array per batch, callers may keep the ones they were given
+            batch = np.empty((batch_size, len(vector)), dtype=np.float32)
+        normalize(vector, out=batch[len(keys)])
+        keys.append(key)
+        if len(keys) == batch_size:
+            yield keys, batch
+            keys = []
+            batch = None
+    if keys:
+        yield keys, batch[:len(keys)]